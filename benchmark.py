@@ -0,0 +1,217 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import numpy as np
+
+import triage_engine
+from image_prep import perceptual_hash, prepare_image
+from triage_engine import apply_input_defaults, encode_columns, encode_patient, get_artifacts
+from triage_llm import build_triage_query, encode_image, parse_triage_response
+
+
+BATCH_SIZES = [1, 10, 100, 1000, 10000]
+# Bulk-sized batches, timed on both model formats: the NumPy export serves
+# single patients, the pickle serves bulk_triage.py
+LARGE_BATCH_SIZES = [10000, 100000]
+IMAGE_SIZES = [(640, 480), (1920, 1080), (4032, 3024)]
+
+SAMPLE_PATIENT = {
+    "age": 67, "sex": "Female", "description": "Fell at home, possible wrist injury",
+    "pain_level": 6, "bp_systolic": 150, "bp_diastolic": 90, "heart_rate": 96,
+    "oxygen_saturation": 97, "respiratory_rate": 20, "body_temperature": 37.2,
+    "temp_unit": "Celsius (°C)", "consciousness": "Alert", "transport": "Walk",
+}
+
+
+class StubGroqClient:
+    """
+    Stands in for groq.Groq: every completion sleeps for a fixed latency and
+    returns a well-formed triage answer.
+    """
+
+    def __init__(self, latency=0.5, response='{"level": 3, "reason": "Stable vitals with localized injury."}'):
+        self.latency = latency
+        self.response = response
+        self.chat = types.SimpleNamespace(completions=self)
+
+    def create(self, **kwargs):
+        time.sleep(self.latency)
+        message = types.SimpleNamespace(content=self.response)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure(fn, repeat, warmup=3):
+    """
+    Runs fn repeatedly and returns latency percentiles (ms) and the peak
+    Python-tracked memory of a single call (KB).
+    """
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings_ms = np.array(timings) * 1000
+    return {
+        "p50_ms": float(np.percentile(timings_ms, 50)),
+        "p95_ms": float(np.percentile(timings_ms, 95)),
+        "p99_ms": float(np.percentile(timings_ms, 99)),
+        "mean_ms": float(timings_ms.mean()),
+        "runs": repeat,
+        "peak_kb": peak / 1024,
+    }
+
+
+def _random_patients(n, rng):
+    return {
+        "age": rng.integers(16, 96, n), "sex": rng.choice(["Male", "Female"], n),
+        "description": rng.choice(["chest pain", "leg injury", "fever", "No description"], n),
+        "pain_level": rng.integers(0, 11, n), "bp_systolic": rng.integers(80, 200, n),
+        "bp_diastolic": rng.integers(40, 120, n), "heart_rate": rng.integers(40, 160, n),
+        "oxygen_saturation": rng.integers(85, 100, n), "respiratory_rate": rng.integers(10, 35, n),
+        "body_temperature": rng.uniform(35.0, 40.0, n), "temp_unit": np.full(n, "Celsius (°C)"),
+        "consciousness": rng.choice(["Alert", "Verbal Response", "Pain Response", "Unresponsive"], n),
+        "transport": rng.choice(["Walk", "Public Ambulance", "Private Vehicle"], n),
+    }
+
+
+def run_benchmarks(repeat=200, llm_latency=0.5, e2e_repeat=20, model_path=None):
+    """
+    Times every stage of the triage request path on its own and end to end.
+    """
+    import joblib
+    from PIL import Image
+
+    if model_path is not None:
+        triage_engine.set_artifacts(*triage_engine.load_model_and_scaler(model_path))
+    model, scaler, feature_names = get_artifacts()
+    patient, _ = apply_input_defaults(SAMPLE_PATIENT)
+    row = encode_patient(patient, feature_names)
+    stages = {}
+
+    stages["encode_patient"] = measure(lambda: encode_patient(patient, feature_names, out=row), repeat)
+    stages["scaler.transform"] = measure(lambda: scaler.transform(row), repeat)
+    row_scaled = scaler.transform(row)
+    stages[f"model.predict ({type(model).__name__})"] = measure(lambda: model.predict(row_scaled), repeat)
+    stages["predict_with_ml_model"] = measure(lambda: triage_engine.predict_with_ml_model(row), repeat)
+    stages["predict_with_confidence"] = measure(lambda: triage_engine.predict_with_confidence(row), repeat)
+
+    # Per-estimator numbers need the scikit-learn ensemble
+    if os.path.exists(triage_engine.MODEL_PATH):
+        voting_model = joblib.load(triage_engine.MODEL_PATH)
+        for name, estimator in voting_model.named_estimators_.items():
+            stages[f"{name}.predict"] = measure(lambda e=estimator: e.predict(row_scaled), repeat)
+        stages["VotingClassifier.predict"] = measure(lambda: voting_model.predict(row_scaled), repeat)
+
+    for width, height in IMAGE_SIZES:
+        image = Image.new("RGB", (width, height), (180, 120, 100))
+        stages[f"prepare+encode_image {width}x{height}"] = measure(
+            lambda image=image: encode_image(prepare_image(image)["jpeg"]), max(repeat // 20, 5), warmup=1)
+    prepared = prepare_image(Image.new("RGB", IMAGE_SIZES[-1], (180, 120, 100)))["image"]
+    stages["perceptual_hash"] = measure(lambda: perceptual_hash(prepared), repeat)
+
+    stages["build_triage_query"] = measure(lambda: build_triage_query(patient, "No image provided."), repeat)
+    stages["parse_triage_response"] = measure(
+        lambda: parse_triage_response('{"level": 2, "reason": "Possible fracture, needs imaging."}'), repeat)
+
+    # End to end through the concurrent pipeline, with a stubbed Groq client.
+    # Each run gets a fresh description so the LLM cache never short-circuits
+    # it, and the cache itself is a throwaway file.
+    from llm_cache import LLMCache, set_llm_cache
+    from triage_pipeline import run_triage
+    set_llm_cache(LLMCache(os.path.join(tempfile.mkdtemp(), "benchmark_cache.sqlite3")))
+    client = StubGroqClient(latency=llm_latency)
+    counter = iter(range(10 ** 9))
+    stages[f"run_triage (stub LLM {llm_latency * 1000:.0f} ms)"] = measure(
+        lambda: run_triage(client, dict(patient, description=f"benchmark run {next(counter)}")),
+        e2e_repeat, warmup=1)
+
+    throughput = {}
+    rng = np.random.default_rng(0)
+    for batch_size in BATCH_SIZES:
+        columns = _random_patients(batch_size, rng)
+        runs = max(3, min(50, 10000 // batch_size))
+        stats = measure(lambda: triage_engine.predict_with_ml_model(
+            encode_columns(columns, batch_size, feature_names)), runs, warmup=1)
+        stats["rows_per_sec"] = batch_size / (stats["p50_ms"] / 1000)
+        throughput[str(batch_size)] = stats
+
+    large_batches = {}
+    backends = {"export": triage_engine.MODEL_ARRAYS_PATH, "pickle": triage_engine.MODEL_PATH}
+    for backend, path in backends.items():
+        if not os.path.exists(path):
+            continue
+        artifacts = triage_engine.load_model_and_scaler(path)
+        for batch_size in LARGE_BATCH_SIZES:
+            features = encode_columns(_random_patients(batch_size, rng), batch_size, feature_names)
+            stats = measure(lambda: triage_engine.predict_with_ml_model(features, artifacts), 3, warmup=1)
+            stats["rows_per_sec"] = batch_size / (stats["p50_ms"] / 1000)
+            large_batches.setdefault(backend, {})[str(batch_size)] = stats
+
+    return stages, throughput, large_batches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-stage latency benchmark of the triage request path.")
+    parser.add_argument("--repeat", type=int, default=200, help="timed runs per local stage")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="stub Groq latency in seconds")
+    parser.add_argument("--e2e-repeat", type=int, default=20, help="timed end-to-end runs")
+    parser.add_argument("--model", default=None, help="model to benchmark (default: what the app loads)")
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args(argv)
+
+    stages, throughput, large_batches = run_benchmarks(args.repeat, args.llm_latency, args.e2e_repeat, args.model)
+
+    print(f"{'stage':<44} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak KB':>9}")
+    for name, stats in stages.items():
+        print(f"{name:<44} {stats['p50_ms']:9.3f} {stats['p95_ms']:9.3f} {stats['p99_ms']:9.3f} "
+              f"{stats['peak_kb']:9.1f}")
+    print(f"\n{'batch size':<12} {'p50 ms':>10} {'rows/sec':>12} {'peak KB':>10}")
+    for batch_size, stats in throughput.items():
+        print(f"{batch_size:<12} {stats['p50_ms']:10.3f} {stats['rows_per_sec']:12,.0f} {stats['peak_kb']:10.1f}")
+    print(f"\n{'model':<8} {'batch size':<12} {'p50 ms':>10} {'rows/sec':>12} {'peak KB':>10}")
+    for backend, sizes in large_batches.items():
+        for batch_size, stats in sizes.items():
+            print(f"{backend:<8} {batch_size:<12} {stats['p50_ms']:10.3f} {stats['rows_per_sec']:12,.0f} "
+                  f"{stats['peak_kb']:10.1f}")
+
+    results = {
+        "commit": _git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "stages": stages,
+        "throughput": throughput,
+        "large_batches": large_batches,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults saved to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import triage_engine
+from triage_engine import clean_triage_data, get_artifacts, predict_with_ml_model
+
+
+PREDICTION_COL = "KTAS_ml"
+
+
+def _init_worker(model_path, scaler_path, feature_names_path):
+    # Each worker process loads the artifacts once and reuses them for every chunk
+    triage_engine.set_artifacts(*triage_engine.load_model_and_scaler(
+        model_path, scaler_path, feature_names_path))
+
+
+def score_chunk(chunk):
+    """
+    Cleans one data.csv-style chunk with the training rules and adds the
+    predicted triage level (1-5) as a new column.
+    """
+    feature_names = get_artifacts()[2]
+    chunk = clean_triage_data(chunk, subset=list(feature_names))
+    if len(chunk):
+        chunk[PREDICTION_COL] = predict_with_ml_model(chunk[list(feature_names)].to_numpy())
+    else:
+        chunk[PREDICTION_COL] = pd.Series(dtype=int)
+    return chunk
+
+
+def bulk_triage(input_path, output_path, chunksize=50000, workers=None,
+                model_path=None, scaler_path=triage_engine.SCALER_PATH,
+                feature_names_path=triage_engine.FEATURE_NAMES_PATH, log=sys.stderr):
+    """
+    Streams a CSV through the ML model chunk by chunk across a process pool and
+    writes the scored rows to output_path in input order. Only a bounded number
+    of chunks is in memory at a time. Returns (rows_read, rows_scored).
+    model_path defaults to the pickled ensemble when it exists: on chunks of
+    thousands of rows scikit-learn is about 3x faster than the NumPy export,
+    which is built for single patients.
+    """
+    if model_path is None and os.path.exists(triage_engine.MODEL_PATH):
+        model_path = triage_engine.MODEL_PATH
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = workers * 2
+    rows_read = 0
+    rows_scored = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(model_path, scaler_path, feature_names_path)) as executor, \
+            open(output_path, "w", newline="") as out:
+        pending = deque()
+        write_header = True
+
+        def write_next():
+            nonlocal write_header, rows_scored
+            scored = pending.popleft().result()
+            scored.to_csv(out, header=write_header, index=False)
+            write_header = False
+            rows_scored += len(scored)
+            elapsed = time.perf_counter() - start
+            print(f"{rows_read} rows read, {rows_scored} scored "
+                  f"({rows_read / elapsed:,.0f} rows/sec)", file=log)
+
+        for chunk in pd.read_csv(input_path, chunksize=chunksize):
+            rows_read += len(chunk)
+            pending.append(executor.submit(score_chunk, chunk))
+            # Back-pressure: never hold more than max_in_flight chunks in memory
+            if len(pending) >= max_in_flight:
+                write_next()
+        while pending:
+            write_next()
+
+    elapsed = time.perf_counter() - start
+    print(f"Done: {rows_scored}/{rows_read} rows scored in {elapsed:.1f}s "
+          f"({rows_read / max(elapsed, 1e-9):,.0f} rows/sec), "
+          f"{rows_read - rows_scored} dropped for missing values", file=log)
+    return rows_read, rows_scored
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score a data.csv-style CSV with the saved voting model.")
+    parser.add_argument("input", help="CSV with Sex, Age, Arrival mode, Injury, Mental, Pain, SBP, DBP, HR, RR, BT")
+    parser.add_argument("output", help="where to write the input rows plus the predicted " + PREDICTION_COL)
+    parser.add_argument("--chunksize", type=int, default=50000, help="rows per chunk (default: 50000)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--model", default=None,
+                        help="voting_model.pkl or an exported array directory "
+                             "(default: voting_model.pkl if present, else the export)")
+    parser.add_argument("--scaler", default=triage_engine.SCALER_PATH)
+    parser.add_argument("--feature-names", default=triage_engine.FEATURE_NAMES_PATH)
+    args = parser.parse_args(argv)
+
+    bulk_triage(args.input, args.output, chunksize=args.chunksize, workers=args.workers,
+                model_path=args.model, scaler_path=args.scaler, feature_names_path=args.feature_names)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from triage_engine import clean_triage_data
+
+
+# Cleaned copies of training CSVs, one directory per source file: a raw
+# little-endian file per column plus meta.json. Columns are memory-mapped on
+# load, so opening a cache is free and reading touches only the rows used.
+CACHE_DIR = os.environ.get("DATA_CACHE_DIR", ".data_cache")
+CHUNK_ROWS = 100_000
+FORMAT_VERSION = 1
+META_FILE = "meta.json"
+LABEL = "KTAS_expert"
+
+# Compact dtypes of the data.csv columns; any other column is stored as
+# FLOAT_DTYPE. The codes are parsed as float32, which also holds the NaN of a
+# blank cell until the row is dropped.
+COLUMN_DTYPES = {
+    "Sex": "int8",
+    "Age": "int16",
+    "Arrival mode": "int8",
+    "Injury": "int8",
+    "Mental": "int8",
+    "Pain": "int8",
+    "KTAS_expert": "int8",
+}
+FLOAT_DTYPE = "float32"
+# float32 keeps about 7 significant digits, so rounding a vital back to this
+# many decimals restores exactly the value written in the CSV
+DECIMALS = 3
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_path(source, cache_dir=CACHE_DIR):
+    name = os.path.splitext(os.path.basename(source))[0]
+    key = hashlib.sha256(os.path.abspath(source).encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{name}-{key}")
+
+
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, META_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_meta(path, meta):
+    with open(os.path.join(path, META_FILE + ".tmp"), "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(os.path.join(path, META_FILE + ".tmp"), os.path.join(path, META_FILE))
+
+
+def prepare(source="data.csv", cache_dir=CACHE_DIR, chunk_rows=CHUNK_ROWS, log=sys.stderr):
+    """
+    Returns the ColumnarDataset of a data.csv-style CSV, parsing it only if
+    there is no cache yet or the source changed. A changed size or
+    modification time is confirmed with a content hash, so a touched but
+    unchanged file is not parsed again.
+    """
+    path = cache_path(source, cache_dir)
+    stat = os.stat(source)
+    meta = _read_meta(path)
+    digest = None
+    if meta is not None and meta.get("format_version") == FORMAT_VERSION:
+        if (meta["source_size"], meta["source_mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+            return ColumnarDataset(path, meta)
+        digest = file_sha256(source)
+        if meta["source_sha256"] == digest:
+            meta["source_mtime_ns"] = stat.st_mtime_ns
+            _write_meta(path, meta)
+            return ColumnarDataset(path, meta)
+    return _parse(source, path, stat, digest or file_sha256(source), chunk_rows, log)
+
+
+def _compact(values, name, dtype):
+    values = values.to_numpy(dtype=np.float64)
+    compact = values.astype(dtype)
+    if np.issubdtype(compact.dtype, np.integer) and not np.array_equal(compact, values):
+        raise ValueError(f"Column {name} has values that do not fit {dtype}")
+    return compact
+
+
+def _parse(source, path, stat, digest, chunk_rows, log):
+    # Parsed chunk by chunk into a staging directory that replaces the old
+    # cache in one rename, so readers never see a half-written cache
+    import pandas as pd
+
+    start = time.perf_counter()
+    staging = path + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    columns = None
+    files = []
+    rows_read = 0
+    n_rows = 0
+    try:
+        for chunk in pd.read_csv(source, chunksize=chunk_rows, dtype={name: "float32" for name in COLUMN_DTYPES}):
+            rows_read += len(chunk)
+            chunk = clean_triage_data(chunk)
+            if columns is None:
+                columns = [{"name": str(name), "dtype": COLUMN_DTYPES.get(name, FLOAT_DTYPE), "file": f"col{j}.bin"}
+                           for j, name in enumerate(chunk.columns)]
+                files = [open(os.path.join(staging, column["file"]), "wb") for column in columns]
+            for column, f in zip(columns, files):
+                f.write(_compact(chunk[column["name"]], column["name"], column["dtype"]).tobytes())
+            n_rows += len(chunk)
+    finally:
+        for f in files:
+            f.close()
+    if columns is None:
+        raise ValueError(f"{source} has no rows")
+
+    _write_meta(staging, {
+        "format_version": FORMAT_VERSION,
+        "source": os.path.abspath(source),
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "source_sha256": digest,
+        "rows_read": rows_read,
+        "n_rows": n_rows,
+        "columns": columns,
+    })
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(staging, path)
+    print(f"Prepared {source}: {n_rows:,} of {rows_read:,} rows kept in {time.perf_counter() - start:.1f}s",
+          file=log)
+    return ColumnarDataset(path, _read_meta(path))
+
+
+class ColumnarDataset:
+    """
+    A prepared dataset. Values come back as float64 (labels shifted to 0-4,
+    as training uses them), but only for the rows asked for, so the cache
+    can be far larger than memory.
+    """
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.n_rows = meta["n_rows"]
+        self._columns = {column["name"]: column for column in meta["columns"]}
+        self.feature_names = [column["name"] for column in meta["columns"] if column["name"] != LABEL]
+
+    def column(self, name):
+        """
+        Returns a column in its compact dtype, as a read-only memory map.
+        """
+        column = self._columns[name]
+        if self.n_rows == 0:
+            return np.empty(0, dtype=column["dtype"])  # Empty files cannot be mapped
+        return np.memmap(os.path.join(self.path, column["file"]), dtype=column["dtype"], mode="r",
+                         shape=(self.n_rows,))
+
+    def values(self, name, rows=slice(None)):
+        values = self.column(name)[rows].astype(np.float64)
+        if self._columns[name]["dtype"] == FLOAT_DTYPE:
+            np.round(values, DECIMALS, out=values)
+        return values
+
+    def take(self, rows=slice(None), out=None):
+        """
+        Returns the feature matrix of the given rows (an index array or
+        slice), written into out when given.
+        """
+        if out is None:
+            n = len(range(self.n_rows)[rows]) if isinstance(rows, slice) else len(rows)
+            out = np.empty((n, len(self.feature_names)))
+        for j, name in enumerate(self.feature_names):
+            out[:, j] = self.values(name, rows)
+        return out
+
+    def labels(self, rows=slice(None)):
+        return self.column(LABEL)[rows].astype(np.int64) - 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parse a training CSV into the columnar cache.")
+    parser.add_argument("source", nargs="?", default="data.csv")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    args = parser.parse_args(argv)
+
+    dataset = prepare(args.source, args.cache_dir, args.chunk_rows)
+    size = sum(os.path.getsize(os.path.join(dataset.path, column["file"])) for column in dataset.meta["columns"])
+    print(f"{dataset.path}: {dataset.n_rows:,} rows, {len(dataset.feature_names)} features, {size / 1024:,.0f} KB")
+
+
+if __name__ == "__main__":
+    main()
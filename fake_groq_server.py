@@ -0,0 +1,175 @@
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+COMPLETIONS_PATH = "/openai/v1/chat/completions"
+TRIAGE_REPLY = '{"level": 3, "reason": "Stable vitals, needs routine assessment."}'
+VISION_REPLY = "The image shows a person with a superficial abrasion on the forearm. No active bleeding is visible."
+
+
+class FakeGroqServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the Groq chat completions API. Point a client at it
+    with GROQ_BASE_URL=http://host:port. Every request waits latency +/- jitter
+    seconds; a fraction is answered with 429 rate-limit errors and a fraction
+    hangs for hang_seconds to simulate upstream timeouts. Streamed requests
+    get their first token after the latency and one more every token_interval.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.5, jitter=0.2, rate_limit_rate=0.0, timeout_rate=0.0,
+                 hang_seconds=30.0, token_interval=0.02, seed=None):
+        super().__init__(address, FakeGroqHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.timeout_rate = timeout_rate
+        self.hang_seconds = hang_seconds
+        self.token_interval = token_interval
+        self.random = random.Random(seed)
+        self.stats = {"requests": 0, "ok": 0, "rate_limited": 0, "timed_out": 0}
+        self.stats_lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+
+class FakeGroqHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass  # Keep load-test output readable
+
+    def _send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        server = self.server
+        server.count("requests")
+        if self.path != COMPLETIONS_PATH:
+            self._send_json(404, {"error": {"message": "Unknown path", "type": "invalid_request_error"}})
+            return
+
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        roll = server.random.random()
+        if roll < server.timeout_rate:
+            server.count("timed_out")
+            time.sleep(server.hang_seconds)
+            try:
+                self._send_json(504, {"error": {"message": "Upstream timed out", "type": "timeout"}})
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # The client gave up first, as it should
+            return
+        if roll < server.timeout_rate + server.rate_limit_rate:
+            server.count("rate_limited")
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}},
+                            headers={"retry-after": "1"})
+            return
+
+        time.sleep(max(0.0, server.latency + server.random.uniform(-server.jitter, server.jitter)))
+
+        # Image requests carry a list of content parts, surge requests a JSON
+        # list of patients and single triage requests a JSON object
+        content = request.get("messages", [{}])[-1].get("content")
+        if isinstance(content, list):
+            reply = VISION_REPLY
+        elif content.startswith("["):
+            reply = json.dumps({"results": [dict(json.loads(TRIAGE_REPLY), id=patient.get("id"))
+                                            for patient in json.loads(content)]})
+        else:
+            reply = TRIAGE_REPLY
+        prompt_tokens = len(json.dumps(request.get("messages", []))) // 4
+        completion_tokens = len(reply) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        server.count("ok")
+        if request.get("stream"):
+            self._stream_reply(request, reply, usage)
+            return
+        self._send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", ""),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": reply}}],
+            "usage": usage,
+        })
+
+    def _stream_reply(self, request, reply, usage):
+        # Server-sent events in the OpenAI chunk format, about 4 characters a token
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        chunk = {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion.chunk",
+                 "created": int(time.time()), "model": request.get("model", "")}
+        pieces = [reply[i:i + 4] for i in range(0, len(reply), 4)]
+        try:
+            for i, piece in enumerate(pieces):
+                if i:
+                    time.sleep(self.server.token_interval)
+                delta = {"role": "assistant", "content": piece} if i == 0 else {"content": piece}
+                self._send_event(dict(chunk, choices=[{"index": 0, "delta": delta, "finish_reason": None}]))
+            self._send_event(dict(chunk, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                                  x_groq={"usage": usage}))
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _send_event(self, data):
+        self.wfile.write(b"data: " + json.dumps(data).encode("utf-8") + b"\n\n")
+        self.wfile.flush()
+
+
+def start_fake_groq_server(host="127.0.0.1", port=0, **options):
+    """
+    Starts a FakeGroqServer on a background thread and returns it. Port 0
+    picks a free port; see server.base_url.
+    """
+    server = FakeGroqServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, name="fake-groq", daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a local fake Groq chat completions server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5, help="mean response time in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="+/- seconds around the mean")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction answered with 429")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="fraction that hangs")
+    parser.add_argument("--hang-seconds", type=float, default=30.0)
+    parser.add_argument("--token-interval", type=float, default=0.02, help="seconds between streamed tokens")
+    args = parser.parse_args(argv)
+
+    server = FakeGroqServer((args.host, args.port), latency=args.latency, jitter=args.jitter,
+                            rate_limit_rate=args.rate_limit_rate, timeout_rate=args.timeout_rate,
+                            hang_seconds=args.hang_seconds, token_interval=args.token_interval)
+    print(f"Fake Groq listening on {server.base_url} (set GROQ_BASE_URL to this)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+import json
+import os
+
+import numpy as np
+
+
+FORMAT_VERSION = 1
+META_FILE = "meta.json"
+
+# Size of each (rows x training set) KNN distance block, so large batches
+# against large training sets keep the distance matrices in memory bounded
+KNN_BLOCK_ELEMENTS = 1 << 20
+# Likewise for the (rows x trees) node arrays of the forest traversal
+RF_BLOCK_ELEMENTS = 1 << 20
+
+
+def _save(path, name, array):
+    np.save(os.path.join(path, name + ".npy"), np.ascontiguousarray(array))
+
+
+def export_voting_model(voting_model, scaler, feature_names, path):
+    """
+    Writes a fitted hard-voting (RandomForest, LinearSVC, KNN) ensemble and its
+    StandardScaler as flat .npy arrays plus a small JSON manifest. Every array
+    can be memory-mapped, so loading needs neither pickle nor scikit-learn.
+    """
+    FastVotingModel(*voting_model_arrays(voting_model, scaler, feature_names)).save(path)
+
+
+def voting_model_arrays(voting_model, scaler, feature_names):
+    """
+    Returns the (arrays, meta) export of a fitted ensemble without writing
+    it, e.g. to build a FastVotingModel in memory. A calibration_ dict set
+    on voting_model (see calibrate_soft_vote) is kept in the meta, and
+    holdout_rows_ (see model.train_from_dataset) in the arrays.
+    """
+    if voting_model.voting != "hard" or voting_model.weights is not None:
+        raise ValueError("Only unweighted hard voting can be exported")
+    rf = voting_model.named_estimators_["rf"]
+    svc = voting_model.named_estimators_["svc"]
+    knn = voting_model.named_estimators_["knn"]
+    if knn.weights != "uniform" or knn.effective_metric_ != "euclidean":
+        raise ValueError("Only uniform-weight euclidean KNN can be exported")
+
+    # Forest: every tree's nodes are concatenated into flat arrays, with child
+    # indices rebased onto them. Leaves point back at themselves, so a fixed
+    # number of steps walks every row to its leaf without branching.
+    children, feature, threshold, proba, roots = [], [], [], [], []
+    offset = 0
+    for estimator in rf.estimators_:
+        tree = estimator.tree_
+        is_leaf = tree.children_left == -1
+        own_index = np.arange(tree.node_count) + offset
+        children.append(np.stack([
+            np.where(is_leaf, own_index, tree.children_left + offset),
+            np.where(is_leaf, own_index, tree.children_right + offset),
+        ], axis=1))
+        feature.append(np.where(is_leaf, 0, tree.feature))
+        threshold.append(tree.threshold)
+        # Same normalization DecisionTreeClassifier.predict_proba applies
+        value = tree.value[:, 0, :rf.n_classes_].astype(np.float64)
+        normalizer = value.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        proba.append(value / normalizer)
+        roots.append(offset)
+        offset += tree.node_count
+
+    arrays = {
+        "rf_children": np.concatenate(children).astype(np.int32),
+        "rf_feature": np.concatenate(feature).astype(np.int32),
+        "rf_threshold": np.concatenate(threshold).astype(np.float64),
+        "rf_proba": np.concatenate(proba),
+        "rf_roots": np.asarray(roots, dtype=np.int32),
+        "rf_classes": np.asarray(rf.classes_).astype(np.int64),
+        "svc_coef": svc.coef_.astype(np.float64),
+        "svc_intercept": np.asarray(svc.intercept_, dtype=np.float64),
+        "svc_classes": np.asarray(svc.classes_).astype(np.int64),
+        "knn_X": np.asarray(knn._fit_X, dtype=np.float64),
+        "knn_y": np.asarray(knn._y, dtype=np.int64),
+        "knn_classes": np.asarray(knn.classes_).astype(np.int64),
+        "scaler_mean": scaler.mean_.astype(np.float64),
+        "scaler_scale": scaler.scale_.astype(np.float64),
+        "classes": np.asarray(voting_model.le_.classes_).astype(np.int64),
+    }
+    meta = {
+        "format_version": FORMAT_VERSION,
+        "feature_names": [str(name) for name in feature_names],
+        "n_neighbors": int(knn.n_neighbors),
+        "n_trees": len(rf.estimators_),
+        "max_depth": max(int(estimator.tree_.max_depth) for estimator in rf.estimators_),
+        # Lets incremental learning keep updating the scaler's running statistics
+        "scaler_n_samples_seen": int(np.max(getattr(scaler, "n_samples_seen_", len(knn._y)))),
+    }
+    if getattr(voting_model, "calibration_", None) is not None:
+        meta["calibration"] = voting_model.calibration_
+    if getattr(voting_model, "holdout_rows_", None) is not None:
+        # Rows of the training data kept out of training, for online learning's accuracy check
+        arrays["holdout_rows"] = np.asarray(voting_model.holdout_rows_, dtype=np.int64)
+        meta["holdout_source_sha256"] = voting_model.holdout_source_
+    return arrays, meta
+
+
+def _count_votes(labels, n_classes):
+    # Per-row label histogram of an (n_rows, n_voters) integer array
+    offsets = np.arange(len(labels))[:, np.newaxis] * n_classes
+    counts = np.bincount((labels + offsets).ravel(), minlength=len(labels) * n_classes)
+    return counts.reshape(len(labels), n_classes)
+
+
+class FastScaler:
+    """
+    StandardScaler.transform without scikit-learn.
+    """
+
+    def __init__(self, mean, scale):
+        self.mean_ = mean
+        self.scale_ = scale
+
+    def transform(self, X):
+        X = np.array(X, dtype=np.float64)  # Copy, like StandardScaler(copy=True)
+        X -= self.mean_
+        X /= self.scale_
+        return X
+
+
+class FastVotingModel:
+    """
+    Pure-NumPy re-implementation of the exported hard-voting ensemble. It
+    reproduces VotingClassifier.predict on scaled features, including
+    scikit-learn's floating-point order and tie-breaking.
+    """
+
+    def __init__(self, arrays, meta):
+        self.arrays = arrays
+        self.meta = meta
+        self.feature_names = meta["feature_names"]
+        self.n_neighbors = meta["n_neighbors"]
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        self.scaler = FastScaler(self.scaler_mean, self.scaler_scale)
+        self.n_classes = len(self.classes)
+
+    def save(self, path):
+        """
+        Writes the model in the export_voting_model layout.
+        """
+        os.makedirs(path, exist_ok=True)
+        for name, array in self.arrays.items():
+            _save(path, name, array)
+        with open(os.path.join(path, META_FILE), "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+    def _rf_proba(self, X):
+        # Trees compare float32 features against float64 thresholds
+        X = X.astype(np.float32)
+        total = np.zeros((len(X), self.rf_proba.shape[1]))
+        block_rows = max(1, RF_BLOCK_ELEMENTS // len(self.rf_roots))
+        for start in range(0, len(X), block_rows):
+            self._rf_proba_block(X[start:start + block_rows], total[start:start + block_rows])
+        total /= len(self.rf_roots)
+        return total
+
+    def _rf_proba_block(self, X, total):
+        # Adds the leaf probabilities of every tree for a block of rows to total
+        rows = np.arange(len(X))[:, np.newaxis]
+        nodes = np.broadcast_to(self.rf_roots, (len(X), len(self.rf_roots)))
+        for _ in range(self.meta["max_depth"]):
+            go_right = X[rows, self.rf_feature[nodes]] > self.rf_threshold[nodes]
+            next_nodes = self.rf_children[nodes, go_right.view(np.int8)]
+            if np.array_equal(next_nodes, nodes):
+                break  # Every row has reached a leaf in every tree
+            nodes = next_nodes
+
+        # Accumulated tree by tree, in the same order as the forest does,
+        # so no (n_trees, n_rows, n_classes) array is ever built
+        for tree in range(nodes.shape[1]):
+            total += self.rf_proba[nodes[:, tree]]
+
+    def _predict_rf(self, X):
+        return self.rf_classes[self._rf_proba(X).argmax(axis=1)]
+
+    def _svc_scores(self, X):
+        return X @ self.svc_coef.T + self.svc_intercept
+
+    def _predict_svc(self, X):
+        return self.svc_classes[self._svc_scores(X).argmax(axis=1)]
+
+    def _knn_votes(self, X):
+        # Per-class neighbour counts of every row
+        votes = np.empty((len(X), len(self.knn_classes)))
+        k = self.n_neighbors
+        one_hot = (self.knn_y[:, np.newaxis] == np.arange(len(self.knn_classes))).astype(np.float64)
+        block_rows = max(1, KNN_BLOCK_ELEMENTS // len(self.knn_X))
+        for start in range(0, len(X), block_rows):
+            block = X[start:start + block_rows]
+            # Summed feature by feature, like the KD-tree's distance loop
+            dist = np.zeros((len(block), len(self.knn_X)))
+            for j in range(self.knn_X.shape[1]):
+                dist += (block[:, j, np.newaxis] - self.knn_X[:, j]) ** 2
+            # The k nearest are everything closer than the k-th distance, plus
+            # as many points tied with it as needed, taken in training order
+            kth = np.partition(dist, k - 1, axis=1)[:, k - 1:k]
+            closer = dist < kth
+            tied = dist == kth
+            needed = k - closer.sum(axis=1, keepdims=True)
+            selected = closer | (tied & (np.cumsum(tied, axis=1) <= needed))
+            votes[start:start + len(block)] = selected @ one_hot
+        return votes
+
+    def _predict_knn(self, X):
+        return self.knn_classes[self._knn_votes(X).argmax(axis=1)]
+
+    def predict(self, X):
+        """
+        Predicts class labels for already scaled features.
+        """
+        X = _as_rows(X)
+        return self._vote(self._predict_rf(X), self._predict_svc(X), self._predict_knn(X))
+
+    def _vote(self, *predictions):
+        # Majority vote; ties go to the lowest label, as with np.bincount().argmax().
+        # Votes are counted by position in self.classes, so any sorted label set works
+        votes = np.searchsorted(self.classes, np.stack(predictions, axis=1))
+        return self.classes[_count_votes(votes, self.n_classes).argmax(axis=1)]
+
+    def _align(self, values, classes):
+        # Per-class columns of one estimator in self.classes order
+        aligned = np.zeros((len(values), self.n_classes))
+        aligned[:, np.searchsorted(self.classes, classes)] = values
+        return aligned
+
+    def _components(self, X):
+        # Each estimator's class scores, aligned to self.classes
+        return (self._align(self._rf_proba(X), self.rf_classes),
+                self._align(self._svc_scores(X), self.svc_classes),
+                self._align(self._knn_votes(X) / self.n_neighbors, self.knn_classes))
+
+    def predict_with_proba(self, X):
+        """
+        Returns (predict(X), probabilities) from one pass of the estimators.
+        The probabilities are the calibrated soft vote, with columns in
+        self.classes order. The hard vote stays the model's prediction;
+        they say how sure the ensemble is. Models exported without a
+        calibration use temperatures of 1.
+        """
+        X = _as_rows(X)
+        rf_proba, svc_scores, knn_votes = self._rf_proba(X), self._svc_scores(X), self._knn_votes(X)
+        labels = self._vote(self.rf_classes[rf_proba.argmax(axis=1)], self.svc_classes[svc_scores.argmax(axis=1)],
+                            self.knn_classes[knn_votes.argmax(axis=1)])
+        return labels, self._calibrated(self._align(rf_proba, self.rf_classes),
+                                        self._align(svc_scores, self.svc_classes),
+                                        self._align(knn_votes / self.n_neighbors, self.knn_classes))
+
+    def _calibrated(self, rf_proba, svc_scores, knn_proba):
+        calibration = self.meta.get("calibration") or {}
+        return _soft_vote(rf_proba, svc_scores, knn_proba, calibration.get("svc_temperature", 1.0),
+                          calibration.get("temperature", 1.0))
+
+
+def _as_rows(X):
+    X = np.asarray(X, dtype=np.float64)
+    return X.reshape(1, -1) if X.ndim == 1 else X
+
+
+def _softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def _soft_vote(rf_proba, svc_scores, knn_proba, svc_temperature, temperature):
+    # The SVC has no probabilities, so its decision scores go through a
+    # softmax; the average of the three is then tempered as a whole
+    average = (rf_proba + _softmax(svc_scores / svc_temperature) + knn_proba) / 3
+    return _softmax(np.log(np.maximum(average, 1e-12)) / temperature)
+
+
+def calibrate_soft_vote(model, X, labels):
+    """
+    Fits the soft vote's two temperatures on held-out scaled features X and
+    their labels by minimizing the negative log-likelihood over a grid.
+    Returns the calibration dict to store in the model's meta.
+    """
+    components = model._components(_as_rows(X))
+    rows = np.arange(len(labels))
+    columns = np.searchsorted(model.classes, labels)
+    best = None
+    for svc_temperature in np.geomspace(0.05, 5.0, 21):
+        for temperature in np.geomspace(0.2, 5.0, 29):
+            proba = _soft_vote(*components, svc_temperature, temperature)
+            loss = -np.mean(np.log(np.maximum(proba[rows, columns], 1e-12)))
+            if best is None or loss < best[0]:
+                best = (loss, svc_temperature, temperature)
+    return {"svc_temperature": float(best[1]), "temperature": float(best[2]), "log_loss": float(best[0]),
+            "n_samples": int(len(labels))}
+
+
+def load_fast_model(path, mmap=True):
+    """
+    Loads an exported model directory. With mmap, arrays are mapped read-only
+    and shared between processes through the page cache.
+    """
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    if meta.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported model format version: {meta.get('format_version')}")
+
+    arrays = {}
+    for filename in os.listdir(path):
+        if filename.endswith(".npy"):
+            array = np.load(os.path.join(path, filename), mmap_mode="r" if mmap else None)
+            # A plain ndarray view over the mapping avoids np.memmap's per-index overhead
+            arrays[filename[:-4]] = np.asarray(array)
+    return FastVotingModel(arrays, meta)
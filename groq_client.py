@@ -0,0 +1,388 @@
+import json
+import os
+import random
+import threading
+import time
+import types
+
+import metrics
+
+DEADLINE_SECONDS = 20.0         # Budget for one completion, retries included
+ATTEMPT_TIMEOUT_SECONDS = 10.0  # Budget for a single HTTP attempt
+MAX_ATTEMPTS = 3
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 4.0
+FAILURE_THRESHOLD = 5           # Consecutive failed attempts before the breaker opens
+RESET_SECONDS = 30.0            # How long the breaker stays open before a trial call
+MAX_CONNECTIONS = 20
+
+# Groq account limits, shared by every call the process makes. Unset, there
+# is no client-side limiter and Groq's own 429s are retried instead; a limiter
+# sized below the account's real limits would only turn calls into ML-only
+# fallbacks
+REQUESTS_PER_MINUTE = int(os.environ.get("GROQ_REQUESTS_PER_MINUTE", "0")) or None
+TOKENS_PER_MINUTE = int(os.environ.get("GROQ_TOKENS_PER_MINUTE", "0")) or None
+IMAGE_TOKEN_ESTIMATE = 1000     # What one image is budgeted at before the call
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class LLMUnavailableError(Exception):
+    """
+    The LLM could not answer within its deadline and retries, or the circuit
+    breaker is open. Callers should fall back to the ML model.
+    """
+
+
+class CircuitOpenError(LLMUnavailableError):
+    pass
+
+
+class RateLimitBudgetError(LLMUnavailableError):
+    """
+    The client-side rate limiter could not fit the call in before its deadline.
+    """
+
+
+class LLMRequestError(LLMUnavailableError):
+    """
+    Groq rejected the request itself (e.g. a bad request or an invalid API
+    key). Retrying will not help, but callers fall back the same way.
+    """
+
+
+def _rejected(error):
+    # Groq's own errors become LLMRequestError; anything else is a bug to surface
+    import groq
+    if isinstance(error, groq.APIError):
+        return LLMRequestError(f"LLM request rejected: {error}")
+    return error
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and rejects calls
+    for reset_seconds. It then lets a single trial call through: success
+    closes it again, failure reopens it.
+    """
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_seconds=RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < self.reset_seconds:
+                return "open"
+            return "half_open"
+
+    def allow(self):
+        """
+        Returns True if a call may go ahead now.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_seconds or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def release(self):
+        """
+        Ends a call that neither succeeded nor failed (e.g. a request Groq
+        rejected as invalid), so a trial call it held is free again.
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+
+class TokenBucket:
+    """
+    Holds up to capacity tokens and refills at rate tokens per second.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, amount):
+        """
+        Takes amount tokens if they are available now and returns 0, or
+        returns how many seconds to wait before they will be.
+        """
+        amount = min(amount, self.capacity)  # A call larger than the bucket still gets through when full
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) / self.rate
+
+    def refund(self, amount):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+
+class _Unlimited:
+    # Stands in for the TokenBucket of a limit that is not configured
+
+    def try_acquire(self, amount):
+        return 0.0
+
+    def refund(self, amount):
+        pass
+
+
+def _per_minute_bucket(limit):
+    return _Unlimited() if limit is None else TokenBucket(limit / 60.0, limit)
+
+
+class RateLimiter:
+    """
+    Client-side copy of the Groq per-minute request and token limits, so
+    bursts (e.g. a surge of patients) queue here instead of collecting 429s.
+    A limit of None is not enforced.
+    """
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE):
+        self.requests = _per_minute_bucket(requests_per_minute)
+        self.tokens = _per_minute_bucket(tokens_per_minute)
+
+    def acquire(self, tokens, timeout=None):
+        """
+        Waits until one request and tokens tokens fit under the limits.
+        Returns False if that would take longer than timeout seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.requests.try_acquire(1)
+            if not wait:
+                wait = self.tokens.try_acquire(tokens)
+                if not wait:
+                    return True
+                self.requests.refund(1)
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+def make_rate_limiter(share=1):
+    """
+    Returns a RateLimiter for 1/share of the configured Groq limits (e.g.
+    one of several processes on the same account), or None when neither
+    GROQ_REQUESTS_PER_MINUTE nor GROQ_TOKENS_PER_MINUTE is set.
+    """
+    if REQUESTS_PER_MINUTE is None and TOKENS_PER_MINUTE is None:
+        return None
+    return RateLimiter(REQUESTS_PER_MINUTE and REQUESTS_PER_MINUTE / share,
+                       TOKENS_PER_MINUTE and TOKENS_PER_MINUTE / share)
+
+
+def estimate_tokens(messages, max_tokens=None):
+    """
+    Rough token count of a completion request (about 4 characters a token),
+    used to budget it against the per-minute token limit.
+    """
+    tokens = max_tokens or 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(content) // 4
+        else:
+            for part in content or []:
+                tokens += IMAGE_TOKEN_ESTIMATE if part.get("type") == "image_url" else len(json.dumps(part)) // 4
+    return tokens
+
+
+def _is_retryable(error):
+    # Timeouts, dropped connections, rate limits and 5xx are worth another
+    # try; bad requests and auth errors will fail the same way again
+    import groq
+    import httpx
+    return isinstance(error, (groq.APITimeoutError, groq.APIConnectionError, groq.RateLimitError,
+                              groq.InternalServerError, httpx.TransportError))
+
+
+def _record_usage(model, usage):
+    if usage is not None:
+        metrics.inc("groq_tokens_total", usage.prompt_tokens, model=model, kind="prompt")
+        metrics.inc("groq_tokens_total", usage.completion_tokens, model=model, kind="completion")
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class ResilientClient:
+    """
+    Wraps a groq.Groq client with the same chat.completions.create interface,
+    adding a per-call deadline, retries with jittered exponential backoff and
+    a circuit breaker, and waits for limiter (if any) before each attempt.
+    Raises LLMUnavailableError when it gives up.
+    """
+
+    def __init__(self, client, breaker=None, limiter=None, deadline=DEADLINE_SECONDS,
+                 attempt_timeout=ATTEMPT_TIMEOUT_SECONDS, max_attempts=MAX_ATTEMPTS,
+                 backoff_base=BACKOFF_BASE_SECONDS, backoff_max=BACKOFF_MAX_SECONDS):
+        self.client = client
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = limiter
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.chat = types.SimpleNamespace(completions=self)
+
+    def create(self, deadline=None, **kwargs):
+        """
+        Same arguments as groq's chat.completions.create; deadline overrides
+        the client's per-call budget in seconds.
+        """
+        deadline = time.monotonic() + (deadline or self.deadline)
+        last_error = None
+        tokens = estimate_tokens(kwargs.get("messages", []), kwargs.get("max_tokens")) if self.limiter else 0
+        model = kwargs.get("model", "")
+        for attempt in range(self.max_attempts):
+            if self.limiter is not None:
+                waited = time.perf_counter()
+                acquired = self.limiter.acquire(tokens, timeout=deadline - time.monotonic())
+                metrics.observe("groq_rate_limit_wait_seconds", time.perf_counter() - waited)
+                if not acquired:
+                    metrics.inc("groq_errors_total", model=model, kind="rate_limit_budget")
+                    raise RateLimitBudgetError("Groq rate limit budget exhausted for this call") from last_error
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # Spent waiting in the limiter; a zero timeout would only fail in the client
+                metrics.inc("groq_errors_total", model=model, kind="deadline")
+                raise LLMUnavailableError("LLM call deadline exceeded") from last_error
+            if not self.breaker.allow():
+                metrics.inc("groq_errors_total", model=model, kind="circuit_open")
+                raise CircuitOpenError("LLM circuit breaker is open") from last_error
+            started = time.perf_counter()
+            try:
+                response = self.client.chat.completions.create(
+                    timeout=min(self.attempt_timeout, remaining), **kwargs)
+            except Exception as e:
+                metrics.observe("groq_request_seconds", time.perf_counter() - started, model=model, outcome="error")
+                metrics.inc("groq_errors_total", model=model, kind=type(e).__name__)
+                if not _is_retryable(e):
+                    if getattr(e, "response", None) is not None:
+                        # The service answered, it just rejected this request
+                        self.breaker.record_success()
+                    else:
+                        self.breaker.release()
+                    rejected = _rejected(e)
+                    if rejected is e:
+                        raise
+                    raise rejected from e
+                self.breaker.record_failure()
+                last_error = e
+            except BaseException:
+                self.breaker.release()
+                raise
+            else:
+                metrics.observe("groq_request_seconds", time.perf_counter() - started, model=model, outcome="ok")
+                if kwargs.get("stream"):
+                    # Judged when the stream ends, since it can still fail after it opened
+                    return self._guard_stream(response, deadline, model)
+                self.breaker.record_success()
+                _record_usage(model, getattr(response, "usage", None))
+                return response
+
+            # Full jitter keeps sessions that failed together from retrying together
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+            delay = max(delay, _retry_after(last_error) or 0)
+            if attempt + 1 == self.max_attempts or time.monotonic() + delay >= deadline:
+                break
+            time.sleep(delay)
+        raise LLMUnavailableError(f"LLM call failed: {last_error}") from last_error
+
+    def _guard_stream(self, stream, deadline, model):
+        # A stream can stall or drop after it has started; that cannot be
+        # retried without repeating tokens, so it ends the call instead.
+        # Every way out settles the breaker, so a trial call is never left held
+        settled = False
+        try:
+            for chunk in stream:
+                # Groq reports token usage on the final chunk
+                _record_usage(model, getattr(chunk, "usage", None)
+                              or getattr(getattr(chunk, "x_groq", None), "usage", None))
+                yield chunk
+                if time.monotonic() > deadline:
+                    raise LLMUnavailableError("LLM stream exceeded its deadline")
+            self.breaker.record_success()
+            settled = True
+        except LLMUnavailableError:
+            metrics.inc("groq_errors_total", model=model, kind="stream_deadline")
+            self.breaker.record_failure()
+            settled = True
+            raise
+        except Exception as e:
+            if not _is_retryable(e):
+                rejected = _rejected(e)
+                if rejected is e:
+                    raise
+                raise rejected from e
+            metrics.inc("groq_errors_total", model=model, kind=type(e).__name__)
+            self.breaker.record_failure()
+            settled = True
+            raise LLMUnavailableError(f"LLM stream failed: {e}") from e
+        finally:
+            if not settled:
+                # A non-retryable error, or the caller stopped reading early
+                self.breaker.release()
+            stream.close()
+
+
+def get_groq_client(api_key, limiter=None):
+    """
+    Returns the process-wide resilient Groq client. Its connection pool is
+    kept alive and shared by every session, so calls skip the TCP and TLS
+    handshakes after the first. limiter replaces the default one from
+    make_rate_limiter() when the client is created (e.g. a share of the
+    account's limits for one of several processes).
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import httpx
+                from groq import DefaultHttpxClient, Groq  # Imported on first use; the form does not need it
+                http_client = DefaultHttpxClient(limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS))
+                # Retries are handled by ResilientClient, within its deadline
+                _client = ResilientClient(Groq(api_key=api_key, http_client=http_client, max_retries=0),
+                                          limiter=limiter or make_rate_limiter())
+    return _client
@@ -0,0 +1,84 @@
+import io
+
+
+# The vision model does not need more than this to describe a wound or rash,
+# and anything larger only slows the upload on hospital Wi-Fi.
+MAX_IMAGE_SIDE = 1024
+JPEG_QUALITY = 80
+
+
+class ImageError(ValueError):
+    """
+    The photo could not be read (not an image, truncated or too large).
+    """
+
+
+def _to_rgb(image):
+    from PIL import Image
+
+    # JPEG has no alpha channel, so transparent areas are flattened onto white
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    if image.mode != "RGB":
+        return image.convert("RGB")
+    return image
+
+
+def prepare_image(image, max_side=MAX_IMAGE_SIDE, quality=JPEG_QUALITY):
+    """
+    Turns an uploaded photo (raw bytes or a PIL.Image) into a small upright RGB
+    JPEG ready for the vision call. Returns a dict with the JPEG bytes, the
+    processed image and the size before and after. Raises ImageError if the
+    photo cannot be read.
+    """
+    from PIL import Image, ImageOps  # Deferred so PIL only loads once a photo arrives
+
+    bytes_before = None
+    try:
+        if isinstance(image, (bytes, bytearray)):
+            bytes_before = len(image)
+            image = Image.open(io.BytesIO(image))
+
+        size_before = image.size
+        image = ImageOps.exif_transpose(image)  # Camera photos are often stored sideways
+        image = _to_rgb(image)
+        if max(image.size) > max_side:
+            image = image.copy()
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        buffered = io.BytesIO()
+        image.save(buffered, format="JPEG", quality=quality, optimize=True)
+        jpeg = buffered.getvalue()
+    except (OSError, Image.DecompressionBombError) as e:
+        # UnidentifiedImageError and truncated files are OSErrors
+        raise ImageError(f"Unreadable image: {e}") from e
+
+    return {
+        "jpeg": jpeg,
+        "image": image,
+        "bytes_before": bytes_before,
+        "bytes_after": len(jpeg),
+        "size_before": size_before,
+        "size_after": image.size,
+    }
+
+
+def perceptual_hash(image, hash_size=8):
+    """
+    Returns a 64-bit difference hash (dHash) of a PIL.Image: one bit per
+    pair of neighbouring pixels in a tiny grayscale copy, set when the left
+    one is brighter. Retakes of the same scene differ in only a few bits,
+    so the Hamming distance between hashes measures how alike two photos are.
+    """
+    from PIL import Image
+
+    pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            value = (value << 1) | (left > pixels[row * (hash_size + 1) + col + 1])
+    return value
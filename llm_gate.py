@@ -0,0 +1,106 @@
+import os
+import random
+
+import metrics
+from triage_engine import convert_to_celsius
+from triage_journal import get_journal
+
+
+# Lets confident, low-acuity ML triage skip the LLM call. ML_GATE_MODE is
+# "shadow" (always call it, but record what the gate would have done and
+# whether the LLM agreed), "on" (skip it) or "off". Shadow is the default, so
+# the LLM is only skipped once the measured agreement justifies opting in.
+GATE_MODE = os.environ.get("ML_GATE_MODE", "shadow")
+GATE_CONFIDENCE = float(os.environ.get("ML_GATE_CONFIDENCE", "0.7"))
+GATE_LEVELS = frozenset(int(level) for level in os.environ.get("ML_GATE_LEVELS", "4,5").split(","))
+# Share of bypassed submits whose LLM call still runs in the background, so
+# the gate's agreement with the LLM stays measured while it is on
+AUDIT_RATE = float(os.environ.get("ML_GATE_AUDIT_RATE", "0.1"))
+
+# Every one of these vitals must be given and inside its band (body
+# temperature in Celsius) for the gate to fire
+SAFE_VITALS = {
+    "heart_rate": (50, 110),
+    "bp_systolic": (90, 180),
+    "bp_diastolic": (50, 110),
+    "respiratory_rate": (10, 24),
+    "body_temperature": (35.5, 38.0),
+}
+MIN_OXYGEN_SATURATION = 94  # Checked only when given
+MAX_PAIN_LEVEL = 6
+# Complaints the model cannot read from its features; any of these in the
+# description sends the patient to the LLM
+RED_FLAG_TERMS = (
+    "chest", "breath", "stroke", "seizure", "faint", "syncope", "unconscious", "collapse", "bleed", "blood",
+    "overdose", "poison", "suicid", "pregnan", "allerg", "anaphyla", "swelling", "numb", "weak", "confus",
+    "head", "neck", "burn", "abdominal", "vomit", "fever", "child", "infant",
+)
+
+CONFIDENCE_BUCKETS = (0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99)
+
+
+def evaluate(patient, has_image, level, confidence):
+    """
+    Decides whether a (defaulted) patient's ML level is safe to use without
+    the LLM. Returns (bypass, reason), where reason names the first check
+    that failed, or "safe". confidence is None when the model has no
+    calibrated soft vote; such a model never bypasses ("no_confidence").
+    """
+    if confidence is None:
+        return False, "no_confidence"
+    if has_image:
+        return False, "image"
+    if level not in GATE_LEVELS:
+        return False, "acuity"
+    if confidence < GATE_CONFIDENCE:
+        return False, "confidence"
+    if patient["consciousness"] != "Alert":
+        return False, "consciousness"
+    for field, (low, high) in SAFE_VITALS.items():
+        value = patient[field]
+        if field == "body_temperature" and value:
+            value = convert_to_celsius(value, patient["temp_unit"])
+        if not value or not low <= value <= high:
+            return False, "vitals"
+    if patient["oxygen_saturation"] and patient["oxygen_saturation"] < MIN_OXYGEN_SATURATION:
+        return False, "vitals"
+    if patient["pain_level"] and patient["pain_level"] > MAX_PAIN_LEVEL:
+        return False, "pain"
+    description = (patient["description"] or "").lower()
+    if any(term in description for term in RED_FLAG_TERMS):
+        return False, "red_flag"
+    return True, "safe"
+
+
+def decide(patient, has_image, level, confidence, mode=None):
+    """
+    Runs evaluate() under the configured mode and counts the outcome.
+    Returns {"bypass": skip the LLM now, "would_bypass": evaluate's answer,
+    "reason": ..., "audit": still call the LLM in the background}.
+    """
+    mode = GATE_MODE if mode is None else mode
+    would_bypass, reason = evaluate(patient, has_image, level, confidence)
+    bypass = would_bypass and mode == "on"
+    if confidence is not None:
+        metrics.observe("triage_ml_confidence", confidence, CONFIDENCE_BUCKETS)
+    metrics.inc("triage_gate_total", mode=mode, decision="bypass" if would_bypass else "llm", reason=reason)
+    return {"bypass": bypass, "would_bypass": would_bypass, "reason": reason,
+            "audit": bypass and random.random() < AUDIT_RATE}
+
+
+def record_agreement(ml_level, llm_level, source, **fields):
+    """
+    Counts how the ML level of a gated patient compares with the LLM's
+    ("same", "ml_less_urgent" i.e. possible under-triage, "ml_more_urgent")
+    and journals it with fields.
+    """
+    if llm_level is None:
+        agreement = "no_llm_answer"
+    elif int(ml_level) == int(llm_level):
+        agreement = "same"
+    else:
+        agreement = "ml_less_urgent" if int(ml_level) > int(llm_level) else "ml_more_urgent"
+    metrics.inc("triage_gate_agreement_total", source=source, agreement=agreement)
+    get_journal().append("gate_audit", source=source, agreement=agreement, ml_triage_level=ml_level,
+                         groq_triage_level=llm_level, **fields)
+    return agreement
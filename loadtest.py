@@ -0,0 +1,368 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from fake_groq_server import start_fake_groq_server
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+USERNAME = "doctor1"
+PASSWORD = "password1"
+STEPS = ["load", "login", "submit", "time_to_level", "resolve"]
+LEVEL_MARKER = "Recommended Triage Level"
+
+VITALS = {
+    "Systolic BP (mmHg)": 135, "Diastolic BP (mmHg)": 85, "Heart Rate (bpm)": 90,
+    "Oxygen Saturation (%)": 97, "Respiratory Rate (bpm)": 18,
+}
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _proc_usage(pid):
+    # (cpu seconds, rss KB) of a process, read from /proc (Linux only)
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/statm") as f:
+            rss_pages = int(f.read().split()[1])
+    except OSError:
+        return None, None
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return cpu, rss_pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def connect_session(url):
+    from websockets.sync.client import connect
+    return connect(url, subprotocols=["streamlit"], max_size=None, open_timeout=30)
+
+
+class StreamlitSession:
+    """
+    Headless Streamlit client: speaks the same websocket protocol as the
+    browser, so every session is a real session on the server. It keeps the
+    widgets rendered by the last run and sends their values back on each rerun.
+    """
+
+    def __init__(self, websocket, script_timeout=120):
+        self.script_timeout = script_timeout
+        self.widgets = {}  # label -> (element proto, fragment id) of the last run
+        self.values = {}   # widget id -> WidgetState to send with every rerun
+        self.exceptions = []
+        self.level_seconds = None  # When the last run first showed a triage level
+        self._ws = websocket
+
+    def _rerun(self, trigger=None, fragment_id=""):
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        msg = BackMsg()
+        msg.rerun_script.query_string = ""
+        # A widget inside a fragment reruns just that fragment, as in the browser
+        msg.rerun_script.fragment_id = fragment_id
+        msg.rerun_script.widget_states.widgets.extend(self.values.values())
+        if trigger is not None:
+            state = msg.rerun_script.widget_states.widgets.add()
+            state.id = trigger
+            state.trigger_value = True
+        self._ws.send(msg.SerializeToString())
+
+        self.exceptions = []
+        self.level_seconds = None
+        start = time.monotonic()
+        deadline = start + self.script_timeout
+        while True:
+            forward = ForwardMsg()
+            forward.ParseFromString(self._ws.recv(timeout=max(0.0, deadline - time.monotonic())))
+            kind = forward.WhichOneof("type")
+            if kind == "new_session" and not forward.new_session.fragment_ids_this_run:
+                self.widgets = {}  # A full run redraws every widget
+            elif kind == "new_session":
+                fragments = set(forward.new_session.fragment_ids_this_run)
+                self.widgets = {label: (widget, fragment_id) for label, (widget, fragment_id)
+                                in self.widgets.items() if fragment_id not in fragments}
+            elif kind == "script_finished":
+                # st.rerun() ends the run early and the server starts the next one
+                if forward.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    return
+            elif kind == "delta" and forward.delta.WhichOneof("type") == "new_element":
+                element = forward.delta.new_element
+                widget = getattr(element, element.WhichOneof("type"))
+                if element.WhichOneof("type") == "exception":
+                    self.exceptions.append(widget.message)
+                elif element.WhichOneof("type") == "markdown" and self.level_seconds is None \
+                        and LEVEL_MARKER in widget.body:
+                    self.level_seconds = time.monotonic() - start
+                elif element.WhichOneof("type") == "component_instance" and widget.id not in self.values:
+                    # A fresh browser's cookie component reports an empty cookie jar
+                    self.values[widget.id] = WidgetState(id=widget.id, json_value="{}")
+                elif getattr(widget, "id", "") and getattr(widget, "label", ""):
+                    self.widgets[widget.label] = (widget, forward.delta.fragment_id)
+
+    def load(self):
+        self._rerun()
+
+    def click(self, label):
+        widget, fragment_id = self._widget(label)
+        self._rerun(trigger=widget.id, fragment_id=fragment_id)
+
+    def _widget(self, label):
+        if label not in self.widgets:
+            raise LookupError(f"No widget labelled {label!r}")
+        return self.widgets[label]
+
+    def set_value(self, label, value):
+        from streamlit.proto.NumberInput_pb2 import NumberInput
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        widget = self._widget(label)[0]
+        state = WidgetState(id=widget.id)
+        if isinstance(value, str):
+            state.string_value = value
+        elif isinstance(widget, NumberInput) and widget.data_type == NumberInput.INT:
+            state.int_value = int(value)
+        else:
+            state.double_value = float(value)
+        self.values[widget.id] = state
+
+
+def run_session(url, session_id, script_timeout=120):
+    """
+    Drives one session through login -> fill form -> submit -> resolve and
+    returns per-step latencies in seconds, or the error.
+    """
+    timings = {}
+
+    def step(name, action):
+        start = time.perf_counter()
+        action()
+        timings[name] = time.perf_counter() - start
+        if session.exceptions:
+            raise RuntimeError(f"{name}: {session.exceptions[0]}")
+
+    try:
+        with connect_session(url) as websocket:
+            session = StreamlitSession(websocket, script_timeout)
+            step("load", session.load)
+            session.set_value("Username", USERNAME)
+            session.set_value("Password", PASSWORD)
+            step("login", lambda: session.click("Login"))
+
+            session.set_value("Age", 30 + session_id % 60)
+            for label, value in VITALS.items():
+                session.set_value(label, value)
+            # A distinct description per session keeps the LLM cache out of the numbers
+            session.set_value("Patient Description", f"Load test patient {session_id}: twisted ankle, mild swelling")
+            step("submit", lambda: session.click("Submit"))
+            if session.level_seconds is not None:
+                timings["time_to_level"] = session.level_seconds
+            step("resolve", lambda: session.click("Resolve Triage 1"))
+    except Exception as e:
+        return {"ok": False, "error": f"{type(e).__name__}: {e}", "timings": timings}
+    return {"ok": True, "timings": timings}
+
+
+def _stage_summary(exposition):
+    # Per-stage count, mean and bucketed p99 from the app's
+    # triage_stage_seconds histogram in Prometheus text format
+    stages = {}
+    for line in exposition.splitlines():
+        if not line.startswith("triage_stage_seconds"):
+            continue
+        series, value = line.rsplit(" ", 1)
+        labels = dict(part.split("=", 1) for part in series[series.index("{") + 1:-1].split(","))
+        stage = stages.setdefault(labels["stage"].strip('"'), {"buckets": []})
+        if series.startswith("triage_stage_seconds_bucket"):
+            stage["buckets"].append((float(labels["le"].strip('"')), float(value)))
+        else:
+            stage[series.split("{")[0].rsplit("_", 1)[1]] = float(value)
+    summary = {}
+    for name, stage in stages.items():
+        count = stage.get("count", 0)
+        if not count:
+            continue
+        p99 = next(bound for bound, cumulative in stage["buckets"] if cumulative >= 0.99 * count)
+        summary[name] = {"count": int(count), "mean_ms": stage["sum"] / count * 1000, "p99_le_ms": p99 * 1000}
+    return summary
+
+
+def start_app_server(port, groq_base_url, workdir, startup_timeout=60, metrics_port=0):
+    """
+    Starts `streamlit run web.py` on port, talking to groq_base_url with a
+    throwaway API key, LLM cache and triage queue, and waits until it accepts
+    sessions. With metrics_port, the app serves its /metrics there.
+    """
+    import urllib.request
+
+    secrets_path = os.path.join(workdir, "secrets.toml")
+    with open(secrets_path, "w") as f:
+        f.write('API_KEY = "load-test-key"\n')
+    env = dict(os.environ, GROQ_BASE_URL=groq_base_url,
+               LLM_CACHE_PATH=os.path.join(workdir, "loadtest_cache.sqlite3"),
+               VISION_CACHE_PATH=os.path.join(workdir, "loadtest_vision_cache.sqlite3"),
+               TRIAGE_JOURNAL_DIR=os.path.join(workdir, "journal"),
+               TRIAGE_DB_URL="sqlite:///" + os.path.join(workdir, "loadtest_queue.sqlite3"),
+               # The fake server has no account limits; the client-side limiter should not add its own
+               GROQ_REQUESTS_PER_MINUTE="1000000", GROQ_TOKENS_PER_MINUTE="1000000000",
+               METRICS_PORT=str(metrics_port))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "streamlit", "run", "web.py", "--server.headless", "true",
+         "--server.port", str(port), "--server.address", "127.0.0.1", "--secrets.files", secrets_path,
+         "--browser.gatherUsageStats", "false", "--server.fileWatcherType", "none"],
+        cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=open(os.path.join(workdir, "server.log"), "w"))
+
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Streamlit exited with {process.returncode}, see {workdir}/server.log")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"Streamlit did not start within {startup_timeout}s")
+
+
+def run_load_test(sessions=20, concurrency=5, latency=0.5, jitter=0.2, rate_limit_rate=0.0,
+                  timeout_rate=0.0, hang_seconds=30.0, token_interval=0.02, script_timeout=120):
+    """
+    Starts a fake Groq server and the app, runs sessions sessions,
+    concurrency at a time, and returns the aggregated report.
+    """
+    groq = start_fake_groq_server(latency=latency, jitter=jitter, rate_limit_rate=rate_limit_rate,
+                                  timeout_rate=timeout_rate, hang_seconds=hang_seconds,
+                                  token_interval=token_interval)
+    workdir = tempfile.mkdtemp(prefix="triage-loadtest-")
+    port = _free_port()
+    url = f"ws://127.0.0.1:{port}/_stcore/stream"
+    metrics_port = _free_port()
+    app = start_app_server(port, groq.base_url, workdir, metrics_port=metrics_port)
+    try:
+        # One throwaway session so the numbers do not include the model warm-up
+        with connect_session(url) as websocket:
+            StreamlitSession(websocket, script_timeout).load()
+        time.sleep(1.0)
+
+        cpu_before, rss_before = _proc_usage(app.pid)
+        peak_rss = [rss_before or 0]
+        done = threading.Event()
+
+        def sample_memory():
+            while not done.wait(0.2):
+                rss = _proc_usage(app.pid)[1]
+                peak_rss[0] = max(peak_rss[0], rss or 0)
+
+        sampler = threading.Thread(target=sample_memory, daemon=True)
+        sampler.start()
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(lambda i: run_session(url, i, script_timeout), range(sessions)))
+        wall = time.perf_counter() - wall_start
+        done.set()
+        sampler.join()
+        cpu_after, rss_after = _proc_usage(app.pid)
+        import urllib.request
+        with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=5) as response:
+            server_stages = _stage_summary(response.read().decode("utf-8"))
+    finally:
+        app.terminate()
+        app.wait()
+        groq.shutdown()
+
+    ok = [r for r in results if r["ok"]]
+    steps = {}
+    for name in STEPS:
+        values = np.array([r["timings"][name] for r in ok if name in r["timings"]]) * 1000
+        if len(values):
+            steps[name] = {"p50_ms": float(np.percentile(values, 50)), "p95_ms": float(np.percentile(values, 95)),
+                           "p99_ms": float(np.percentile(values, 99)), "max_ms": float(values.max())}
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+
+    server = {}
+    if cpu_before is not None and cpu_after is not None:
+        peak = max(peak_rss[0], rss_after)
+        server = {"cpu_seconds_per_session": (cpu_after - cpu_before) / sessions,
+                  "rss_growth_kb_per_session": (peak - rss_before) / sessions,
+                  "rss_before_kb": rss_before, "peak_rss_kb": peak}
+
+    return {
+        "sessions": sessions,
+        "concurrency": concurrency,
+        "succeeded": len(ok),
+        "failed": sessions - len(ok),
+        "wall_seconds": wall,
+        "sessions_per_sec": len(ok) / wall,
+        "steps": steps,
+        "server": server,
+        "server_stages": server_stages,
+        "errors": errors,
+        "fake_groq": dict(groq.stats),
+        "fake_groq_settings": {"latency": latency, "jitter": jitter, "rate_limit_rate": rate_limit_rate,
+                               "timeout_rate": timeout_rate, "hang_seconds": hang_seconds,
+                               "token_interval": token_interval},
+        "server_log": os.path.join(workdir, "server.log"),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent-session load test of web.py against a fake Groq.")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.5, help="fake Groq mean latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of Groq calls answered 429")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="fraction of Groq calls that hang")
+    parser.add_argument("--hang-seconds", type=float, default=30.0)
+    parser.add_argument("--token-interval", type=float, default=0.02, help="seconds between streamed tokens")
+    parser.add_argument("--script-timeout", type=float, default=120.0, help="max seconds per script run")
+    parser.add_argument("--output", default=None, help="also write the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = run_load_test(args.sessions, args.concurrency, args.latency, args.jitter, args.rate_limit_rate,
+                           args.timeout_rate, args.hang_seconds, args.token_interval, args.script_timeout)
+
+    print(f"{report['succeeded']}/{report['sessions']} sessions succeeded at concurrency "
+          f"{report['concurrency']} in {report['wall_seconds']:.1f}s ({report['sessions_per_sec']:.2f} sessions/sec)")
+    print(f"{'step':<14} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'max ms':>10}")
+    for name, stats in report["steps"].items():
+        print(f"{name:<14} {stats['p50_ms']:10.1f} {stats['p95_ms']:10.1f} {stats['p99_ms']:10.1f} "
+              f"{stats['max_ms']:10.1f}")
+    if report["server"]:
+        server = report["server"]
+        print(f"Server CPU per session: {server['cpu_seconds_per_session'] * 1000:.1f} ms, "
+              f"memory growth per session: {server['rss_growth_kb_per_session']:.0f} KB, "
+              f"peak RSS: {server['peak_rss_kb'] / 1024:.0f} MB")
+    if report["server_stages"]:
+        # Measured inside the app; p99 is the upper bound of its histogram bucket
+        print(f"\n{'server stage':<18} {'count':>7} {'mean ms':>10} {'p99 <= ms':>10}")
+        for name, stats in sorted(report["server_stages"].items(), key=lambda item: -item[1]["mean_ms"]):
+            print(f"{name:<18} {stats['count']:7d} {stats['mean_ms']:10.1f} {stats['p99_le_ms']:10.1f}")
+    print(f"Fake Groq: {report['fake_groq']}")
+    for error, count in report["errors"].items():
+        print(f"  {count} x {error}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Off unless configured: METRICS_PORT serves /metrics on localhost for
+# Prometheus to scrape, METRICS_FILE is rewritten every FLUSH_SECONDS
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_FILE = os.environ.get("METRICS_FILE")
+FLUSH_SECONDS = 15.0
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 60.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+HELP = {
+    "triage_stage_seconds": ("histogram", "Time spent in each stage of a triage submit."),
+    "triage_stage_errors_total": ("counter", "Stages that ended with an exception."),
+    "triage_payload_bytes": ("histogram", "Size of images and prompts sent to Groq."),
+    "triage_cache_requests_total": ("counter", "LLM and vision cache lookups by result."),
+    "triage_fallbacks_total": ("counter", "Triage results that fell back to the ML model alone."),
+    "groq_request_seconds": ("histogram", "Duration of each HTTP attempt to Groq."),
+    "groq_errors_total": ("counter", "Failed Groq attempts and rejected calls, by kind."),
+    "groq_rate_limit_wait_seconds": ("histogram", "Time calls waited in the client-side rate limiter."),
+    "groq_tokens_total": ("counter", "Tokens used by Groq completions."),
+    "model_reloads_total": ("counter", "Model versions hot-loaded or rejected by validation."),
+    "triage_ml_confidence": ("histogram", "Calibrated soft-vote probability of the ML level."),
+    "triage_gate_total": ("counter", "LLM bypass gate decisions, by the check that decided them."),
+    "triage_gate_agreement_total": ("counter", "ML levels of gated patients compared with the LLM's."),
+    "triage_http_requests_total": ("counter", "Scoring service requests by endpoint and status."),
+    "triage_http_request_seconds": ("histogram", "Scoring service request duration, body parsing included."),
+}
+
+_counters = {}
+_histograms = {}
+_lock = threading.Lock()
+_exporter_started = False
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    """
+    Adds amount to the counter name with the given labels.
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """
+    Records value in the histogram name with the given labels. buckets are
+    the upper bounds; the first observation of a series fixes them.
+    """
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": tuple(buckets), "counts": [0] * (len(buckets) + 1),
+                                            "sum": 0.0, "count": 0}
+        histogram["counts"][bisect.bisect_left(histogram["buckets"], value)] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+@contextmanager
+def span(stage, timings=None):
+    """
+    Times the wrapped block as one stage in triage_stage_seconds, and counts
+    it in triage_stage_errors_total if it raises. The seconds are also stored
+    in timings[stage] when a dict is given, for per-request records.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        inc("triage_stage_errors_total", stage=stage, error=type(e).__name__)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        observe("triage_stage_seconds", elapsed, stage=stage)
+        if timings is not None:
+            timings[stage] = elapsed
+
+
+def _labels(pairs, extra=()):
+    pairs = tuple(pairs) + tuple(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: dict(value, counts=list(value["counts"])) for key, value in _histograms.items()}
+
+    lines = []
+    described = set()
+
+    def describe(name, kind):
+        if name not in described:
+            described.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, (kind, name))[1]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        describe(name, "counter")
+        lines.append(f"{name}{_labels(labels)} {value}")
+    for (name, labels), histogram in sorted(histograms.items()):
+        describe(name, "histogram")
+        cumulative = 0
+        for bound, count in zip(histogram["buckets"] + (float("inf"),), histogram["counts"]):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            lines.append(f"{name}_bucket{_labels(labels, [('le', le)])} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {histogram['sum']}")
+        lines.append(f"{name}_count{_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _serve(port):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes every few seconds would flood the app's log
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def _flush_forever(path, interval):
+    while True:
+        time.sleep(interval)
+        # Written to a temporary file and renamed, so readers never see half a file
+        with open(path + ".tmp", "w") as f:
+            f.write(render())
+        os.replace(path + ".tmp", path)
+
+
+def start_exporter(port=METRICS_PORT, path=METRICS_FILE, interval=FLUSH_SECONDS):
+    """
+    Starts the /metrics endpoint and/or the periodic file flush, whichever
+    is configured, once per process.
+    """
+    global _exporter_started
+    with _lock:
+        if _exporter_started:
+            return
+        _exporter_started = True
+    if port:
+        _serve(port)
+    if path:
+        threading.Thread(target=_flush_forever, args=(path, interval), name="metrics-flush", daemon=True).start()
@@ -1,71 +1,318 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
-from sklearn.model_selection import train_test_split
+from sklearn.base import clone
+from sklearn.model_selection import StratifiedKFold, train_test_split
 from sklearn.ensemble import RandomForestClassifier, VotingClassifier
 from sklearn.svm import LinearSVC
 from sklearn.neighbors import KNeighborsClassifier
-from sklearn.preprocessing import StandardScaler
+from sklearn.preprocessing import LabelEncoder, StandardScaler
 from sklearn.metrics import accuracy_score
+from sklearn.utils import Bunch
 import joblib
+import data_prep
+import model_registry
+from fast_model import FastVotingModel, calibrate_soft_vote, export_voting_model, voting_model_arrays
+
+
+CACHE_DIR = ".train_cache"
+# Share of the held-out rows that calibrates the soft vote; accuracy is
+# reported on the rest, which calibration never sees
+CALIBRATION_FRACTION = 0.5
+
+# Base estimators of the ensemble and the hyperparameters searched for each.
+# The first value of every list is the configuration used without --search.
+BASE_ESTIMATORS = {
+    "rf": (RandomForestClassifier, {"random_state": [42], "n_estimators": [100, 200],
+                                    "max_depth": [None, 10, 20], "min_samples_leaf": [1, 3]}),
+    "svc": (LinearSVC, {"random_state": [42], "max_iter": [10000], "C": [1.0, 0.1, 10.0]}),
+    "knn": (KNeighborsClassifier, {"n_neighbors": [5, 3, 7, 9, 15]}),
+}
+MODEL_NAMES = {"rf": "RandomForest", "svc": "LinearSVC", "knn": "KNN"}
+
+# Training data shared with worker processes (set once per worker by _init_worker)
+_X = None
+_y = None
+
+
+def param_grid(name, search):
+    estimator_class, grid = BASE_ESTIMATORS[name]
+    if not search:
+        return [{key: values[0] for key, values in grid.items()}]
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def _cache_path(cache_dir, fingerprint, *parts):
+    key = hashlib.sha256(json.dumps([fingerprint, *parts], sort_keys=True).encode()).hexdigest()
+    return os.path.join(cache_dir, key[:2], key + ".joblib")
+
+
+def _cached(path, compute):
+    # Results are written to a temporary file first, so an interrupted run
+    # never leaves a truncated entry behind
+    if path is not None and os.path.exists(path):
+        return joblib.load(path)
+    result = compute()
+    if path is not None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        joblib.dump(result, path + ".tmp", compress=3)
+        os.replace(path + ".tmp", path)
+    return result
+
+
+def _init_worker(X, y):
+    global _X, _y
+    # A memory-mapped training matrix arrives as its path and is mapped
+    # again, so the workers share it instead of each unpickling a copy
+    _X = np.load(X, mmap_mode="r") if isinstance(X, str) else X
+    _y = y
+
+
+def _fit_fold(name, params, train_idx, test_idx, cache_path):
+    # Only the fold's accuracy is cached; its fitted model is never reused
+    def compute():
+        model = BASE_ESTIMATORS[name][0](**params).fit(_X[train_idx], _y[train_idx])
+        return float(accuracy_score(_y[test_idx], model.predict(_X[test_idx])))
+    return _cached(cache_path, compute)
+
 
+def _fit_final(name, params, cache_path):
+    return _cached(cache_path, lambda: BASE_ESTIMATORS[name][0](**params).fit(_X, _y))
 
-# Load dataset
-file_path = "data.csv"
-df = pd.read_csv(file_path)
 
-# Convert numeric columns to appropriate types
-numeric_cols = ["SBP", "DBP", "HR", "RR", "BT"]
-df[numeric_cols] = df[numeric_cols].apply(pd.to_numeric, errors="coerce")
+def search_and_fit(X_train, y_train, search=False, folds=5, workers=None, cache_dir=CACHE_DIR):
+    """
+    Cross-validates every candidate configuration of each base estimator on a
+    process pool, then fits the best configuration of each on the full
+    training set, also in parallel. Fold accuracies and final fits are
+    cached under cache_dir keyed on the data and parameters, so a rerun
+    after an interruption only computes what is missing. Returns {name: fitted model}.
+    """
+    # Hashed in memory order, without a contiguous copy of the matrix
+    fingerprint = hashlib.sha256(X_train.T if X_train.flags.f_contiguous else np.ascontiguousarray(X_train))
+    fingerprint.update(np.ascontiguousarray(y_train))
+    fingerprint = fingerprint.hexdigest()
+    use_cache = cache_dir is not None
 
-# Drop rows with missing values
-df = df.dropna()
+    shared_X = X_train.filename if isinstance(X_train, np.memmap) else X_train
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(shared_X, np.asarray(y_train))) as executor:
+        best_params = {}
+        candidates = {name: param_grid(name, search) for name in BASE_ESTIMATORS}
+        if any(len(grid) > 1 for grid in candidates.values()):
+            splits = list(StratifiedKFold(n_splits=folds, shuffle=True, random_state=42).split(X_train, y_train))
+            futures = {}
+            for name, grid in candidates.items():
+                for i, params in enumerate(grid):
+                    for fold, (train_idx, test_idx) in enumerate(splits):
+                        path = (_cache_path(cache_dir, fingerprint, name, params, folds, fold, "accuracy")
+                                if use_cache else None)
+                        futures[name, i, fold] = executor.submit(_fit_fold, name, params, train_idx, test_idx, path)
 
-# Split features and target
-X = df.drop(columns=['KTAS_expert'])
-y = df['KTAS_expert']
+            for name, grid in candidates.items():
+                scores = [np.mean([futures[name, i, fold].result() for fold in range(folds)])
+                          for i in range(len(grid))]
+                best = int(np.argmax(scores))
+                best_params[name] = grid[best]
+                print(f"{MODEL_NAMES[name]} best CV accuracy {scores[best]:.4f} "
+                      f"({len(grid)} configurations): {grid[best]}")
+        else:
+            best_params = {name: grid[0] for name, grid in candidates.items()}
 
-# Reduce labels by 1 (adjust if needed)
-y = y - 1
+        # Final fits of the three base estimators run side by side
+        final = {
+            name: executor.submit(_fit_final, name, params,
+                                  _cache_path(cache_dir, fingerprint, name, params, "final") if use_cache else None)
+            for name, params in best_params.items()
+        }
+        return {name: future.result() for name, future in final.items()}
 
-# Split dataset
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
 
-# Scale features (recommended for SVM, KNN, and XGBoost)
-scaler = StandardScaler()
-X_train_scaled = scaler.fit_transform(X_train)
-X_test_scaled = scaler.transform(X_test)
+def build_voting_model(models, y_train):
+    """
+    Assembles a hard-voting ensemble from already fitted base estimators,
+    instead of letting VotingClassifier.fit refit clones of them.
+    """
+    voting_model = VotingClassifier(estimators=[(name, clone(model)) for name, model in models.items()],
+                                    voting='hard')
+    voting_model.le_ = LabelEncoder().fit(y_train)
+    voting_model.classes_ = voting_model.le_.classes_
+    voting_model.estimators_ = list(models.values())
+    voting_model.named_estimators_ = Bunch(**models)
+    return voting_model
+
 
 # Function to evaluate models
-def evaluate_model(model, X_train, X_test, y_train, y_test, model_name):
-    model.fit(X_train, y_train)
+def evaluate_model(model, X_test, y_test, model_name):
     y_pred = model.predict(X_test)
     exact_acc = accuracy_score(y_test, y_pred)
 
-    print(f"{model_name} Accuracy (Exact Match): {exact_acc:.4f}")
+    print(f"{model_name} Accuracy (Exact Match): {exact_acc:.4f} on {len(y_test)} rows")
+
+    return y_pred
+
+
+def train_from_dataset(dataset, extra=None, max_rows=None, search=False, folds=5, workers=None,
+                       cache_dir=CACHE_DIR):
+    """
+    Splits a data_prep.ColumnarDataset into training and held-out rows,
+    fits the scaler and the ensemble, and leaves the held-out rows to
+    fit_ensemble for calibration and testing. extra is an optional (X, y)
+    appended after the dataset's rows (e.g. confirmed outcomes). The rows
+    are streamed out of the dataset, and the scaled training matrix is
+    written block by block to a memory-mapped file that the worker
+    processes share, so apart from the fitted models memory stays bounded
+    by the training matrix itself; max_rows caps that. The held-out
+    dataset rows are recorded on the model as holdout_rows_.
+    Returns (voting_model, scaler).
+    """
+    extra_X, extra_y = (np.empty((0, len(dataset.feature_names))), np.empty(0, dtype=np.int64)) \
+        if extra is None else (np.asarray(extra[0], dtype=np.float64), np.asarray(extra[1], dtype=np.int64))
+    train_idx, test_idx = train_test_split(np.arange(dataset.n_rows + len(extra_X)), test_size=0.2, random_state=42)
+    if max_rows is not None:
+        # The split is already shuffled, so its first rows are a random sample
+        train_idx, test_idx = train_idx[:max_rows], test_idx[:max(2, max_rows // 4)]
+
+    def gather(rows, X, y):
+        for start in range(0, len(rows), data_prep.CHUNK_ROWS):
+            block = rows[start:start + data_prep.CHUNK_ROWS]
+            in_dataset = block < dataset.n_rows
+            X[start:start + len(block)][in_dataset] = dataset.take(block[in_dataset])
+            X[start:start + len(block)][~in_dataset] = extra_X[block[~in_dataset] - dataset.n_rows]
+            y[start:start + len(block)][in_dataset] = dataset.labels(block[in_dataset])
+            y[start:start + len(block)][~in_dataset] = extra_y[block[~in_dataset] - dataset.n_rows]
+
+    os.makedirs(data_prep.CACHE_DIR, exist_ok=True)
+    matrix_path = os.path.join(data_prep.CACHE_DIR, f"train-{os.getpid()}.npy")
+    try:
+        # Column-major, like the array scikit-learn makes of a DataFrame, so
+        # the scaler's sums run in the same order as on the original DataFrame
+        X_train = np.lib.format.open_memmap(matrix_path, mode="w+", fortran_order=True,
+                                            shape=(len(train_idx), len(dataset.feature_names)))
+        y_train = np.empty(len(train_idx), dtype=np.int64)
+        gather(train_idx, X_train, y_train)
+        X_test = np.empty((len(test_idx), len(dataset.feature_names)), order="F")
+        y_test = np.empty(len(test_idx), dtype=np.int64)
+        gather(test_idx, X_test, y_test)
+
+        # Fitted and applied in place, rather than fit_transform's copy
+        scaler = StandardScaler().fit(X_train)
+        scaler.transform(X_train, copy=False)
+        scaler.transform(X_test, copy=False)
+        X_train.flush()
+        # As if fitted on a DataFrame, as the app's scaler always was
+        scaler.feature_names_in_ = np.asarray(dataset.feature_names, dtype=object)
+        voting_model, scaler = fit_ensemble(X_train, X_test, y_train, y_test, scaler,
+                                            pd.Index(dataset.feature_names), search=search, folds=folds,
+                                            workers=workers, cache_dir=cache_dir)
+    finally:
+        os.remove(matrix_path)
+    # The held-out dataset rows, so online learning can test its updates on
+    # exactly these (see online_learning.load_holdout)
+    voting_model.holdout_rows_ = test_idx[test_idx < dataset.n_rows]
+    voting_model.holdout_source_ = dataset.meta["source_sha256"]
+    return voting_model, scaler
+
+
+def fit_ensemble(X_train_scaled, X_holdout_scaled, y_train, y_holdout, scaler, feature_names, search=False, folds=5,
+                 workers=None, cache_dir=CACHE_DIR):
+    """
+    Fits the ensemble on already scaled features. The held-out rows are
+    split in two: the soft vote is calibrated on one part, and each model's
+    accuracy is printed for the other.
+    Returns (voting_model, scaler).
+    """
+    calibration_idx, test_idx = train_test_split(np.arange(len(y_holdout)), train_size=CALIBRATION_FRACTION,
+                                                 random_state=42)
+    X_test_scaled, y_test = X_holdout_scaled[test_idx], y_holdout[test_idx]
+    print(f"Held-out rows: {len(y_holdout)}, of which {len(calibration_idx)} calibrate the soft vote "
+          f"and {len(test_idx)} test accuracy")
+
+    # Train the base models once, in parallel, and reuse them in the ensemble
+    models = search_and_fit(X_train_scaled, y_train, search=search, folds=folds,
+                            workers=workers, cache_dir=cache_dir)
+    for name, model in models.items():
+        evaluate_model(model, X_test_scaled, y_test, MODEL_NAMES[name])
+
+    voting_model = build_voting_model(models, y_train)
+    evaluate_model(voting_model, X_test_scaled, y_test, "Voting Classifier")
+
+    # Soft-vote confidences for the LLM bypass gate, calibrated on rows kept
+    # out of both training and the accuracy test
+    fast_model = FastVotingModel(*voting_model_arrays(voting_model, scaler, feature_names))
+    voting_model.calibration_ = calibrate_soft_vote(fast_model, X_holdout_scaled[calibration_idx],
+                                                    y_holdout[calibration_idx])
+    print(f"Soft-vote calibration: SVC temperature {voting_model.calibration_['svc_temperature']:.3f}, "
+          f"temperature {voting_model.calibration_['temperature']:.3f}, "
+          f"log loss {voting_model.calibration_['log_loss']:.4f}")
+    return voting_model, scaler
+
+
+def load_confirmed_outcomes(columns, url=None):
+    """
+    Returns clinician-confirmed outcomes from the triage queue database as
+    (X, y) with the given feature columns and labels shifted to 0-4,
+    leaving out those with a vital missing.
+    """
+    from online_learning import complete_outcomes
+    from triage_queue import DATABASE_URL, TriageQueue
+
+    outcomes = complete_outcomes(TriageQueue(url or DATABASE_URL).confirmed_outcomes())
+    X = pd.DataFrame([[outcome["features"].get(str(column), 0.0) for column in columns] for outcome in outcomes],
+                     columns=columns)
+    y = pd.Series([outcome["confirmed_level"] - 1 for outcome in outcomes], name="KTAS_expert")
+    return X, y
+
 
-    return model, y_pred
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train the triage voting ensemble.")
+    parser.add_argument("--data", default="data.csv")
+    parser.add_argument("--search", action="store_true", help="cross-validated hyperparameter search")
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="where fold results and fits are cached")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--max-rows", type=int, default=None,
+                        help="train on at most this many (randomly chosen) rows, to bound memory")
+    parser.add_argument("--confirmed", action="store_true",
+                        help="also train on clinician-confirmed levels from the triage queue database")
+    parser.add_argument("--publish", action="store_true",
+                        help="also publish the model to the registry, where running apps pick it up")
+    parser.add_argument("--notes", default=None, help="notes stored with the published version")
+    args = parser.parse_args(argv)
 
-# Train and evaluate models
-rf_model, y_pred_rf = evaluate_model(RandomForestClassifier(random_state=42),
-                                     X_train, X_test, y_train, y_test, "RandomForest")
+    start = time.perf_counter()
+    dataset = data_prep.prepare(args.data)
+    feature_names = pd.Index(dataset.feature_names)
+    extra = None
+    if args.confirmed:
+        extra = load_confirmed_outcomes(feature_names)
+        print(f"Adding {len(extra[0])} confirmed outcomes to {dataset.n_rows} rows")
 
-svc_model, y_pred_svc = evaluate_model(LinearSVC(random_state=42, max_iter=10000),
-                                       X_train_scaled, X_test_scaled, y_train, y_test, "LinearSVC")
+    voting_model, scaler = train_from_dataset(dataset, extra, max_rows=args.max_rows, search=args.search,
+                                              folds=args.folds, workers=args.workers,
+                                              cache_dir=None if args.no_cache else args.cache_dir)
 
-knn_model, y_pred_knn = evaluate_model(KNeighborsClassifier(n_neighbors=5),
-                                       X_train_scaled, X_test_scaled, y_train, y_test, "KNN")
+    joblib.dump(voting_model, 'voting_model.pkl')
+    joblib.dump(scaler, 'scaler.pkl')
+    joblib.dump(feature_names, 'feature_names.pkl')
 
-# Create and evaluate Voting Classifier
-voting_model = VotingClassifier(estimators=[
-    ('rf', rf_model),
-    ('svc', svc_model),
-    ('knn', knn_model),
-], voting='hard')
+    # Flat NumPy export of the ensemble for fast, scikit-learn-free inference
+    export_voting_model(voting_model, scaler, feature_names, 'voting_model_arrays')
+    if args.publish:
+        version = model_registry.publish(voting_model, scaler, feature_names, notes=args.notes)
+        print(f"Published model version {version} to {model_registry.REGISTRY_DIR}")
 
-voting_model, y_pred_voting = evaluate_model(voting_model,
-                                             X_train_scaled, X_test_scaled, y_train, y_test, "Voting Classifier")
+    print(f"Training finished in {time.perf_counter() - start:.1f}s")
 
 
-joblib.dump(voting_model, 'voting_model.pkl')
-joblib.dump(scaler, 'scaler.pkl')
-joblib.dump(X_train.columns, 'feature_names.pkl')
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+
+# model_registry/<version>/ holds one exported model (see fast_model) and
+# manifest.json says which version is live
+REGISTRY_DIR = os.environ.get("MODEL_REGISTRY_DIR", "model_registry")
+MANIFEST_FILE = "manifest.json"
+MODEL_DIR = "voting_model_arrays"
+POLL_SECONDS = 10.0
+
+
+def read_manifest(registry=REGISTRY_DIR):
+    """
+    Returns the registry manifest, {"current": version, "versions": {...}},
+    or None if there is no registry.
+    """
+    try:
+        with open(os.path.join(registry, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_manifest(registry, manifest):
+    # Replaced in one rename, so the watcher never reads half a manifest
+    path = os.path.join(registry, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def current_version(registry=REGISTRY_DIR):
+    manifest = read_manifest(registry)
+    return None if manifest is None else manifest.get("current")
+
+
+def version_path(version, registry=REGISTRY_DIR):
+    """
+    Returns the model directory of a version, loadable with
+    triage_engine.load_model_and_scaler.
+    """
+    return os.path.join(registry, version, MODEL_DIR)
+
+
+def publish(voting_model, scaler, feature_names, registry=REGISTRY_DIR, version=None, activate=True, notes=None):
+    """
+    Exports a trained model (a VotingClassifier, or a FastVotingModel, e.g.
+    from incremental learning) as a new version and, with activate, makes it
+    current. Running apps pick it up through their watcher. Returns the version.
+    """
+    from fast_model import export_voting_model
+
+    if version is None:
+        version = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d-%H%M%S")
+        suffix = 1
+        while os.path.exists(os.path.join(registry, version if suffix == 1 else f"{version}-{suffix}")):
+            suffix += 1
+        version = version if suffix == 1 else f"{version}-{suffix}"
+    final = os.path.join(registry, version)
+    if os.path.exists(final):
+        raise ValueError(f"Model version {version} already exists")
+    # Exported next to its final place and renamed in, so a half-written
+    # version is never visible
+    staging = os.path.join(registry, f".{version}.tmp")
+    shutil.rmtree(staging, ignore_errors=True)
+    if hasattr(voting_model, "save"):
+        voting_model.save(os.path.join(staging, MODEL_DIR))
+    else:
+        export_voting_model(voting_model, scaler, feature_names, os.path.join(staging, MODEL_DIR))
+    os.replace(staging, final)
+
+    manifest = read_manifest(registry) or {"current": None, "versions": {}}
+    manifest["versions"][version] = {
+        "created_at": time.time(),
+        "feature_names": [str(name) for name in feature_names],
+        "notes": notes,
+    }
+    if activate:
+        manifest["current"] = version
+    _write_manifest(registry, manifest)
+    return version
+
+
+def activate(version, registry=REGISTRY_DIR):
+    """
+    Makes an already published version current, e.g. to roll back.
+    """
+    manifest = read_manifest(registry)
+    if manifest is None or version not in manifest["versions"]:
+        raise ValueError(f"Unknown model version: {version}")
+    manifest["current"] = version
+    _write_manifest(registry, manifest)
+
+
+class ModelWatcher:
+    """
+    Polls the registry manifest every interval seconds and calls
+    on_version(version) from its thread when the current version changes.
+    """
+
+    def __init__(self, on_version, registry=REGISTRY_DIR, interval=POLL_SECONDS, version=None):
+        self.on_version = on_version
+        self.registry = registry
+        self.interval = interval
+        self.version = version
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="model-watcher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def check(self):
+        """
+        Calls on_version if the current version changed since the last check.
+        """
+        try:
+            version = current_version(self.registry)
+        except (OSError, ValueError) as e:
+            print(f"Model registry: cannot read manifest: {e}", file=sys.stderr)
+            return
+        if version is None or version == self.version:
+            return
+        # Remembered even if loading fails, so a bad version is not retried every poll
+        self.version = version
+        self.on_version(version)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Publish, list and activate model versions.")
+    parser.add_argument("--registry", default=REGISTRY_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+    publish_parser = commands.add_parser("publish", help="publish exported artifacts as a new version")
+    publish_parser.add_argument("--model", default="voting_model.pkl")
+    publish_parser.add_argument("--scaler", default="scaler.pkl")
+    publish_parser.add_argument("--feature-names", default="feature_names.pkl")
+    publish_parser.add_argument("--version", default=None)
+    publish_parser.add_argument("--notes", default=None)
+    publish_parser.add_argument("--no-activate", action="store_true")
+    commands.add_parser("list", help="list versions")
+    activate_parser = commands.add_parser("activate", help="make a version current")
+    activate_parser.add_argument("version")
+    args = parser.parse_args(argv)
+
+    if args.command == "publish":
+        import joblib
+        version = publish(joblib.load(args.model), joblib.load(args.scaler), joblib.load(args.feature_names),
+                          args.registry, args.version, not args.no_activate, args.notes)
+        print(f"Published model version {version}")
+    elif args.command == "activate":
+        activate(args.version, args.registry)
+        print(f"Activated model version {args.version}")
+    else:
+        manifest = read_manifest(args.registry) or {"current": None, "versions": {}}
+        for version, info in sorted(manifest["versions"].items()):
+            marker = "*" if version == manifest["current"] else " "
+            created = datetime.datetime.fromtimestamp(info["created_at"]).isoformat(timespec="seconds")
+            print(f"{marker} {version}  {created}  {info.get('notes') or ''}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import data_prep
+import model_registry
+from fast_model import FastVotingModel, calibrate_soft_vote, load_fast_model
+from triage_engine import MODEL_ARRAYS_PATH, NUMERIC_COLS
+
+
+# Incremental updates work on the exported ensemble (see fast_model):
+#  - the scaler keeps running mean/variance statistics,
+#  - the linear SVC takes mini-batch SGD steps on the squared hinge loss it was trained with,
+#  - the KNN adds the confirmed cases to its neighbours,
+#  - the random forest cannot learn incrementally; it only waits for the next compaction.
+# After compact_every confirmed outcomes, a full retrain on data.csv plus every
+# confirmed outcome replaces the incrementally updated model.
+MIN_BATCH = 20            # Confirmed outcomes needed before an update is published
+COMPACT_EVERY = 2000      # Incremental outcomes before a full retrain
+LEARNING_RATE = 0.01
+L2_PENALTY = 1e-4
+EPOCHS = 5
+KNN_MAX_ROWS = 20000      # Oldest neighbours are dropped beyond this, to bound KNN latency
+MAX_ACCURACY_DROP = 0.02  # Largest holdout accuracy loss an update may cause
+MAX_HOLDOUT_ROWS = 50000
+STATE_FILE = "online_state.json"  # In the registry directory
+# Training rows always have these vitals (rows missing one are dropped), but
+# an outcome stores a vital that was not entered as 0; such outcomes are skipped
+REQUIRED_FEATURES = NUMERIC_COLS
+
+
+class RunningScaler:
+    """
+    StandardScaler statistics that can be updated batch by batch
+    (StandardScaler.partial_fit's merge of means and variances).
+    """
+
+    def __init__(self, mean, var, n_samples_seen):
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.var = np.asarray(var, dtype=np.float64)
+        self.n_samples_seen = n_samples_seen
+
+    @classmethod
+    def from_model(cls, model):
+        n_samples_seen = model.meta.get("scaler_n_samples_seen", len(model.knn_y))
+        return cls(model.scaler_mean, np.asarray(model.scaler_scale) ** 2, n_samples_seen)
+
+    def partial_fit(self, X):
+        n = len(X)
+        if n == 0:
+            return self
+        batch_mean = X.mean(axis=0)
+        batch_var = X.var(axis=0)
+        total = self.n_samples_seen + n
+        delta = batch_mean - self.mean
+        self.var = (self.var * self.n_samples_seen + batch_var * n
+                    + delta ** 2 * self.n_samples_seen * n / total) / total
+        self.mean = self.mean + delta * n / total
+        self.n_samples_seen = total
+        return self
+
+    @property
+    def scale(self):
+        scale = np.sqrt(self.var)
+        scale[scale == 0.0] = 1.0  # Constant features, as StandardScaler leaves them
+        return scale
+
+
+def _rescale_thresholds(threshold, old_mean, old_scale, new_mean, new_scale):
+    # Most thresholds sit within a float32 rounding of a raw value the data
+    # takes (e.g. a heart rate of 100), so which side that value falls on
+    # depends on rounding. For those, the side is worked out under the old
+    # scaling and the new threshold is placed on the same side of the value's
+    # new float32 encoding; the others are simply re-expressed.
+    raw = threshold * old_scale + old_mean
+    value = np.round(raw, 4)
+    at_value = np.abs(raw - value) <= 1e-6 * np.maximum(1.0, np.abs(value))
+    goes_right = ((value - old_mean) / old_scale).astype(np.float32) > threshold
+    encoded = ((value - new_mean) / new_scale).astype(np.float32).astype(np.float64)
+    snapped = np.where(goes_right, np.nextafter(encoded, -np.inf), encoded)
+    return np.where(at_value, snapped, (raw - new_mean) / new_scale)
+
+
+def rescale_arrays(arrays, new_mean, new_scale):
+    """
+    Re-expresses the ensemble's split thresholds, SVC weights and intercepts,
+    and KNN points in a new scaling. Forest and SVC predictions on raw
+    features stay the same; KNN neighbourhoods shift with the scaler, as they
+    would in a retrain.
+    """
+    old_mean, old_scale = arrays["scaler_mean"], arrays["scaler_scale"]
+    arrays = dict(arrays)
+    feature = arrays["rf_feature"]
+    arrays["rf_threshold"] = _rescale_thresholds(arrays["rf_threshold"], old_mean[feature], old_scale[feature],
+                                                 new_mean[feature], new_scale[feature])
+    coef = arrays["svc_coef"]
+    arrays["svc_intercept"] = arrays["svc_intercept"] + coef @ ((new_mean - old_mean) / old_scale)
+    arrays["svc_coef"] = coef * (new_scale / old_scale)
+    arrays["knn_X"] = (arrays["knn_X"] * old_scale + old_mean - new_mean) / new_scale
+    arrays["scaler_mean"] = new_mean
+    arrays["scaler_scale"] = new_scale
+    return arrays
+
+
+def sgd_partial_fit(coef, intercept, classes, X, y, learning_rate=LEARNING_RATE, l2_penalty=L2_PENALTY,
+                    epochs=EPOCHS):
+    """
+    Mini-batch gradient steps of a one-vs-rest squared hinge loss (the
+    LinearSVC objective) on scaled features X with labels y. Returns the
+    updated (coef, intercept).
+    """
+    targets = np.where(y[:, np.newaxis] == classes[np.newaxis, :], 1.0, -1.0)
+    for _ in range(epochs):
+        scores = X @ coef.T + intercept
+        slack = np.maximum(0.0, 1.0 - targets * scores)
+        gradient = -2.0 * slack * targets / len(X)
+        coef = coef - learning_rate * (gradient.T @ X + l2_penalty * coef)
+        intercept = intercept - learning_rate * gradient.sum(axis=0)
+    return coef, intercept
+
+
+def incremental_update(model, X, labels):
+    """
+    Returns a new FastVotingModel updated with raw (unscaled) features X and
+    class labels (level - 1). model itself is left unchanged. The soft-vote
+    calibration no longer fits the updated model, so it is dropped (see
+    recalibrate).
+    """
+    arrays = {name: np.array(array) for name, array in model.arrays.items()}
+    scaler = RunningScaler.from_model(model).partial_fit(X)
+    arrays = rescale_arrays(arrays, scaler.mean, scaler.scale)
+
+    X_scaled = (X - scaler.mean) / scaler.scale
+    arrays["svc_coef"], arrays["svc_intercept"] = sgd_partial_fit(
+        arrays["svc_coef"], arrays["svc_intercept"], arrays["svc_classes"], X_scaled, labels)
+    arrays["knn_X"] = np.concatenate([arrays["knn_X"], X_scaled])[-KNN_MAX_ROWS:]
+    arrays["knn_y"] = np.concatenate([arrays["knn_y"], labels.astype(np.int64)])[-KNN_MAX_ROWS:]
+
+    meta = dict(model.meta, scaler_n_samples_seen=int(scaler.n_samples_seen),
+                incremental_outcomes=model.meta.get("incremental_outcomes", 0) + len(X))
+    meta.pop("calibration", None)
+    return FastVotingModel(arrays, meta)
+
+
+def recalibrate(model, X, labels):
+    """
+    Refits model's soft-vote temperatures on raw features X and class labels
+    (see fast_model.calibrate_soft_vote), in place.
+    """
+    model.meta["calibration"] = calibrate_soft_vote(model, model.scaler.transform(X), labels)
+    return model
+
+
+def accuracy(model, X, labels):
+    return float(np.mean(model.predict(model.scaler.transform(X)) == labels))
+
+
+def complete_outcomes(outcomes):
+    """
+    Returns the confirmed outcomes that had every vital entered.
+    """
+    return [outcome for outcome in outcomes if all(outcome["features"].get(name) for name in REQUIRED_FEATURES)]
+
+
+def outcome_matrix(outcomes, feature_names):
+    """
+    Returns (X, labels) from confirmed outcomes, in feature_names order.
+    Pass them through complete_outcomes first.
+    """
+    X = np.array([[outcome["features"].get(str(name), 0.0) for name in feature_names] for outcome in outcomes],
+                 dtype=np.float64).reshape(len(outcomes), len(feature_names))
+    labels = np.array([outcome["confirmed_level"] - 1 for outcome in outcomes], dtype=np.int64)
+    return X, labels
+
+
+def load_holdout(model, data_path="data.csv"):
+    """
+    The rows of data.csv that model.py held out of the model's training (at
+    most MAX_HOLDOUT_ROWS of them) as (X, labels), to catch updates that make
+    the model worse on the original data.
+    """
+    if "holdout_rows" not in model.arrays:
+        raise ValueError("The model does not record its held-out rows; retrain it with model.py")
+    dataset = data_prep.prepare(data_path)
+    if [str(name) for name in model.feature_names] != dataset.feature_names:
+        raise ValueError(f"{data_path} columns {dataset.feature_names} do not match the model's "
+                         f"{list(model.feature_names)}")
+    if dataset.meta["source_sha256"] != model.meta["holdout_source_sha256"]:
+        raise ValueError(f"{data_path} has changed since the model was trained; retrain it with model.py")
+    # The split is shuffled, so its first rows are a random sample
+    rows = np.sort(model.holdout_rows[:MAX_HOLDOUT_ROWS])
+    return dataset.take(rows), dataset.labels(rows)
+
+
+class IncrementalTrainer:
+    """
+    Turns clinician-confirmed levels from the triage queue into new model
+    versions in the registry, where running apps pick them up. Progress
+    (which outcomes were used and how many since the last full retrain) is
+    kept in the registry's online_state.json.
+    """
+
+    def __init__(self, queue, registry=model_registry.REGISTRY_DIR, data_path="data.csv", min_batch=MIN_BATCH,
+                 compact_every=COMPACT_EVERY):
+        self.queue = queue
+        self.registry = registry
+        self.data_path = data_path
+        self.min_batch = min_batch
+        self.compact_every = compact_every
+        self.state_path = os.path.join(registry, STATE_FILE)
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"cursor": [0.0, 0], "since_compaction": 0}
+
+    def _save_state(self, state):
+        os.makedirs(self.registry, exist_ok=True)
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def _current_model(self):
+        version = model_registry.current_version(self.registry)
+        path = MODEL_ARRAYS_PATH if version is None else model_registry.version_path(version, self.registry)
+        return load_fast_model(path, mmap=False), version or "unversioned"
+
+    def run_once(self):
+        """
+        Publishes one incremental update, or a full retrain when enough
+        outcomes have built up. Returns the new version, or None.
+        """
+        state = self._load_state()
+        outcomes = self.queue.confirmed_outcomes(after=tuple(state["cursor"]))
+        complete = complete_outcomes(outcomes)
+        if state["since_compaction"] + len(complete) >= self.compact_every:
+            return self.compact(outcomes, state)
+        if len(complete) < self.min_batch:
+            return None
+
+        model, base_version = self._current_model()
+        X, labels = outcome_matrix(complete, model.feature_names)
+        updated = incremental_update(model, X, labels)
+
+        # The cursor moves past the incomplete outcomes too
+        state["cursor"] = [outcomes[-1]["confirmed_at"], outcomes[-1]["request_id"]]
+        state["since_compaction"] += len(complete)
+        X_holdout, y_holdout = load_holdout(model, self.data_path)
+        before, after = accuracy(model, X_holdout, y_holdout), accuracy(updated, X_holdout, y_holdout)
+        if after < before - MAX_ACCURACY_DROP:
+            # The outcomes still count towards the next full retrain
+            self._save_state(state)
+            print(f"Incremental update on {len(complete)} outcomes rejected: holdout accuracy "
+                  f"{before:.3f} -> {after:.3f}", file=sys.stderr)
+            return None
+        recalibrate(updated, X_holdout, y_holdout)
+        version = model_registry.publish(updated, None, model.feature_names, self.registry,
+                                         notes=f"incremental: {len(complete)} confirmed outcomes on {base_version}, "
+                                               f"holdout accuracy {before:.3f} -> {after:.3f}")
+        self._save_state(state)
+        print(f"Published incremental model version {version} ({len(complete)} outcomes, "
+              f"holdout accuracy {before:.3f} -> {after:.3f})", file=sys.stderr)
+        return version
+
+    def compact(self, outcomes=None, state=None):
+        """
+        Retrains from scratch on data.csv plus every confirmed outcome and
+        publishes the result, replacing the incrementally updated model.
+        """
+        import model  # scikit-learn is only needed here
+
+        state = state or self._load_state()
+        outcomes = self.queue.confirmed_outcomes() if outcomes is None else outcomes
+        dataset = data_prep.prepare(self.data_path)
+        X_confirmed, y_confirmed = model.load_confirmed_outcomes(dataset.feature_names, self.queue.url)
+        voting_model, scaler = model.train_from_dataset(dataset, (X_confirmed, y_confirmed))
+        version = model_registry.publish(voting_model, scaler, dataset.feature_names, self.registry,
+                                         notes=f"full retrain with {len(X_confirmed)} confirmed outcomes")
+        if outcomes:
+            state["cursor"] = [outcomes[-1]["confirmed_at"], outcomes[-1]["request_id"]]
+        state["since_compaction"] = 0
+        self._save_state(state)
+        print(f"Published retrained model version {version}", file=sys.stderr)
+        return version
+
+
+def main(argv=None):
+    from triage_queue import DATABASE_URL, TriageQueue
+
+    parser = argparse.ArgumentParser(description="Update the model from clinician-confirmed triage levels.")
+    parser.add_argument("--db", default=DATABASE_URL, help="triage queue database URL")
+    parser.add_argument("--registry", default=model_registry.REGISTRY_DIR)
+    parser.add_argument("--data", default="data.csv")
+    parser.add_argument("--min-batch", type=int, default=MIN_BATCH)
+    parser.add_argument("--compact-every", type=int, default=COMPACT_EVERY)
+    parser.add_argument("--compact", action="store_true", help="run a full retrain now")
+    parser.add_argument("--every", type=float, default=None, help="keep running, checking every N seconds")
+    args = parser.parse_args(argv)
+
+    trainer = IncrementalTrainer(TriageQueue(args.db), args.registry, args.data, args.min_batch, args.compact_every)
+    if args.compact:
+        trainer.compact()
+        return
+    while True:
+        trainer.run_once()
+        if args.every is None:
+            return
+        time.sleep(args.every)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+_phases = []
+_lock = threading.Lock()
+_recording = True
+
+
+@contextmanager
+def timed(phase):
+    """
+    Records how long the wrapped import/load step takes. Each phase is recorded
+    once and only until finish() is called, so script reruns add nothing.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            if _recording and all(name != phase for name, _ in _phases):
+                _phases.append((phase, elapsed))
+
+
+def phases():
+    with _lock:
+        return list(_phases)
+
+
+def report(file=None):
+    """
+    Prints the per-phase startup breakdown.
+    """
+    file = file or sys.stderr
+    recorded = phases()
+    print("Startup timing:", file=file)
+    for phase, elapsed in recorded:
+        print(f"  {phase:<32} {elapsed * 1000:9.1f} ms", file=file)
+    print(f"  {'total':<32} {sum(e for _, e in recorded) * 1000:9.1f} ms", file=file)
+
+
+def finish(file=None):
+    """
+    Stops recording and prints the report, once per process.
+    """
+    global _recording
+    with _lock:
+        if not _recording:
+            return
+        _recording = False
+    report(file)
+
+
+def main():
+    # Cold-start breakdown in a fresh interpreter, e.g. after a container restart
+    with timed("import streamlit"):
+        import streamlit  # noqa: F401
+    with timed("import groq"):
+        import groq  # noqa: F401
+    with timed("import PIL"):
+        import PIL.Image  # noqa: F401
+    with timed("import numpy"):
+        import numpy  # noqa: F401
+    with timed("import pandas"):
+        import pandas  # noqa: F401
+    with timed("import joblib"):
+        import joblib  # noqa: F401
+    with timed("import scikit-learn"):
+        import sklearn.ensemble  # noqa: F401
+        import sklearn.neighbors  # noqa: F401
+        import sklearn.svm  # noqa: F401
+
+    import triage_engine
+    triage_engine.warm_up()
+
+
+if __name__ == "__main__":
+    # Run through the importable module so triage_engine records into the same report
+    import startup_timing
+    startup_timing.main()
@@ -0,0 +1,216 @@
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import llm_gate
+import metrics
+from groq_client import LLMUnavailableError
+from image_prep import ImageError
+from triage_engine import PATIENT_FIELDS, triage_batch
+from triage_llm import TriageResponseError, build_surge_query, parse_surge_response, request_surge_triage
+from triage_pipeline import describe_image, gate_llm, recommend, skipped_llm_error
+
+
+PACK_SIZE = 8                   # Patients per packed LLM completion
+PACK_WORKERS = 4                # Packs in flight across every surge of the process
+MAX_PACKS_IN_FLIGHT = 4         # Packs one surge queues at once, so concurrent surges take turns
+SURGE_DEADLINE_SECONDS = 120.0  # Surge calls may queue behind the rate limiter for a while
+VISION_WORKERS = 8              # Vision calls of packs in flight, run side by side
+
+_pack_executor = None
+_pack_executor_lock = threading.Lock()
+_vision_executor = None
+_vision_executor_lock = threading.Lock()
+
+
+def get_pack_executor():
+    """
+    Returns the process-wide pool for surge packs. It is separate from the
+    triage pool because a pack can wait in the rate limiter for up to
+    SURGE_DEADLINE_SECONDS, and several surges at once would otherwise hold
+    every triage thread that single-patient submits need.
+    """
+    global _pack_executor
+    if _pack_executor is None:
+        with _pack_executor_lock:
+            if _pack_executor is None:
+                _pack_executor = ThreadPoolExecutor(max_workers=PACK_WORKERS, thread_name_prefix="surge-pack")
+    return _pack_executor
+
+
+def get_vision_executor():
+    """
+    Returns the process-wide pool for surge vision calls. It is separate from
+    the pack pool because pack tasks wait on these calls.
+    """
+    global _vision_executor
+    if _vision_executor is None:
+        with _vision_executor_lock:
+            if _vision_executor is None:
+                _vision_executor = ThreadPoolExecutor(max_workers=VISION_WORKERS, thread_name_prefix="surge-vision")
+    return _vision_executor
+
+
+def read_patient_table(df, image_column="image"):
+    """
+    Turns a pasted, edited or uploaded table with PATIENT_FIELDS columns
+    (any subset, extra columns ignored) into a list of patient dicts. Blank
+    cells become None, so apply_input_defaults fills them as the form does.
+    Returns (patients, image_names), with each patient's image_column value
+    (e.g. a photo's file name) or None in image_names.
+    """
+    columns = [field for field in PATIENT_FIELDS if field in df.columns]
+    names = df[image_column].tolist() if image_column in df.columns else [None] * len(df)
+    patients = []
+    image_names = []
+    for row, name in zip(df[columns].itertuples(index=False), names):
+        patient = {}
+        for field, value in zip(columns, row):
+            if value is None or value != value or (isinstance(value, str) and not value.strip()):
+                value = None  # Blank or NaN
+            elif hasattr(value, "item"):
+                value = value.item()  # NumPy scalar from pandas
+            patient[field] = value
+        if any(value is not None for value in patient.values()):
+            patients.append(patient)
+            image_names.append(name if isinstance(name, str) and name.strip() else None)
+    return patients, image_names
+
+
+def _triage_pack(client, pack, images):
+    # One packed completion for up to PACK_SIZE patients. Vision calls cannot
+    # be packed (one image per request), so they go first, one per image,
+    # all at once on the vision pool.
+    # Returns {index: (level, description) or None} plus the exception, if any.
+    rows = []
+    image_stats = {}
+    try:
+        executor = get_vision_executor()
+        described = {index: executor.submit(describe_image, client, images[index])
+                     for index, _ in pack if images.get(index) is not None}
+        for index, scored in pack:
+            image_description = "No image provided."
+            if index in described:
+                prepared, image_description, _, _ = described[index].result()
+                image_stats[index] = {key: prepared[key] for key in ("bytes_before", "bytes_after")}
+            rows.append((index, scored["patient"], image_description))
+        with metrics.span("surge_llm_call"):
+            response, usage = request_surge_triage(client, build_surge_query(rows), len(rows),
+                                                   deadline=SURGE_DEADLINE_SECONDS)
+        answers = parse_surge_response(response)
+        error = None
+    except (LLMUnavailableError, TriageResponseError, ImageError) as e:
+        answers, usage, error = {}, None, e
+    return {index: answers.get(str(index)) for index, _ in pack}, image_stats, usage, error
+
+
+def run_surge(client, patients, images=None, pack_size=PACK_SIZE, on_result=None, scored=None):
+    """
+    Triage many patients at once. All of them are scored with one batched ML
+    call and go through the same LLM bypass gate as a single submit. The
+    rest are sent to the LLM packed pack_size to a completion, with the
+    packs running concurrently under the client's rate limiter. Packs are
+    formed and started most urgent (by ML level) first.
+
+    images maps a patient's index to its image (raw bytes or PIL.Image).
+    scored, if given, holds the patients' triage_batch results, which are
+    then used as they are instead of scoring the patients again.
+    on_result(index, result), if given, is called on the calling thread for
+    each patient as its pack finishes, most urgent first within the pack,
+    and right away for patients the gate lets skip the LLM.
+    A patient the LLM did not answer for gets an ML-only result, as does
+    every patient of a pack that failed in any other way, so one failed
+    pack never stops the rest of the surge. Returns the results in input
+    order.
+    """
+    images = images or {}
+    if scored is None:
+        with metrics.span("surge_ml_predict"):
+            scored = triage_batch([dict(patient, has_image=images.get(i) is not None)
+                                   for i, patient in enumerate(patients)])
+    results = [None] * len(scored)
+    gates = [gate_llm(client, result["patient"], images.get(i), result["ml_triage_level"], result["ml_confidence"])
+             for i, result in enumerate(scored)]
+    order = sorted(range(len(scored)), key=lambda i: scored[i]["ml_triage_level"])
+    asked = []
+    for index in order:
+        if gates[index] is not None and gates[index]["bypass"]:
+            results[index] = _bypassed_result(scored[index], gates[index])
+            if on_result is not None:
+                on_result(index, results[index])
+        else:
+            asked.append(index)
+    packs = [[(i, scored[i]) for i in asked[start:start + pack_size]]
+             for start in range(0, len(asked), pack_size)]
+    packs.reverse()  # Popped from the end, most urgent first
+
+    # Packs run PACK_WORKERS at a time across every surge in the process.
+    # Each surge only queues a few at once, so a large one cannot hold up
+    # the packs of another started after it
+    executor = get_pack_executor()
+    in_flight = {}
+    while packs or in_flight:
+        while packs and len(in_flight) < MAX_PACKS_IN_FLIGHT:
+            pack = packs.pop()
+            in_flight[executor.submit(_triage_pack, client, pack, images)] = pack
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            pack = in_flight.pop(future)
+            try:
+                pack_result = future.result()
+            except Exception as e:
+                # Patients of earlier packs are already queued; this pack falls back to the ML levels
+                print(f"Surge pack of {len(pack)} patients failed: {type(e).__name__}: {e}", file=sys.stderr)
+                pack_result = {index: None for index, _ in pack}, {}, None, e
+            _collect_pack(pack_result, scored, gates, results, on_result)
+    return results
+
+
+def _bypassed_result(scored, gate):
+    # A patient the gate let skip the LLM, triaged on the ML level alone
+    result = dict(scored, groq_triage_level=None, groq_triage_description=None, ml_only=True, llm_bypassed=True,
+                  gate_reason=gate["reason"], llm_error=skipped_llm_error(scored["ml_confidence"]),
+                  image_stats=None, pack_usage=None, pack_size=0)
+    recommended_triage, model_weight, rationale = recommend(result, scored["model_weight"])
+    result.update(recommended_triage=recommended_triage, model_weight=model_weight, rationale=rationale)
+    return result
+
+
+def _collect_pack(pack_result, scored, gates, results, on_result):
+    answers, image_stats, usage, error = pack_result
+    pack_results = []
+    for index, answer in answers.items():
+        ml_triage_level = scored[index]["ml_triage_level"]
+        gate = gates[index]
+        if answer is None:
+            reason = "surge_no_answer" if error is None else type(error).__name__
+            metrics.inc("triage_fallbacks_total", reason=reason)
+            result = {
+                "groq_triage_level": None,
+                "groq_triage_description": None,
+                "ml_only": True,
+                "llm_error": "No answer for this patient in the packed completion" if error is None else str(error),
+                "fallback_reason": reason,
+            }
+        else:
+            groq_triage_level, groq_triage_description = answer
+            result = {
+                "groq_triage_level": groq_triage_level,
+                "groq_triage_description": groq_triage_description,
+                "ml_only": False,
+            }
+        result.update(patient=scored[index]["patient"], ml_triage_level=ml_triage_level,
+                      ml_confidence=scored[index]["ml_confidence"],
+                      model_version=scored[index]["model_version"], features=scored[index]["features"],
+                      llm_bypassed=False, gate_reason=None if gate is None else gate["reason"],
+                      image_stats=image_stats.get(index), pack_usage=usage, pack_size=len(answers))
+        recommended_triage, model_weight, rationale = recommend(result, scored[index]["model_weight"])
+        result.update(recommended_triage=recommended_triage, model_weight=model_weight, rationale=rationale)
+        if gate is not None and gate["would_bypass"]:
+            llm_gate.record_agreement(ml_triage_level, result["groq_triage_level"], "shadow",
+                                      ml_confidence=result["ml_confidence"])
+        results[index] = result
+        pack_results.append((index, result))
+    for index, result in sorted(pack_results, key=lambda item: item[1]["recommended_triage"]):
+        if on_result is not None:
+            on_result(index, result)
@@ -0,0 +1,441 @@
+import math
+import os
+import sys
+import threading
+
+import numpy as np
+
+import metrics
+import model_registry
+import startup_timing
+
+# pandas, joblib and (through the pickles) scikit-learn are imported lazily so
+# the UI can render while start_warmup() loads them in the background.
+
+
+MODEL_PATH = "voting_model.pkl"
+MODEL_ARRAYS_PATH = "voting_model_arrays"  # NumPy export written by model.py
+SCALER_PATH = "scaler.pkl"
+FEATURE_NAMES_PATH = "feature_names.pkl"
+UNVERSIONED = "unversioned"  # Model loaded from the files above rather than the registry
+
+# Vitals columns in data.csv that may hold non-numeric placeholders
+NUMERIC_COLS = ["SBP", "DBP", "HR", "RR", "BT"]
+
+# Fields a patient record may carry (the same names the Streamlit form uses)
+PATIENT_FIELDS = [
+    "age", "sex", "description", "pain_level", "bp_systolic", "bp_diastolic",
+    "heart_rate", "oxygen_saturation", "respiratory_rate", "body_temperature",
+    "temp_unit", "consciousness", "transport",
+]
+
+_model = None  # ((voting_model, scaler, feature_names), version), swapped as one
+_artifacts_lock = threading.Lock()
+_model_watcher = None
+_warmup_thread = None
+_warmup_lock = threading.Lock()
+
+
+def load_model_and_scaler(model_path=None, scaler_path=SCALER_PATH,
+                          feature_names_path=FEATURE_NAMES_PATH):
+    """
+    Loads the voting model, the scaler and the training feature names from disk.
+    By default the memory-mapped NumPy export is used when it exists, which
+    skips importing scikit-learn; a directory model_path selects it explicitly.
+    """
+    if model_path is None:
+        model_path = MODEL_ARRAYS_PATH if os.path.isdir(MODEL_ARRAYS_PATH) else MODEL_PATH
+    if os.path.isdir(model_path):
+        from fast_model import load_fast_model
+        model = load_fast_model(model_path)
+        return model, model.scaler, model.feature_names
+
+    import joblib
+
+    voting_model = joblib.load(model_path)
+    scaler = joblib.load(scaler_path)
+    feature_names = joblib.load(feature_names_path)
+    return voting_model, scaler, feature_names
+
+
+def get_model():
+    """
+    Returns the process-wide ((voting_model, scaler, feature_names), version),
+    loading the registry's current version (or the unversioned files if there
+    is no registry) on first use. A request should take both from one call,
+    so a hot reload between two calls cannot mix versions.
+    """
+    global _model
+    if _model is None:
+        with _artifacts_lock:
+            if _model is None:
+                version = model_registry.current_version()
+                if version is None:
+                    _model = (load_model_and_scaler(), UNVERSIONED)
+                else:
+                    _model = (load_model_and_scaler(model_registry.version_path(version)), version)
+    return _model
+
+
+def get_artifacts():
+    """
+    Returns the process-wide (voting_model, scaler, feature_names), loading them on first use.
+    """
+    return get_model()[0]
+
+
+def get_model_version():
+    return get_model()[1]
+
+
+def warm_up():
+    """
+    Loads the artifacts and runs a dummy prediction so the first real request
+    does not pay for imports, unpickling or first-call overhead.
+    """
+    with startup_timing.timed("load model artifacts"):
+        feature_names = get_artifacts()[2]
+    with startup_timing.timed("warm-up predict"):
+        predict_with_ml_model(np.zeros((1, len(feature_names))))
+    startup_timing.finish()
+
+
+def start_warmup():
+    """
+    Starts warm_up() in a background thread, once per process.
+    """
+    global _warmup_thread
+    with _warmup_lock:
+        if _warmup_thread is None:
+            _warmup_thread = threading.Thread(target=warm_up, name="triage-warmup", daemon=True)
+            _warmup_thread.start()
+    return _warmup_thread
+
+
+def set_artifacts(voting_model, scaler, feature_names, version=UNVERSIONED):
+    """
+    Installs already-loaded artifacts (e.g. from a Streamlit resource cache).
+    """
+    global _model
+    with _artifacts_lock:
+        _model = ((voting_model, scaler, feature_names), version)
+
+
+def validate_artifacts(artifacts, expected_feature_names=None):
+    """
+    Checks a freshly loaded model before it serves requests: its feature names
+    must match expected_feature_names (or the encoders, if None) exactly, and
+    a smoke prediction must return levels from 1 to 5. Raises ValueError.
+    """
+    feature_names = [str(name) for name in artifacts[2]]
+    if expected_feature_names is not None:
+        if feature_names != [str(name) for name in expected_feature_names]:
+            raise ValueError(f"Feature names {feature_names} do not match {list(expected_feature_names)}")
+    elif not set(feature_names) <= set(FEATURE_SCHEMA):
+        raise ValueError(f"No encoder for features {sorted(set(feature_names) - set(FEATURE_SCHEMA))}")
+
+    smoke_patients = [
+        apply_input_defaults({})[0],
+        apply_input_defaults({"age": 80, "sex": "Male", "heart_rate": 140, "bp_systolic": 80, "bp_diastolic": 50,
+                              "respiratory_rate": 30, "consciousness": "Unresponsive",
+                              "transport": "Public Ambulance", "pain_level": 9})[0],
+    ]
+    levels = predict_with_ml_model(encode_patients(smoke_patients, feature_names), artifacts)
+    if len(levels) != len(smoke_patients) or not all(1 <= level <= 5 for level in levels):
+        raise ValueError(f"Smoke prediction returned {list(levels)}")
+
+
+def reload_model(version):
+    """
+    Loads and validates a registry version and, if it passes, swaps it in.
+    Requests already running keep the model they started with. Returns
+    True if the version is now live.
+    """
+    global _model
+    current_artifacts, current_version = get_model()
+    if version == current_version:
+        return True
+    try:
+        artifacts = load_model_and_scaler(model_registry.version_path(version))
+        validate_artifacts(artifacts, current_artifacts[2])
+    except Exception as e:
+        metrics.inc("model_reloads_total", result="rejected")
+        print(f"Model version {version} rejected, still serving {current_version}: {e}", file=sys.stderr)
+        return False
+    with _artifacts_lock:
+        _model = (artifacts, version)
+    metrics.inc("model_reloads_total", result="loaded")
+    print(f"Model version {version} loaded (was {current_version})", file=sys.stderr)
+    return True
+
+
+def start_model_watcher():
+    """
+    Starts watching the model registry for a new current version, once per process.
+    """
+    global _model_watcher
+    with _warmup_lock:
+        if _model_watcher is None:
+            _model_watcher = model_registry.ModelWatcher(reload_model).start()
+    return _model_watcher
+
+
+def clean_triage_data(df, subset=None):
+    """
+    Applies the training-time cleaning rules to a data.csv-style frame: vitals
+    are coerced to numbers and rows with missing values are dropped.
+    """
+    import pandas as pd
+
+    df[NUMERIC_COLS] = df[NUMERIC_COLS].apply(pd.to_numeric, errors="coerce")
+    return df.dropna(subset=subset)
+
+
+# Lookup tables for the categorical form fields; anything else encodes as 0
+SEX_CODES = {"Male": 1, "Female": 2}
+TRANSPORT_CODES = {"Walk": 1, "Public Ambulance": 2, "Private Vehicle": 3, "Private Ambulance": 4}
+CONSCIOUSNESS_CODES = {"Alert": 1, "Verbal Response": 2, "Pain Response": 3, "Unresponsive": 4}
+FAHRENHEIT = "Fahrenheit (°F)"
+
+
+def map_sex(sex):
+    return SEX_CODES.get(sex, 0)  # 0 for "No Selection"
+
+def map_transport(transport):
+    return TRANSPORT_CODES.get(transport, 0)  # 0 for "No Selection"
+
+def map_consciousness(consciousness):
+    return CONSCIOUSNESS_CODES.get(consciousness, 0)
+
+def map_pain(pain_level):
+    """
+    Map pain level to 1 or 2 based on the slider value.
+    """
+    return 2 if pain_level >= 4 else 1
+
+def map_injury(description):
+    """
+    Map injury to 1 or 2 based on the presence of the phrase "injur".
+    """
+    return 2 if "injur" in description.lower() else 1
+
+def convert_to_celsius(temp, unit):
+    """
+    Convert temperature to Celsius.
+    """
+    if unit == FAHRENHEIT:
+        return (temp - 32) * 5 / 9  # Convert Fahrenheit to Celsius
+    else:
+        return temp  # Already in Celsius
+
+
+def _lookup_codes(values, table):
+    # Vectorized dict lookup: map each distinct value once, then broadcast back
+    values = np.asarray(values, dtype=object).astype(str)
+    distinct, inverse = np.unique(values, return_inverse=True)
+    codes = np.array([table.get(value, 0) for value in distinct], dtype=np.float64)
+    return codes[inverse]
+
+
+def _injury_codes(descriptions):
+    descriptions = np.char.lower(np.asarray(descriptions, dtype=object).astype(str))
+    return np.where(np.char.find(descriptions, "injur") >= 0, 2.0, 1.0)
+
+
+def _celsius(temps, units):
+    temps = np.asarray(temps, dtype=np.float64)
+    return np.where(np.asarray(units, dtype=object) == FAHRENHEIT, (temps - 32) * 5 / 9, temps)
+
+
+# Training column -> (scalar encoder for one patient dict, vectorized encoder
+# for a dict of field columns). Training columns missing here are zero-filled.
+FEATURE_SCHEMA = {
+    'Sex': (lambda p: map_sex(p["sex"]),
+            lambda c: _lookup_codes(c["sex"], SEX_CODES)),
+    'Age': (lambda p: p["age"],
+            lambda c: c["age"]),
+    'Arrival mode': (lambda p: map_transport(p["transport"]),
+                     lambda c: _lookup_codes(c["transport"], TRANSPORT_CODES)),
+    'Injury': (lambda p: map_injury(p["description"]),
+               lambda c: _injury_codes(c["description"])),
+    'Mental': (lambda p: map_consciousness(p["consciousness"]),
+               lambda c: _lookup_codes(c["consciousness"], CONSCIOUSNESS_CODES)),
+    'Pain': (lambda p: map_pain(p["pain_level"]),
+             lambda c: np.where(np.asarray(c["pain_level"], dtype=np.float64) >= 4, 2.0, 1.0)),
+    'SBP': (lambda p: p["bp_systolic"],
+            lambda c: c["bp_systolic"]),
+    'DBP': (lambda p: p["bp_diastolic"],
+            lambda c: c["bp_diastolic"]),
+    'HR': (lambda p: p["heart_rate"],
+           lambda c: c["heart_rate"]),
+    'RR': (lambda p: p["respiratory_rate"],
+           lambda c: c["respiratory_rate"]),
+    'BT': (lambda p: convert_to_celsius(p["body_temperature"], p["temp_unit"]),
+           lambda c: _celsius(c["body_temperature"], c["temp_unit"])),
+}
+
+
+def apply_input_defaults(patient, has_image=False):
+    """
+    Fills in missing patient fields the same way the submit form does and
+    returns (patient, model_weight). Every supplied field adds to the ML model's
+    weight, while an image or a free-text description shifts weight to the LLM.
+    """
+    patient = {field: patient.get(field) for field in PATIENT_FIELDS}
+    model_weight = -.3 if has_image else 0
+
+    numeric_fields = ["age", "pain_level", "bp_systolic", "bp_diastolic", "heart_rate",
+                      "oxygen_saturation", "respiratory_rate", "body_temperature"]
+    for field in numeric_fields:
+        if patient[field] is None:
+            patient[field] = 0
+        else:
+            model_weight += 0.05
+
+    if patient["sex"] is None:
+        patient["sex"] = "No Selection"
+    else:
+        model_weight += 0.05
+
+    if patient["consciousness"] is None:
+        patient["consciousness"] = "Unknown"
+    else:
+        model_weight += 0.05
+
+    if patient["transport"] is None:
+        patient["transport"] = "No Selection"
+    else:
+        model_weight += 0.05
+
+    if patient["description"] is None or patient["description"] == "":
+        patient["description"] = "No description"
+    else:
+        model_weight -= 0.1
+
+    if patient["temp_unit"] is None:
+        patient["temp_unit"] = "Celsius (°C)"
+
+    return patient, model_weight
+
+
+def _feature_names(feature_names):
+    return get_artifacts()[2] if feature_names is None else feature_names
+
+
+def encode_patient(patient, feature_names=None, out=None, dtype=np.float64):
+    """
+    Encodes one (already defaulted) patient dict into a (1, n_features) row
+    ordered like the training data, writing into out when given.
+    """
+    feature_names = _feature_names(feature_names)
+    if out is None:
+        out = np.zeros((1, len(feature_names)), dtype=dtype)
+    row = out.reshape(-1)
+    for j, name in enumerate(feature_names):
+        encoders = FEATURE_SCHEMA.get(name)
+        row[j] = encoders[0](patient) if encoders is not None else 0
+    return out
+
+
+def encode_columns(columns, n_rows, feature_names=None, out=None, dtype=np.float64):
+    """
+    Encodes column-oriented patient data (a dict of field -> sequence or
+    array, already defaulted) into an (n_rows, n_features) matrix in one
+    vectorized pass per feature. Suited to very large batches.
+    """
+    feature_names = _feature_names(feature_names)
+    if out is None:
+        out = np.zeros((n_rows, len(feature_names)), dtype=dtype)
+    for j, name in enumerate(feature_names):
+        encoders = FEATURE_SCHEMA.get(name)
+        out[:, j] = encoders[1](columns) if encoders is not None else 0
+    return out
+
+
+def encode_patients(patients, feature_names=None, out=None, dtype=np.float64):
+    """
+    Encodes a list of (already defaulted) patient dicts into a 2D feature matrix
+    ordered like the training data.
+    """
+    if len(patients) == 1:
+        return encode_patient(patients[0], feature_names, out, dtype)
+    columns = {field: [p[field] for p in patients] for field in PATIENT_FIELDS}
+    return encode_columns(columns, len(patients), feature_names, out, dtype)
+
+
+def predict_with_ml_model(features, artifacts=None):
+    """
+    Predicts triage levels (1-5) for every row of an encoded feature matrix
+    with a single scaler/model call, using artifacts if given and otherwise
+    the process-wide model.
+    """
+    voting_model, scaler, feature_names = artifacts or get_artifacts()
+    prediction = voting_model.predict(_scale(features, scaler, feature_names))
+    return prediction.astype(int) + 1
+
+
+def predict_with_confidence(features, artifacts=None):
+    """
+    Like predict_with_ml_model, but returns (levels, confidences): each
+    confidence is the calibrated soft-vote probability of the predicted
+    level. confidences is None for models without soft voting (the pickled
+    scikit-learn ensemble votes hard only) and for exports without a
+    calibration, whose raw soft vote is not a probability to threshold.
+    """
+    voting_model, scaler, feature_names = artifacts or get_artifacts()
+    features_scaled = _scale(features, scaler, feature_names)
+    if not hasattr(voting_model, "predict_with_proba") or not voting_model.meta.get("calibration"):
+        return voting_model.predict(features_scaled).astype(int) + 1, None
+    prediction, proba = voting_model.predict_with_proba(features_scaled)
+    confidences = proba[np.arange(len(prediction)), np.searchsorted(voting_model.classes, prediction)]
+    return prediction.astype(int) + 1, confidences
+
+
+def _scale(features, scaler, feature_names):
+    features = np.asarray(features, dtype=np.float64)
+    if features.ndim == 1:
+        features = features.reshape(1, -1)
+    if hasattr(scaler, "feature_names_in_"):
+        # A scikit-learn scaler fitted on a DataFrame expects one back
+        import pandas as pd
+        features = pd.DataFrame(features, columns=feature_names)
+    return scaler.transform(features)
+
+
+def triage_batch(patients):
+    """
+    Triage many patients at once: fills defaults, encodes all of them into one
+    matrix and scores it with one vectorized model call. Returns a list of
+    dicts with the ML triage level and its confidence, model weight,
+    defaulted patient, nonzero encoded features by name and model version
+    for each patient.
+    """
+    if not patients:
+        return []
+
+    artifacts, version = get_model()
+    defaulted = [apply_input_defaults(p, has_image=p.get("has_image", False)) for p in patients]
+    features = encode_patients([patient for patient, _ in defaulted], artifacts[2])
+    levels, confidences = predict_with_confidence(features, artifacts)
+    if confidences is None:
+        confidences = [None] * len(levels)
+
+    feature_names = [str(name) for name in artifacts[2]]
+    return [
+        {"ml_triage_level": int(level), "ml_confidence": None if confidence is None else float(confidence),
+         "model_weight": model_weight, "patient": patient, "model_version": version,
+         "features": {name: float(value) for name, value in zip(feature_names, row) if value}}
+        for level, confidence, (patient, model_weight), row in zip(levels, confidences, defaulted,
+                                                                   np.atleast_2d(features))
+    ]
+
+
+def calculate_recommended_triage(groq_triage_level, ml_triage_level, model_weight):
+    """
+    Calculate the recommended triage level as a weighted average.
+    """
+    if model_weight < 0: model_weight = 0
+    groq_weight = 1 - model_weight
+    ml_weight = model_weight
+    recommended_triage = groq_weight * float(groq_triage_level) + ml_weight * float(ml_triage_level)
+    return math.floor(recommended_triage)  # Round to the nearest integer
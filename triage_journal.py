@@ -0,0 +1,287 @@
+import argparse
+import atexit
+import datetime
+import gzip
+import json
+import mmap
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+
+
+# Kept apart from the repo's own requests.jsonl (the change backlog)
+JOURNAL_DIR = os.environ.get("TRIAGE_JOURNAL_DIR", "triage_journal")
+ROTATE_BYTES = 64 * 1024 * 1024
+FLUSH_SECONDS = 1.0
+MAX_BATCH = 1000
+
+_journal = None
+_journal_lock = threading.Lock()
+_CLOSE = object()
+
+
+def _day(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y%m%d")
+
+
+def _compress(path):
+    with open(path, "rb") as src, gzip.open(path + ".gz.tmp", "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(path + ".gz.tmp", path + ".gz")
+    os.remove(path)
+
+
+class TriageJournal:
+    """
+    Append-only JSON-lines log of triage events. append() only queues the
+    event; a background thread serializes and writes batches every
+    flush_seconds, so the request path never waits on the disk. The active
+    file is triage-YYYYMMDD.jsonl (UTC). It is rotated when it passes
+    rotate_bytes or the day changes, and rotated files are gzipped.
+    """
+
+    def __init__(self, directory=JOURNAL_DIR, rotate_bytes=ROTATE_BYTES, flush_seconds=FLUSH_SECONDS):
+        self.directory = directory
+        self.rotate_bytes = rotate_bytes
+        self.flush_seconds = flush_seconds
+        os.makedirs(directory, exist_ok=True)
+        self._queue = queue.SimpleQueue()
+        self._file = None
+        self._file_day = None
+        self._thread = threading.Thread(target=self._run, name="triage-journal", daemon=True)
+        self._thread.start()
+
+    def append(self, event, **fields):
+        """
+        Queues one entry: {"ts": <unix time>, "event": event, **fields}.
+        """
+        self._queue.put({"ts": time.time(), "event": event, **fields})
+
+    def flush(self, timeout=None):
+        """
+        Waits until everything appended so far is written (or dropped after a
+        logged write error). Returns False on timeout or once closed.
+        """
+        done = threading.Event()
+        self._queue.put(done)
+        if not self._thread.is_alive():
+            return False  # Closed; nothing would ever set it
+        return done.wait(timeout)
+
+    def close(self, timeout=10):
+        if self._thread.is_alive():
+            self._queue.put(_CLOSE)
+            self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            self._loop()
+        finally:
+            # Whatever ended the loop, nobody may be left waiting in flush()
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _loop(self):
+        batch = []
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, self.flush_seconds - (time.monotonic() - last_flush)))
+            except queue.Empty:
+                item = None
+            if isinstance(item, dict):
+                batch.append(item)
+                if len(batch) < MAX_BATCH:
+                    continue
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    # A full disk or a failed rotation must not kill the writer:
+                    # this batch is lost, but later events and flush() still work
+                    print(f"Triage journal: could not write {len(batch)} entries: {type(e).__name__}: {e}",
+                          file=sys.stderr)
+                    self._discard_file()
+                batch = []
+            last_flush = time.monotonic()
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is _CLOSE:
+                if self._file is not None:
+                    self._file.close()
+                return
+
+    def _discard_file(self):
+        # Reopened (and rotated if due) by the next write
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+        self._file = None
+
+    def _write(self, batch):
+        data = "".join(json.dumps(entry, ensure_ascii=False, separators=(",", ":"), default=str) + "\n"
+                       for entry in batch).encode("utf-8")
+        day = _day(batch[0]["ts"])
+        full = self._file is not None and 0 < self._file.tell() and self._file.tell() + len(data) > self.rotate_bytes
+        if self._file is None or day != self._file_day or full:
+            self._rotate(day, full)
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _rotate(self, day, full):
+        if self._file is not None:
+            self._file.close()
+        active = os.path.join(self.directory, f"triage-{day}.jsonl")
+        # Earlier days' files, and today's once full, move aside under a
+        # time-stamped name and are compressed in the background
+        for path in journal_files(self.directory):
+            if len(os.path.basename(path)) != len("triage-YYYYMMDD.jsonl") or (path == active and not full):
+                continue
+            stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%H%M%S%f")
+            rotated = f"{path[:-len('.jsonl')]}-{stamp}.jsonl"
+            os.replace(path, rotated)
+            threading.Thread(target=_compress, args=(rotated,), name="triage-journal-gzip", daemon=True).start()
+        self._file = open(active, "ab")
+        self._file_day = day
+
+
+def journal_files(directory=JOURNAL_DIR):
+    """
+    Returns the journal files in write order, rotated ones before the active one of each day.
+    """
+    names = {name for name in os.listdir(directory)
+             if name.startswith("triage-") and (name.endswith(".jsonl") or name.endswith(".jsonl.gz"))}
+    # A rotated file is briefly there twice while its compression finishes
+    names = [name for name in names if name + ".gz" not in names]
+    # "triage-20260101-<time>.jsonl.gz" sorts before "triage-20260101.jsonl"
+    return [os.path.join(directory, name) for name in sorted(names)]
+
+
+def read_journal_file(path):
+    """
+    Yields the entries of one journal file. Plain files are memory-mapped
+    and split on newlines directly, without a buffered file object; a torn
+    last line (e.g. after a crash) is skipped.
+    """
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            for line in f:
+                if line.endswith(b"\n"):
+                    yield json.loads(line)
+        return
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = 0
+            while True:
+                end = data.find(b"\n", start)
+                if end == -1:
+                    return
+                yield json.loads(data[start:end])
+                start = end + 1
+
+
+def replay(directory=JOURNAL_DIR, since=None, event=None):
+    """
+    Yields every journal entry in write order, optionally only those at or
+    after the unix time since and of the given event type.
+    """
+    since_day = _day(since) if since is not None else None
+    for path in journal_files(directory):
+        if since_day is not None and os.path.basename(path)[len("triage-"):][:8] < since_day:
+            continue
+        for entry in read_journal_file(path):
+            if since is not None and entry["ts"] < since:
+                continue
+            if event is not None and entry["event"] != event:
+                continue
+            yield entry
+
+
+def summarize(entries):
+    """
+    Aggregates journal entries for an audit: counts by event, final level
+    distribution, how often the LLM was unavailable (by fallback reason) or
+    skipped by the bypass gate, how often the ML and LLM levels agreed, and how gated ML levels
+    compared with the LLM's (gate_audit entries).
+    """
+    summary = {"entries": 0, "events": {}, "levels": {}, "ml_only": 0, "fallback_reasons": {}, "llm_bypassed": 0,
+               "ml_llm_agree": 0, "ml_llm_compared": 0, "gate_agreement": {}, "first_ts": None, "last_ts": None}
+    for entry in entries:
+        summary["entries"] += 1
+        summary["events"][entry["event"]] = summary["events"].get(entry["event"], 0) + 1
+        if summary["first_ts"] is None:
+            summary["first_ts"] = entry["ts"]
+        summary["last_ts"] = entry["ts"]
+        if entry["event"] == "gate_audit":
+            agreement = entry["agreement"]
+            summary["gate_agreement"][agreement] = summary["gate_agreement"].get(agreement, 0) + 1
+        if "recommended_triage" not in entry:
+            continue
+        level = str(entry["recommended_triage"])
+        summary["levels"][level] = summary["levels"].get(level, 0) + 1
+        if entry.get("llm_bypassed"):
+            summary["llm_bypassed"] += 1
+        elif entry.get("ml_only"):
+            summary["ml_only"] += 1
+            reason = entry.get("fallback_reason") or "unknown"
+            summary["fallback_reasons"][reason] = summary["fallback_reasons"].get(reason, 0) + 1
+        elif entry.get("groq_triage_level") is not None:
+            summary["ml_llm_compared"] += 1
+            summary["ml_llm_agree"] += str(entry["groq_triage_level"]) == str(entry["ml_triage_level"])
+    return summary
+
+
+def get_journal():
+    """
+    Returns the process-wide journal, starting its writer thread on first use.
+    """
+    global _journal
+    if _journal is None:
+        with _journal_lock:
+            if _journal is None:
+                _journal = TriageJournal()
+                atexit.register(_journal.close)
+    return _journal
+
+
+def set_journal(journal):
+    """
+    Replaces the process-wide journal (e.g. with a throwaway directory for tests).
+    """
+    global _journal
+    with _journal_lock:
+        _journal = journal
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize the triage journal for an audit.")
+    parser.add_argument("--dir", default=JOURNAL_DIR)
+    parser.add_argument("--since", default=None, help="only entries from this UTC date on (YYYY-MM-DD)")
+    parser.add_argument("--event", default=None, help="only this event type, e.g. triage")
+    args = parser.parse_args(argv)
+
+    since = None
+    if args.since:
+        since = datetime.datetime.strptime(args.since, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc).timestamp()
+    start = time.perf_counter()
+    summary = summarize(replay(args.dir, since, args.event))
+    elapsed = time.perf_counter() - start
+    print(json.dumps(summary, indent=2))
+    print(f"Read {summary['entries']:,} entries in {elapsed:.2f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+import base64
+import json
+import re
+import time
+
+from triage_engine import convert_to_celsius
+
+
+VISION_MODEL = "llama-3.2-11b-vision-preview"
+TRIAGE_MODEL = "llama-3.3-70b-versatile"
+
+# Bumped whenever the prompt or answer format changes, so cached answers
+# from an older prompt are not replayed
+PROMPT_VERSION = 2
+VISION_PROMPT_VERSION = 1
+
+# Answers are short by design; the caps stop a rambling model from adding latency
+VISION_MAX_TOKENS = 200    # 2-5 sentences
+TRIAGE_MAX_TOKENS = 48     # {"level": N, "reason": "under 10 words"}
+MAX_REASON_CHARS = 200
+
+VISION_PROMPT = ("A person has come to the hospital and this is an image of them. Give a 2-5 sentence description of the injury/ailment/sickness that has led them to come to the hospital. A medical professional should be able to use your description in order to make decisions. If it is not clear what you see, say that. It is better to be not specific than wrong.")
+
+TRIAGE_SYSTEM_PROMPT = ("You triage emergency department patients. Level 1 is life threatening and needs "
+                        "immediate intervention; 5 is not life threatening in any way. Reply with JSON only: "
+                        "{\"level\": <1-5>, \"reason\": \"<one sentence, under 10 words>\"}. "
+                        "Do not give explicit medical advice.")
+
+SURGE_SYSTEM_PROMPT = ("You triage emergency department patients during a mass-casualty incident. Level 1 is life "
+                       "threatening and needs immediate intervention; 5 is not life threatening in any way. "
+                       "Triage each patient on their own. Reply with JSON only: {\"results\": [{\"id\": <id>, "
+                       "\"level\": <1-5>, \"reason\": \"<one sentence, under 10 words>\"}]} with one entry "
+                       "per patient. Do not give explicit medical advice.")
+SURGE_MAX_TOKENS_PER_PATIENT = 40
+
+# Defaults apply_input_defaults puts in for empty form fields
+_UNRECORDED = (None, 0, "No Selection", "Unknown", "No description", "No image provided.")
+
+_STREAMED_LEVEL = re.compile(r'"level"\s*:\s*"?([1-5])')
+_STREAMED_REASON = re.compile(r'"reason"\s*:\s*"((?:[^"\\]|\\.)*)')
+
+
+class TriageResponseError(ValueError):
+    """
+    The LLM answer could not be parsed into a level from 1 to 5 and a reason.
+    """
+
+
+def encode_image(jpeg):
+    """
+    Converts JPEG bytes (see image_prep.prepare_image) to a base64-encoded string.
+    """
+    return base64.b64encode(jpeg).decode('utf-8')
+
+
+def _usage(usage):
+    # Token counts as a plain dict, or None if the response did not include them
+    if usage is None:
+        return None
+    return {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+
+
+def analyze_image(client, jpeg):
+    """
+    Asks the vision model for a short clinical description of the patient
+    image. Returns (description, usage).
+    """
+    base64_image = encode_image(jpeg)
+    chat_completion = client.chat.completions.create(
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": VISION_PROMPT},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{base64_image}",
+                        },
+                    },
+                ],
+            }
+        ],
+        model=VISION_MODEL,
+        max_tokens=VISION_MAX_TOKENS,
+    )
+    return chat_completion.choices[0].message.content, _usage(getattr(chat_completion, "usage", None))
+
+
+def build_triage_query(patient, image_description):
+    """
+    Builds the LLM triage messages from a defaulted patient dict. The
+    instructions are a fixed system message and the patient goes in as
+    compact JSON, which takes far fewer tokens than prose. Fields the form
+    left empty are omitted rather than sent as their 0 / "No Selection"
+    defaults, which the model could read as real findings.
+    """
+    return [
+        {"role": "system", "content": TRIAGE_SYSTEM_PROMPT},
+        {"role": "user", "content": _compact_json(_patient_summary(patient, image_description))},
+    ]
+
+
+def _compact_json(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def _patient_summary(patient, image_description):
+    body_temperature_celsius = convert_to_celsius(patient["body_temperature"], patient["temp_unit"])
+    vitals = {
+        "description": patient["description"],
+        "image": image_description,
+        "pain": patient["pain_level"],
+        "bp": f"{patient['bp_systolic']}/{patient['bp_diastolic']}" if patient["bp_systolic"] else None,
+        "hr": patient["heart_rate"],
+        "spo2": patient["oxygen_saturation"],
+        "rr": patient["respiratory_rate"],
+        "temp_c": round(float(body_temperature_celsius), 1) if patient["body_temperature"] else None,
+        "sex": patient["sex"],
+        "consciousness": patient["consciousness"],
+        "transport": patient["transport"],
+    }
+    return {key: value for key, value in vitals.items() if value not in _UNRECORDED or key == "pain"}
+
+
+def build_surge_query(patients):
+    """
+    Builds one triage request for several patients, given as a list of
+    (patient_id, defaulted patient dict, image description) tuples. See
+    parse_surge_response for the answer.
+    """
+    summaries = [{"id": patient_id, **_patient_summary(patient, image_description)}
+                 for patient_id, patient, image_description in patients]
+    return [
+        {"role": "system", "content": SURGE_SYSTEM_PROMPT},
+        {"role": "user", "content": _compact_json(summaries)},
+    ]
+
+
+def request_surge_triage(client, query, n_patients, deadline=None):
+    """
+    Sends a build_surge_query request in JSON mode and returns (response, usage).
+    """
+    chat_completion = client.chat.completions.create(
+        messages=query,
+        model=TRIAGE_MODEL,
+        max_tokens=SURGE_MAX_TOKENS_PER_PATIENT * n_patients + 16,
+        response_format={"type": "json_object"},
+        **({"deadline": deadline} if deadline is not None else {}),
+    )
+    return chat_completion.choices[0].message.content, _usage(getattr(chat_completion, "usage", None))
+
+
+def parse_surge_response(response):
+    """
+    Returns {str(patient_id): (triage_level, triage_description)} for every
+    valid entry of a surge answer. Patients missing from the answer or with
+    an invalid entry are left out, for the caller to fall back on.
+    """
+    try:
+        answer = json.loads(response)
+        entries = answer["results"] if isinstance(answer, dict) else answer
+    except (ValueError, KeyError, TypeError):
+        raise TriageResponseError(f"Unreadable surge answer: {str(response)[:100]!r}") from None
+
+    results = {}
+    for entry in entries if isinstance(entries, list) else []:
+        try:
+            results[str(entry["id"])] = parse_triage_response(json.dumps(entry))
+        except (KeyError, TypeError, TriageResponseError):
+            continue
+    return results
+
+
+def request_llm_triage(client, query):
+    """
+    Sends the triage messages to the LLM in JSON mode and returns the raw
+    response and its token usage as (response, usage).
+    """
+    chat_completion = client.chat.completions.create(
+        messages=query,
+        model=TRIAGE_MODEL,
+        max_tokens=TRIAGE_MAX_TOKENS,
+        response_format={"type": "json_object"},
+    )
+    return chat_completion.choices[0].message.content, _usage(getattr(chat_completion, "usage", None))
+
+
+def parse_streamed_level(partial):
+    """
+    Returns the triage level from the first characters of a streamed
+    response, or None until the level has arrived.
+    """
+    match = _STREAMED_LEVEL.search(partial)
+    if match:
+        return match.group(1)
+    partial = partial.lstrip()
+    if partial and partial[0] in "12345":  # Older "N;reason" answers
+        return partial[0]
+    return None
+
+
+def _streamed_reason(partial):
+    match = _STREAMED_REASON.search(partial)
+    if match is None:
+        return partial.split(";", 1)[1].strip() if ";" in partial else None
+    try:
+        return json.loads(f'"{match.group(1)}"')
+    except ValueError:
+        return match.group(1)  # Cut off in the middle of an escape
+
+
+def stream_llm_triage(client, query, on_level=None, on_text=None):
+    """
+    Streams the triage completion. on_level(level) is called as soon as the
+    level arrives in the first tokens, and on_text(rationale) each time more
+    of the rationale arrives. Returns (response, timings, usage), where
+    timings has the seconds from the request to the first token
+    ("first_token"), to the level ("level") and to the end of the answer
+    ("total").
+
+    JSON mode cannot be streamed, so the JSON answer is asked for by the
+    prompt alone and checked by parse_triage_response afterwards.
+    """
+    start = time.perf_counter()
+    timings = {"first_token": None, "level": None, "total": None}
+    response = ""
+    level = None
+    usage = None
+    stream = client.chat.completions.create(
+        messages=query,
+        model=TRIAGE_MODEL,
+        max_tokens=TRIAGE_MAX_TOKENS,
+        stream=True,
+    )
+    for chunk in stream:
+        # Groq reports token usage on the final chunk
+        chunk_usage = getattr(chunk, "usage", None) or getattr(getattr(chunk, "x_groq", None), "usage", None)
+        if chunk_usage is not None:
+            usage = _usage(chunk_usage)
+        piece = chunk.choices[0].delta.content if chunk.choices else None
+        if not piece:
+            continue
+        if timings["first_token"] is None:
+            timings["first_token"] = time.perf_counter() - start
+        response += piece
+        if level is None:
+            level = parse_streamed_level(response)
+            if level is not None:
+                timings["level"] = time.perf_counter() - start
+                if on_level is not None:
+                    on_level(level)
+        if level is not None and on_text is not None:
+            reason = _streamed_reason(response)
+            if reason:
+                on_text(reason)
+    timings["total"] = time.perf_counter() - start
+    return response, timings, usage
+
+
+def parse_triage_response(response):
+    """
+    Validates a {"level": N, "reason": "..."} answer and returns
+    (triage_level, triage_description), with the level as "1" to "5".
+    Older "N;reason" answers are accepted too. Raises TriageResponseError
+    for anything else.
+    """
+    text = (response or "").strip()
+    try:
+        answer = json.loads(text[text.index("{"):text.rindex("}") + 1])
+        level, reason = answer["level"], answer.get("reason", "")
+    except (ValueError, KeyError, TypeError):
+        level, _, reason = text.partition(";")
+
+    try:
+        level = int(str(level).strip())
+    except ValueError:
+        raise TriageResponseError(f"No triage level in LLM answer: {text[:100]!r}") from None
+    if not 1 <= level <= 5:
+        raise TriageResponseError(f"Triage level out of range in LLM answer: {level}")
+    return str(level), str(reason).strip()[:MAX_REASON_CHARS]
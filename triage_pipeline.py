@@ -0,0 +1,283 @@
+import hashlib
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import llm_gate
+import metrics
+from groq_client import LLMUnavailableError
+from image_prep import ImageError, perceptual_hash, prepare_image
+from llm_cache import get_llm_cache, make_cache_key
+from triage_engine import calculate_recommended_triage, encode_patient, get_model, predict_with_confidence
+from triage_llm import (PROMPT_VERSION, TRIAGE_MODEL, VISION_MODEL, VISION_PROMPT_VERSION, TriageResponseError,
+                        analyze_image, build_triage_query, parse_triage_response, request_llm_triage,
+                        stream_llm_triage)
+from vision_cache import get_vision_cache
+
+
+# Remote calls spend their time waiting on the network, so a small shared pool
+# is enough to overlap them across every session in the process.
+MAX_WORKERS = 8
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the process-wide thread pool used to run triage stages concurrently.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="triage")
+    return _executor
+
+
+def _ml_stage(patient):
+    # Returns (level, confidence, nonzero encoded features by name, stage
+    # timings, model version). The model is taken once, so a hot reload
+    # mid-request cannot mix versions
+    timings = {}
+    artifacts, version = get_model()
+    feature_names = artifacts[2]
+    with metrics.span("feature_encode", timings):
+        features = encode_patient(patient, feature_names)
+    with metrics.span("ml_predict", timings):
+        levels, confidences = predict_with_confidence(features, artifacts)
+    confidence = None if confidences is None else float(confidences[0])
+    features = {str(name): float(value) for name, value in zip(feature_names, features[0]) if value}
+    return int(levels[0]), confidence, features, timings, version
+
+
+def describe_image(client, image, timings=None):
+    """
+    Prepares a photo and returns (prepared, description, usage, cached). A
+    photo matching one described within the vision cache's TTL (see
+    VisionCache.get) reuses that description, with usage None, instead of
+    another vision call.
+    Stage timings are added to timings, if given.
+    """
+    with metrics.span("image_prepare", timings):
+        prepared = prepare_image(image)
+        phash = perceptual_hash(prepared["image"])
+        digest = hashlib.sha256(prepared["jpeg"]).hexdigest()
+    if prepared["bytes_before"] is not None:
+        metrics.observe("triage_payload_bytes", prepared["bytes_before"], metrics.SIZE_BUCKETS, kind="image_upload")
+    cache = get_vision_cache()
+    namespace = f"{VISION_MODEL}:{VISION_PROMPT_VERSION}"
+    description = cache.get(namespace, phash, digest)
+    metrics.inc("triage_cache_requests_total", cache="vision", result="miss" if description is None else "hit")
+    if description is not None:
+        return prepared, description, None, True
+    metrics.observe("triage_payload_bytes", prepared["bytes_after"], metrics.SIZE_BUCKETS, kind="image_sent")
+    with metrics.span("vision_call", timings):
+        description, usage = analyze_image(client, prepared["jpeg"])
+    cache.set(namespace, phash, digest, description)
+    return prepared, description, usage, False
+
+
+def _llm_stage(client, patient, image, emit=None):
+    # The text prompt needs the image description, so it starts as soon as
+    # the vision call (if any) returns.
+    # With emit, the completion is streamed and emit(kind, value) reports
+    # the level and the growing rationale as they arrive.
+    image_description = "No image provided."
+    image_stats = None
+    vision_cached = False
+    usage = {"vision": None, "triage": None}
+    timings = {}
+    if image is not None:
+        prepared, image_description, usage["vision"], vision_cached = describe_image(client, image, timings)
+        image_stats = {key: prepared[key] for key in ("bytes_before", "bytes_after", "size_before", "size_after")}
+
+    # Double-clicks, reruns and re-triage of the same patient reuse the last answer
+    cache = get_llm_cache()
+    cache_key = make_cache_key(TRIAGE_MODEL, {"prompt_version": PROMPT_VERSION, "patient": patient,
+                                              "image_description": image_description})
+    response = cache.get(cache_key)
+    llm_cached = response is not None
+    metrics.inc("triage_cache_requests_total", cache="llm", result="hit" if llm_cached else "miss")
+    llm_timings = None
+    if not llm_cached:
+        query = build_triage_query(patient, image_description)
+        metrics.observe("triage_payload_bytes", len(json.dumps(query)), metrics.SIZE_BUCKETS, kind="prompt")
+        with metrics.span("llm_call", timings):
+            if emit is None:
+                response, usage["triage"] = request_llm_triage(client, query)
+            else:
+                response, llm_timings, usage["triage"] = stream_llm_triage(
+                    client, query, on_level=lambda level: emit("level", level),
+                    on_text=lambda text: emit("text", text))
+    with metrics.span("parse", timings):
+        groq_triage_level, groq_triage_description = parse_triage_response(response)
+    if not llm_cached:
+        # Only well-formed responses are worth replaying
+        cache.set(cache_key, response)
+    return {
+        "image_description": image_description,
+        "image_stats": image_stats,
+        "vision_cached": vision_cached,
+        "llm_cached": llm_cached,
+        "llm_timings": llm_timings,
+        "llm_usage": usage,
+        "stage_timings": timings,
+        "groq_triage_level": groq_triage_level,
+        "groq_triage_description": groq_triage_description,
+    }
+
+
+def start_triage(client, patient, image=None, emit=None):
+    """
+    Starts the ML prediction and the vision -> LLM chain side by side and
+    returns (ml_future, llm_future, gate) without waiting on the LLM. image
+    may be the raw uploaded bytes or a PIL.Image. With emit, the LLM answer
+    is streamed and emit(kind, value) is called from the worker thread with
+    ("level", level) and then ("text", rationale so far).
+
+    With the LLM bypass gate on and no image (the only case the gate can
+    skip the LLM), the LLM is only started once the ML level is known (the
+    model takes about a millisecond), and llm_future is None when the gate
+    skips it. Otherwise the LLM starts right away, alongside the model.
+    gate is llm_gate.decide()'s answer, or None with the gate off.
+    """
+    executor = get_executor()
+    ml_future = executor.submit(_ml_stage, patient)
+    llm_future = None
+    if llm_gate.GATE_MODE != "on" or image is not None:
+        llm_future = executor.submit(_llm_stage, client, patient, image, emit)
+    gate = None
+    if llm_gate.GATE_MODE != "off":
+        gate = gate_llm(client, patient, image, *ml_future.result()[:2])
+        if gate["bypass"]:
+            return ml_future, None, gate
+    if llm_future is None:
+        llm_future = executor.submit(_llm_stage, client, patient, image, emit)
+    return ml_future, llm_future, gate
+
+
+def gate_llm(client, patient, image, ml_triage_level, ml_confidence):
+    """
+    Asks the LLM bypass gate whether a patient can skip the LLM given its
+    ML level and confidence, and returns llm_gate.decide()'s answer, or None
+    with the gate off. A bypass picked for audit still calls the LLM in the
+    background to record how its level compares.
+    """
+    if llm_gate.GATE_MODE == "off":
+        return None
+    gate = llm_gate.decide(patient, image is not None, ml_triage_level, ml_confidence)
+    if gate["bypass"] and gate["audit"]:
+        audit_future = get_executor().submit(_llm_stage, client, patient, image)
+        audit_future.add_done_callback(lambda future: _record_audit(future, ml_triage_level, ml_confidence))
+    return gate
+
+
+def skipped_llm_error(ml_confidence):
+    # llm_error of a result whose LLM call the gate skipped
+    return f"LLM skipped: ML confidence {ml_confidence:.0%} for a low-acuity patient with vitals in the safe range"
+
+
+def _record_audit(future, ml_triage_level, ml_confidence):
+    # A bypassed submit's background LLM call; a failure only loses the sample
+    if future.exception() is None:
+        llm_gate.record_agreement(ml_triage_level, future.result()["groq_triage_level"], "audit",
+                                  ml_confidence=ml_confidence)
+
+
+def _ml_only_result(llm_error, fallback_reason=None):
+    # fallback_reason names the error that made the LLM unavailable (e.g.
+    # RateLimitBudgetError), so the journal can tell fallbacks apart
+    return {
+        "image_description": None,
+        "image_stats": None,
+        "vision_cached": False,
+        "llm_cached": False,
+        "llm_timings": None,
+        "llm_usage": None,
+        "stage_timings": {},
+        "groq_triage_level": None,
+        "groq_triage_description": None,
+        "ml_only": True,
+        "llm_error": llm_error,
+        "fallback_reason": fallback_reason,
+    }
+
+
+def run_triage(client, patient, image=None, on_ml_level=None, on_llm_level=None, on_llm_text=None):
+    """
+    Runs all triage stages concurrently and returns the combined result.
+    on_ml_level, if given, is called with the ML level as soon as it is
+    available, while the remote calls are still in flight. Passing
+    on_llm_level or on_llm_text streams the LLM answer: they are called
+    with the LLM level as soon as its first tokens arrive and with the
+    rationale as it grows, and "llm_timings" holds time to first token,
+    time to level and total time. All callbacks run on the calling thread.
+    "stage_timings" has the seconds each stage took, "features" the
+    patient's nonzero encoded features and "model_version" the ML model
+    version that scored them.
+
+    If the LLM is unavailable (deadline exceeded, retries exhausted,
+    circuit breaker open or the request rejected), its answer is not a
+    valid triage level or the photo cannot be read, the result is ML-only:
+    "ml_only" is True, the groq_* fields are None and "llm_error" says why.
+
+    If the LLM bypass gate (see llm_gate) skips the LLM for a confident,
+    low-acuity patient, the result is ML-only as well, with "llm_bypassed"
+    True. "ml_confidence" is the ML level's soft-vote probability and
+    "gate_reason" the gate's reason (None with the gate off).
+    """
+    events = None
+    if on_llm_level is not None or on_llm_text is not None:
+        events = queue.Queue()
+    ml_future, llm_future, gate = start_triage(client, patient, image,
+                                               emit=None if events is None else lambda *event: events.put(event))
+    ml_triage_level, ml_confidence, features, ml_timings, model_version = ml_future.result()
+    if on_ml_level is not None:
+        on_ml_level(ml_triage_level)
+    if llm_future is None:
+        result = _ml_only_result(skipped_llm_error(ml_confidence))
+    else:
+        if events is not None:
+            # Relay streamed events to the caller's thread (Streamlit elements
+            # can only be updated from the script thread)
+            llm_future.add_done_callback(lambda future: events.put(("done", None)))
+            callbacks = {"level": on_llm_level, "text": on_llm_text}
+            for kind, value in iter(events.get, ("done", None)):
+                if callbacks[kind] is not None:
+                    callbacks[kind](value)
+        try:
+            result = llm_future.result()
+            result["ml_only"] = False
+        except (LLMUnavailableError, TriageResponseError, ImageError) as e:
+            metrics.inc("triage_fallbacks_total", reason=type(e).__name__)
+            result = _ml_only_result(str(e), type(e).__name__)
+        if gate is not None and gate["would_bypass"]:
+            llm_gate.record_agreement(ml_triage_level, result["groq_triage_level"], "shadow",
+                                      ml_confidence=ml_confidence)
+    result["llm_bypassed"] = llm_future is None
+    result["ml_confidence"] = ml_confidence
+    result["gate_reason"] = None if gate is None else gate["reason"]
+    result["ml_triage_level"] = ml_triage_level
+    result["features"] = features
+    result["model_version"] = model_version
+    result["stage_timings"] = dict(ml_timings, **result["stage_timings"])
+    return result
+
+
+def recommend(result, model_weight):
+    """
+    Returns (recommended_triage, model_weight, rationale) for a run_triage
+    result: the weighted ML/LLM level, or the ML level alone (with weight
+    1.0) when the LLM was skipped or gave no answer.
+    """
+    if result["llm_bypassed"]:
+        # Confident low-acuity case with safe vitals; the LLM was not asked
+        return result["ml_triage_level"], 1.0, "ML-only triage (confident low-acuity case, LLM skipped)"
+    if result["ml_only"]:
+        # The LLM is down or timed out; triage on the ML model alone rather than block
+        return result["ml_triage_level"], 1.0, "ML-only triage (LLM unavailable)"
+    recommended_triage = calculate_recommended_triage(result["groq_triage_level"], result["ml_triage_level"],
+                                                      model_weight)
+    return recommended_triage, model_weight, result["groq_triage_description"]
@@ -0,0 +1,176 @@
+import json
+import os
+import threading
+import time
+
+from sqlalchemy import (Column, Float, ForeignKey, Index, Integer, MetaData, SmallInteger, String, Table, Text,
+                        create_engine, event, func, insert, select, tuple_, update)
+
+
+DATABASE_URL = os.environ.get("TRIAGE_DB_URL", "sqlite:///triage_queue.sqlite3")
+PAGE_SIZE = 20
+
+metadata = MetaData()
+
+triage_requests = Table(
+    "triage_requests", metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("triage_level", SmallInteger, nullable=False),
+    Column("description", Text, nullable=False),
+    Column("triage_description", Text, nullable=False),
+    Column("created_by", String(64)),
+    Column("arrived_at", Float, nullable=False),
+    Column("resolved_at", Float),
+    Column("resolved_by", String(64)),
+)
+
+# The sidebar reads open requests by (level, arrival); a partial index keeps
+# that walk proportional to the open queue, not to every request ever made
+Index("ix_triage_requests_open", triage_requests.c.triage_level, triage_requests.c.arrived_at,
+      triage_requests.c.id,
+      sqlite_where=triage_requests.c.resolved_at.is_(None),
+      postgresql_where=triage_requests.c.resolved_at.is_(None))
+Index("ix_triage_requests_arrived_at", triage_requests.c.arrived_at)
+
+# The encoded features of each request and, once a clinician resolves it,
+# the level they confirmed: the training data for incremental learning
+triage_outcomes = Table(
+    "triage_outcomes", metadata,
+    Column("request_id", Integer, ForeignKey("triage_requests.id"), primary_key=True),
+    Column("features", Text, nullable=False),  # JSON {feature name: value}, zeros left out
+    Column("model_version", String(64)),
+    Column("ml_triage_level", SmallInteger),
+    Column("confirmed_level", SmallInteger),
+    Column("confirmed_at", Float),
+)
+Index("ix_triage_outcomes_confirmed", triage_outcomes.c.confirmed_at, triage_outcomes.c.request_id)
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+class TriageQueue:
+    """
+    Triage requests shared by every session, ordered by level (1 first) and
+    then arrival time. Resolved requests are kept for the record but leave
+    the open queue.
+    """
+
+    def __init__(self, url=DATABASE_URL):
+        self.url = url
+        connect_args = {"check_same_thread": False} if url.startswith("sqlite") else {}
+        self.engine = create_engine(url, connect_args=connect_args, pool_pre_ping=True)
+        if self.engine.dialect.name == "sqlite":
+            event.listen(self.engine, "connect", _sqlite_pragmas)
+        metadata.create_all(self.engine)
+
+    def add(self, triage_level, description, triage_description, created_by=None, features=None,
+            model_version=None, ml_triage_level=None):
+        """
+        Adds an open request and returns its ID. With features (the encoded
+        features by name), the request can later feed incremental learning.
+        """
+        with self.engine.begin() as conn:
+            result = conn.execute(insert(triage_requests).values(
+                triage_level=int(triage_level),
+                description=description,
+                triage_description=triage_description,
+                created_by=created_by,
+                arrived_at=time.time(),
+            ))
+            request_id = result.inserted_primary_key[0]
+            if features is not None:
+                conn.execute(insert(triage_outcomes).values(
+                    request_id=request_id,
+                    features=json.dumps(features, separators=(",", ":")),
+                    model_version=model_version,
+                    ml_triage_level=ml_triage_level,
+                ))
+            return request_id
+
+    def resolve(self, request_id, resolved_by=None, confirmed_level=None):
+        """
+        Resolves an open request, recording confirmed_level as the level the
+        clinician confirmed, if given. Returns False if it was already
+        resolved (e.g. from another workstation) or does not exist.
+        """
+        now = time.time()
+        with self.engine.begin() as conn:
+            result = conn.execute(
+                update(triage_requests)
+                .where(triage_requests.c.id == request_id, triage_requests.c.resolved_at.is_(None))
+                .values(resolved_at=now, resolved_by=resolved_by)
+            )
+            if result.rowcount == 1 and confirmed_level is not None:
+                conn.execute(
+                    update(triage_outcomes)
+                    .where(triage_outcomes.c.request_id == request_id)
+                    .values(confirmed_level=int(confirmed_level), confirmed_at=now)
+                )
+            return result.rowcount == 1
+
+    def confirmed_outcomes(self, after=(0.0, 0), limit=None):
+        """
+        Returns confirmed outcomes as dicts with the features decoded, in
+        confirmation order, after the (confirmed_at, request_id) cursor.
+        """
+        query = (
+            select(triage_outcomes)
+            .where(triage_outcomes.c.confirmed_at.is_not(None),
+                   tuple_(triage_outcomes.c.confirmed_at, triage_outcomes.c.request_id) > tuple_(*after))
+            .order_by(triage_outcomes.c.confirmed_at, triage_outcomes.c.request_id)
+            .limit(limit)
+        )
+        with self.engine.connect() as conn:
+            return [dict(row, features=json.loads(row["features"])) for row in conn.execute(query).mappings()]
+
+    def open_requests(self, page=0, page_size=PAGE_SIZE):
+        """
+        Returns one page of open requests as dicts, most urgent first.
+        """
+        query = (
+            select(triage_requests.c.id, triage_requests.c.triage_level, triage_requests.c.description,
+                   triage_requests.c.triage_description, triage_requests.c.created_by,
+                   triage_requests.c.arrived_at)
+            .where(triage_requests.c.resolved_at.is_(None))
+            .order_by(triage_requests.c.triage_level, triage_requests.c.arrived_at, triage_requests.c.id)
+            .limit(page_size)
+            .offset(page * page_size)
+        )
+        with self.engine.connect() as conn:
+            return [dict(row) for row in conn.execute(query).mappings()]
+
+    def count_open(self):
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select(func.count()).select_from(triage_requests)
+                .where(triage_requests.c.resolved_at.is_(None))
+            ).scalar_one()
+
+
+def get_triage_queue():
+    """
+    Returns the process-wide triage queue, connecting on first use.
+    """
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = TriageQueue()
+    return _queue
+
+
+def set_triage_queue(queue):
+    """
+    Replaces the process-wide queue (e.g. with a throwaway database for tests).
+    """
+    global _queue
+    with _queue_lock:
+        _queue = queue
@@ -0,0 +1,408 @@
+import argparse
+import base64
+import binascii
+import hmac
+import json
+import math
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import groq_client
+import metrics
+import triage_engine
+import triage_journal
+from surge import run_surge
+from triage_engine import FAHRENHEIT, PATIENT_FIELDS, apply_input_defaults, triage_batch
+from triage_pipeline import recommend, run_triage
+
+
+# JSON scoring API for machine clients such as an EHR interface engine. The
+# parent process loads the model and forks WORKERS processes that accept on
+# one shared socket, so the memory-mapped model is loaded once and its pages
+# are shared by every worker.
+HOST = os.environ.get("TRIAGE_SERVICE_HOST", "127.0.0.1")
+PORT = int(os.environ.get("TRIAGE_SERVICE_PORT", "8080"))
+WORKERS = int(os.environ.get("TRIAGE_SERVICE_WORKERS", str(os.cpu_count() or 1)))
+# Requests a worker runs at once. With the LLM on, each can wait up to the
+# Groq deadline, so past this a worker answers 503 rather than pile up threads
+MAX_CONCURRENT = int(os.environ.get("TRIAGE_SERVICE_CONCURRENCY", "16"))
+# When set, clients must send "Authorization: Bearer <token>"
+API_TOKEN = os.environ.get("TRIAGE_SERVICE_TOKEN")
+# Without a Groq key every answer is ML-only
+GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
+BACKLOG = 1024
+MAX_BODY_BYTES = 16 * 1024 * 1024  # Room for a few photos
+MAX_BATCH = 1000
+KEEPALIVE_SECONDS = 5.0  # Idle keep-alive connections are closed after this
+RESPAWN_DELAY_SECONDS = 1.0
+BUSY_RETRY_AFTER_SECONDS = 1  # Retry-After of a 503 from a saturated worker
+CREATED_BY = "api"  # created_by of journal entries written by the service
+
+NUMERIC_FIELDS = {"age", "pain_level", "bp_systolic", "bp_diastolic", "heart_rate", "oxygen_saturation",
+                  "respiratory_rate", "body_temperature"}
+TEXT_FIELDS = set(PATIENT_FIELDS) - NUMERIC_FIELDS
+# The submit form's input limits; values outside them are rejected
+VITAL_RANGES = {"age": (0, 120), "pain_level": (0, 10), "bp_systolic": (50, 250), "bp_diastolic": (30, 150),
+                "heart_rate": (30, 220), "oxygen_saturation": (50, 100), "respiratory_rate": (10, 40)}
+TEMPERATURE_RANGES = {"Celsius": (30.0, 42.0), "Fahrenheit": (86.0, 107.6)}
+
+
+class RequestError(Exception):
+    """
+    A request the service cannot answer; status is the HTTP status to reply
+    with, and retry_after (seconds) is sent as Retry-After if given.
+    """
+
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def read_patient(record, where="patient"):
+    """
+    Validates one patient object of a request body and returns (patient,
+    image), where image is the decoded "image" field (base64 JPEG or PNG) or
+    None. Fields are those of the submit form; missing or null ones are
+    defaulted as on the form, and numbers must be within the form's limits.
+    """
+    if not isinstance(record, dict):
+        raise RequestError(400, f"{where} must be an object")
+    unknown = set(record) - set(PATIENT_FIELDS) - {"image"}
+    if unknown:
+        raise RequestError(400, f"{where} has unknown fields {sorted(unknown)}")
+    for field in NUMERIC_FIELDS:
+        value = record.get(field)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))
+                                  or not math.isfinite(value)):
+            raise RequestError(400, f"{where}.{field} must be a number or null")
+    for field in TEXT_FIELDS:
+        if not isinstance(record.get(field, ""), (str, type(None))):
+            raise RequestError(400, f"{where}.{field} must be a string or null")
+    unit = "Fahrenheit" if record.get("temp_unit") == FAHRENHEIT else "Celsius"
+    for field, (low, high) in dict(VITAL_RANGES, body_temperature=TEMPERATURE_RANGES[unit]).items():
+        value = record.get(field)
+        if value is not None and not low <= value <= high:
+            units = f" in {unit}" if field == "body_temperature" else ""
+            raise RequestError(400, f"{where}.{field} must be between {low} and {high}{units}")
+    image = record.get("image")
+    if image is not None:
+        try:
+            image = base64.b64decode(image, validate=True)
+        except (binascii.Error, TypeError, ValueError):
+            raise RequestError(400, f"{where}.image must be base64") from None
+    return {field: record.get(field) for field in PATIENT_FIELDS}, image
+
+
+def _ml_only(scored, reason):
+    return dict(scored, groq_triage_level=None, groq_triage_description=None,
+                recommended_triage=scored["ml_triage_level"], model_weight=1.0, ml_only=True, llm_bypassed=False,
+                llm_error=reason, fallback_reason=reason, rationale=f"ML-only triage ({reason})")
+
+
+def _public(result):
+    # The stable response fields; the journal keeps the full result
+    llm_level = result["groq_triage_level"]
+    return {
+        "recommended_triage": int(result["recommended_triage"]),
+        "ml_triage_level": int(result["ml_triage_level"]),
+        "ml_confidence": result["ml_confidence"],
+        "llm_triage_level": None if llm_level is None else int(llm_level),
+        "rationale": result["rationale"],
+        "model_weight": result["model_weight"],
+        "model_version": result["model_version"],
+        "ml_only": result["ml_only"],
+        "llm_bypassed": result["llm_bypassed"],
+        "llm_error": result.get("llm_error"),
+    }
+
+
+def triage_one(client, patient, image=None, no_llm_reason="LLM not requested"):
+    """
+    Triages one patient like a submit on the form: the ML level, the LLM
+    level (unless the bypass gate skips it) and the weighted
+    recommendation. With client None the result is ML-only, with
+    no_llm_reason as its llm_error. Returns the full result, journaled as a
+    "triage" entry.
+    """
+    if client is None:
+        result = _ml_only(triage_batch([dict(patient, has_image=image is not None)])[0], no_llm_reason)
+    else:
+        patient, model_weight = apply_input_defaults(patient, has_image=image is not None)
+        result = run_triage(client, patient, image)
+        recommended_triage, model_weight, rationale = recommend(result, model_weight)
+        result.update(patient=patient, model_weight=model_weight, recommended_triage=recommended_triage,
+                      rationale=rationale)
+    triage_journal.get_journal().append("triage", created_by=CREATED_BY, has_image=image is not None, **result)
+    return result
+
+
+def triage_many(client, patients, images=None, no_llm_reason="LLM not requested"):
+    """
+    Triages a batch in one vectorized ML call and, with a client, packed LLM
+    calls as in surge mode, on the pack pool every batch request of the
+    worker shares (see surge.get_pack_executor). Each patient goes through
+    the same bypass gate as a single request, and only those it does not
+    skip are sent to the LLM. images maps a patient's index to its image.
+    Returns the results in input order, each journaled as a "triage" entry.
+    """
+    images = images or {}
+    scored = triage_batch([dict(patient, has_image=i in images) for i, patient in enumerate(patients)])
+    if client is None:
+        results = [_ml_only(result, no_llm_reason) for result in scored]
+    else:
+        results = run_surge(client, patients, images, scored=scored)
+    journal = triage_journal.get_journal()
+    for i, result in enumerate(results):
+        journal.append("triage", created_by=CREATED_BY, has_image=i in images, batch_size=len(results), **result)
+    return results
+
+
+class TriageServer(ThreadingHTTPServer):
+    """
+    One worker's HTTP server, accepting on a socket shared with the other
+    workers. At most max_concurrent requests run at once; drain() fails
+    the readiness probe and stops accepting, and requests already running
+    finish first.
+    """
+
+    daemon_threads = False  # server_close() waits for running requests
+    allow_reuse_address = True
+
+    def __init__(self, sock, worker, client=None, max_concurrent=MAX_CONCURRENT):
+        super().__init__(sock.getsockname()[:2], TriageHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.worker = worker
+        self.client = client
+        self.max_concurrent = max_concurrent
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.draining = False
+
+    def drain(self):
+        self.draining = True
+        # shutdown() waits for serve_forever() to return, so it cannot run on its thread
+        threading.Thread(target=self.shutdown, name="triage-service-drain", daemon=True).start()
+
+
+class TriageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so interface engines reuse connections
+    timeout = KEEPALIVE_SECONDS
+
+    def log_message(self, format, *args):
+        pass  # Hundreds of requests a second would flood the log; see the metrics instead
+
+    def _send_json(self, status, body, retry_after=None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if retry_after is not None:
+            self.send_header("Retry-After", str(retry_after))
+        if self.server.draining:
+            self.close_connection = True
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/healthz":
+            self._send_json(200, {"status": "ok", "worker": self.server.worker, "pid": os.getpid()})
+        elif path == "/readyz":
+            if self.server.draining:
+                self._send_json(503, {"status": "draining", "worker": self.server.worker})
+                return
+            self._send_json(200, {"status": "ready", "worker": self.server.worker,
+                                  "model_version": triage_engine.get_model_version(),
+                                  "llm": self.server.client is not None})
+        else:
+            self._send_json(404, {"error": f"Unknown path {path}"})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        path = self.path.split("?")[0]
+        endpoint = ROUTES.get(path)
+        retry_after = None
+        try:
+            if endpoint is None:
+                raise RequestError(404, f"Unknown path {path}")
+            self._check_token()
+            if not self.server.slots.acquire(blocking=False):
+                self.close_connection = True  # The body is left unread
+                raise RequestError(503, f"Worker busy with {self.server.max_concurrent} requests",
+                                   retry_after=BUSY_RETRY_AFTER_SECONDS)
+            try:
+                status, body = 200, endpoint(self.server.client, self._read_json())
+            finally:
+                self.server.slots.release()
+        except RequestError as e:
+            status, body, retry_after = e.status, {"error": str(e)}, e.retry_after
+        except Exception as e:
+            traceback.print_exc()
+            status, body = 500, {"error": f"{type(e).__name__}: {e}"}
+        self._send_json(status, body, retry_after)
+        label = path if endpoint is not None else "other"
+        metrics.inc("triage_http_requests_total", endpoint=label, status=status)
+        metrics.observe("triage_http_request_seconds", time.perf_counter() - start, endpoint=label)
+
+    def _check_token(self):
+        if API_TOKEN is None:
+            return
+        supplied = self.headers.get("Authorization", "")
+        if not hmac.compare_digest(supplied.encode("utf-8"), f"Bearer {API_TOKEN}".encode("utf-8")):
+            self.close_connection = True  # The body is left unread
+            raise RequestError(401, "Missing or wrong bearer token")
+
+    def _read_json(self):
+        length = self.headers.get("Content-Length")
+        if length is None or not length.isdigit():
+            self.close_connection = True
+            raise RequestError(411, "Content-Length is required")
+        if int(length) > MAX_BODY_BYTES:
+            self.close_connection = True
+            raise RequestError(413, f"Request body over {MAX_BODY_BYTES} bytes")
+        try:
+            return json.loads(self.rfile.read(int(length)))
+        except ValueError:
+            raise RequestError(400, "Request body is not valid JSON") from None
+
+
+def _llm_client(client, body):
+    # Returns (client or None, why the LLM is not used). "llm": false asks
+    # for the ML level alone; by default the LLM is used when configured
+    if not isinstance(body, dict):
+        raise RequestError(400, "Request body must be an object")
+    use_llm = body.get("llm", True)
+    if not isinstance(use_llm, bool):
+        raise RequestError(400, "llm must be true or false")
+    if not use_llm:
+        return None, "LLM not requested"
+    return client, "LLM not configured"
+
+
+def handle_triage(client, body):
+    client, no_llm_reason = _llm_client(client, body)
+    patient, image = read_patient(body.get("patient"))
+    return _public(triage_one(client, patient, image, no_llm_reason))
+
+
+def handle_batch(client, body):
+    client, no_llm_reason = _llm_client(client, body)
+    records = body.get("patients")
+    if not isinstance(records, list) or not records:
+        raise RequestError(400, "patients must be a non-empty list")
+    if len(records) > MAX_BATCH:
+        raise RequestError(413, f"At most {MAX_BATCH} patients per batch")
+    patients, images = [], {}
+    for i, record in enumerate(records):
+        patient, image = read_patient(record, f"patients[{i}]")
+        patients.append(patient)
+        if image is not None:
+            images[i] = image
+    return {"results": [_public(result) for result in triage_many(client, patients, images, no_llm_reason)]}
+
+
+ROUTES = {
+    "/v1/triage": handle_triage,
+    "/v1/triage/batch": handle_batch,
+}
+
+
+def _run_worker(sock, worker, workers):
+    # Ctrl+C reaches the whole process group; the parent drains the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    client = None
+    if GROQ_API_KEY:
+        # Each worker keeps to its share of the account's Groq limits, if configured
+        client = groq_client.get_groq_client(GROQ_API_KEY, limiter=groq_client.make_rate_limiter(workers))
+    server = TriageServer(sock, worker, client)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.drain())
+    # Journal files are not shared between processes, so each worker writes its own directory
+    journal = triage_journal.TriageJournal(os.path.join(triage_journal.JOURNAL_DIR, f"service-{worker}"))
+    triage_journal.set_journal(journal)
+    triage_engine.start_model_watcher()
+    metrics.start_exporter(port=metrics.METRICS_PORT and metrics.METRICS_PORT + worker,
+                           path=metrics.METRICS_FILE and f"{metrics.METRICS_FILE}.{worker}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        journal.close()
+
+
+def _spawn(sock, worker, workers):
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 1
+    try:
+        _run_worker(sock, worker, workers)
+        code = 0
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        os._exit(code)  # Never return into the parent's loop
+
+
+def serve(host=HOST, port=PORT, workers=WORKERS, log=sys.stderr):
+    """
+    Loads and warms the model, then runs workers pre-forked processes on
+    host:port until SIGTERM or SIGINT, restarting any worker that dies.
+    On shutdown every worker drains its running requests first.
+    """
+    # Loaded before forking, so the workers share the model's pages
+    triage_engine.warm_up()
+    sock = socket.create_server((host, port), backlog=BACKLOG)
+    children = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker in range(workers):
+        children[_spawn(sock, worker, workers)] = worker
+    print(f"Triage service on http://{host}:{sock.getsockname()[1]} with {workers} workers "
+          f"(model {triage_engine.get_model_version()}, LLM {'on' if GROQ_API_KEY else 'off'})", file=log)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker = children.pop(pid, None)
+        if worker is None or stopping:
+            continue
+        print(f"Worker {worker} (pid {pid}) exited with status {status}; restarting", file=log)
+        time.sleep(RESPAWN_DELAY_SECONDS)
+        if not stopping:
+            children[_spawn(sock, worker, workers)] = worker
+    sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve ML/LLM triage as a JSON HTTP API.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    args = parser.parse_args(argv)
+    serve(args.host, args.port, max(1, args.workers))
+
+
+if __name__ == "__main__":
+    main()
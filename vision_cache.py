@@ -0,0 +1,162 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+CACHE_PATH = os.environ.get("VISION_CACHE_PATH", "vision_cache.sqlite3")
+MAX_ENTRIES = 2000
+TTL_SECONDS = 60 * 60  # A photo sent again after an hour is described again
+# Largest Hamming distance (of 64 bits) between two photos' hashes that still
+# counts as the same image; 0 reuses only exact hash matches. The cache is
+# shared by every patient, so a looser match can hand one patient's
+# description to a similar-looking photo of another
+MAX_DISTANCE = int(os.environ.get("VISION_CACHE_MAX_DISTANCE", "0"))
+# A uniform or low-contrast photo (a covered lens, plain skin, a dark room)
+# hashes to nearly all 0 or all 1 bits, like any other such photo. Hashes
+# with fewer than this many bits differing from either reuse a description
+# only for the very same image
+MIN_HASH_BITS = 8
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _to_signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _low_contrast(phash):
+    bits = phash.bit_count()
+    return min(bits, 64 - bits) < MIN_HASH_BITS
+
+
+class VisionCache:
+    """
+    Image descriptions keyed on a perceptual hash (see
+    image_prep.perceptual_hash), so a retaken photo of the same wound reuses
+    the description of the first one when their hashes are within
+    max_distance bits. The SHA-256 of the prepared JPEG is stored too: a
+    low-contrast photo (see MIN_HASH_BITS) reuses a description only when it
+    matches. Entries are kept in memory in LRU order for the near-match
+    scan, expire after ttl_seconds and are persisted to SQLite.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_entries=MAX_ENTRIES, ttl_seconds=TTL_SECONDS,
+                 max_distance=MAX_DISTANCE):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_distance = max_distance
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS image_descriptions ("
+            " namespace TEXT NOT NULL, phash INTEGER NOT NULL, digest TEXT NOT NULL,"
+            " description TEXT NOT NULL, created_at REAL NOT NULL, last_used_at REAL NOT NULL,"
+            " PRIMARY KEY (namespace, phash))"
+        )
+        self._conn.execute("DELETE FROM image_descriptions WHERE created_at < ?", (time.time() - ttl_seconds,))
+        self._conn.commit()
+        # (namespace, phash) -> (digest, description, created_at), least recently used first
+        self._entries = OrderedDict()
+        for namespace, phash, digest, description, created_at in self._conn.execute(
+                "SELECT namespace, phash, digest, description, created_at FROM image_descriptions"
+                " ORDER BY last_used_at"):
+            self._entries[(namespace, phash % (1 << 64))] = (digest, description, created_at)
+
+    def get(self, namespace, phash, digest):
+        """
+        Returns the description of the closest cached image within
+        max_distance of phash (for a low-contrast photo, of the image with
+        content hash digest only), or None on a miss or expired entry.
+        namespace separates descriptions from different models or prompts.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get((namespace, phash))
+            if entry is not None and now - entry[2] > self.ttl_seconds:
+                del self._entries[(namespace, phash)]
+                self._conn.execute("DELETE FROM image_descriptions WHERE namespace = ? AND phash = ?",
+                                   (namespace, _to_signed(phash)))
+                self._conn.commit()
+                entry = None
+            best = None
+            if _low_contrast(phash):
+                if entry is not None and entry[0] == digest:
+                    best = (namespace, phash)
+            elif entry is not None:
+                best = (namespace, phash)
+            elif self.max_distance > 0:
+                best_distance = self.max_distance + 1
+                for key, (_, _, created_at) in self._entries.items():
+                    if key[0] == namespace and now - created_at <= self.ttl_seconds and not _low_contrast(key[1]):
+                        distance = (key[1] ^ phash).bit_count()
+                        if distance < best_distance:
+                            best, best_distance = key, distance
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best)
+            self._conn.execute("UPDATE image_descriptions SET last_used_at = ? WHERE namespace = ? AND phash = ?",
+                               (now, best[0], _to_signed(best[1])))
+            self._conn.commit()
+            return self._entries[best][1]
+
+    def set(self, namespace, phash, digest, description):
+        """
+        Stores a description, replacing any other image with the same
+        perceptual hash, and evicts the least recently used entries over the
+        size limit.
+        """
+        now = time.time()
+        with self._lock:
+            self._entries[(namespace, phash)] = (digest, description, now)
+            self._entries.move_to_end((namespace, phash))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO image_descriptions"
+                " (namespace, phash, digest, description, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, _to_signed(phash), digest, description, now, now)
+            )
+            while len(self._entries) > self.max_entries:
+                (old_namespace, old_phash), _ = self._entries.popitem(last=False)
+                self._conn.execute("DELETE FROM image_descriptions WHERE namespace = ? AND phash = ?",
+                                   (old_namespace, _to_signed(old_phash)))
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._conn.execute("DELETE FROM image_descriptions")
+            self._conn.commit()
+
+
+def get_vision_cache():
+    """
+    Returns the process-wide vision cache, opening it on first use.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = VisionCache()
+    return _cache
+
+
+def set_vision_cache(cache):
+    """
+    Replaces the process-wide cache (e.g. with a throwaway one for benchmarks).
+    """
+    global _cache
+    with _cache_lock:
+        _cache = cache
@@ -1,62 +1,32 @@
-import streamlit as st
-from PIL import Image
-from groq import Groq
-import base64
-import io
-from streamlit_cookies_controller import CookieController
+import startup_timing
+with startup_timing.timed("import streamlit"):
+    import streamlit as st
+    from streamlit_cookies_controller import CookieController
+import os
 import time
-import joblib
-import pandas as pd
-import math
+with startup_timing.timed("import triage modules"):
+    import groq_client
+    import metrics
+    import triage_engine
+    from triage_engine import apply_input_defaults, calculate_recommended_triage
+    from triage_pipeline import recommend, run_triage
+    from triage_journal import get_journal
+    from triage_queue import PAGE_SIZE, get_triage_queue
+    from surge import read_patient_table, run_surge
 
 st.set_page_config(page_title="Triage Assist", layout="centered")
 
-# Cache the model and scaler loading to avoid reloading on every interaction
-@st.cache_resource
-def load_model_and_scaler():
-    voting_model = joblib.load('voting_model.pkl')
-    scaler = joblib.load('scaler.pkl')
-    feature_names = joblib.load('feature_names.pkl')
-    return voting_model, scaler, feature_names
-
-# Load the model and scaler once
-voting_model, scaler, feature_names = load_model_and_scaler()
+# Load and warm the model in the background once per process, so the login
+# page renders right away and the first submit does not wait on scikit-learn
+triage_engine.start_warmup()
+# Picks up models published to the registry without a restart
+triage_engine.start_model_watcher()
+# Serves /metrics and/or flushes a metrics file if METRICS_PORT / METRICS_FILE are set
+metrics.start_exporter()
 
+# Shared by every session, so calls reuse pooled connections
 def get_groq_client():
-    return Groq(api_key=st.secrets["API_KEY"])
-
-# Cache the image encoding function to avoid redundant computations
-@st.cache_data
-def encode_image(image):
-    """
-    Converts a PIL.Image object to a base64-encoded string.
-    """
-    buffered = io.BytesIO()  # Create a bytes buffer
-    image.save(buffered, format="JPEG")  # Save the image to the buffer in JPEG format
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')  # Encode to base64
-
-def analyze_image(image):
-    base64_image = encode_image(image)
-    client = get_groq_client()
-    chat_completion = client.chat.completions.create(
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": "A person has come to the hospital and this is an image of them. Give a 2-5 sentence description of the injury/ailment/sickness that has led them to come to the hospital. A medical professional should be able to use your description in order to make decisions. If it is not clear what you see, say that. It is better to be not specific than wrong."},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}",
-                        },
-                    },
-                ],
-            }
-        ],
-        model="llama-3.2-11b-vision-preview",
-    )
-
-    return chat_completion.choices[0].message.content
+    return groq_client.get_groq_client(st.secrets["API_KEY"])
 
 def get_triage_color(triage_level):
     if triage_level == "1":
@@ -72,122 +42,22 @@ def get_triage_color(triage_level):
     else:
         return "black"
 
-def map_sex(sex):
-    if sex == "Male":
-        return 1
-    elif sex == "Female":
-        return 2
-    else:
-        return 0  # Default value for "No Selection"
-
-def map_transport(transport):
-    if transport == "Walk":
-        return 1
-    elif transport == "Public Ambulance":
-        return 2
-    elif transport == "Private Vehicle":
-        return 3
-    elif transport == "Private Ambulance":
-        return 4
-    else:
-        return 0  # Default value for "No Selection"
-
-def map_consciousness(consciousness):
-    if consciousness == "Alert":
-        return 1
-    elif consciousness == "Verbal Response":
-        return 2
-    elif consciousness == "Pain Response":
-        return 3
-    elif consciousness == "Unresponsive":
-        return 4
-    else:
-        return 0  # Default value
-
-def map_pain(pain_level):
-    """
-    Map pain level to 1 or 2 based on the slider value.
-    """
-    return 2 if pain_level >= 4 else 1
-
-def map_injury(description):
-    """
-    Map injury to 1 or 2 based on the presence of the phrase "injur".
-    """
-    return 2 if "injur" in description.lower() else 1
-
-def convert_to_celsius(temp, unit):
-    """
-    Convert temperature to Celsius.
-    """
-    if unit == "Fahrenheit (°F)":
-        return (temp - 32) * 5 / 9  # Convert Fahrenheit to Celsius
-    else:
-        return temp  # Already in Celsius
-
-def predict_with_ml_model(input_data):
-    """
-    Predicts the triage level using the machine learning model.
-    """
-    # Scale the input data
-    input_data_scaled = scaler.transform(input_data)
-    # Make the prediction
-    prediction = voting_model.predict(input_data_scaled)
-    return prediction[0] + 1
-
-def calculate_recommended_triage(groq_triage_level, ml_triage_level, model_weight):
-    """
-    Calculate the recommended triage level as a weighted average.
-    """
-    if model_weight < 0: model_weight = 0
-    groq_weight = 1 - model_weight
-    ml_weight = model_weight
-    recommended_triage = groq_weight * float(groq_triage_level) + ml_weight * float(ml_triage_level)
-    return math.floor(recommended_triage)  # Round to the nearest integer
-
 # Initialize CookieController
 cookie_name = 'triage_assist'
 controller = CookieController(key='cookies')
 
+# How often the sidebar queue picks up requests made at other workstations
+QUEUE_REFRESH_SECONDS = 30
+# The LLM answer is streamed into the form. JSON mode cannot stream, so with
+# TRIAGE_STREAM_LLM=0 the form waits for the whole answer in JSON mode instead
+STREAM_LLM = os.environ.get("TRIAGE_STREAM_LLM", "1") != "0"
+
 # Mock user database (replace with a real database in production)
 USERS = {
     "doctor1": {"password": "password1"},
     "doctor2": {"password": "password2"},
 }
 
-# Initialize Groq client
-def get_groq_client():
-    return Groq(api_key=st.secrets["API_KEY"])
-
-# Function to encode the image
-def encode_image(image):
-    buffered = io.BytesIO()
-    image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
-
-# Function to analyze the image
-def analyze_image(image):
-    base64_image = encode_image(image)
-    client = get_groq_client()
-    chat_completion = client.chat.completions.create(
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": "A person has come to the hospital and this is an image of them. Give a 2-5 sentence description of the injury/ailment/sickness that has led them to come to the hospital. A medical professional should be able to use your description in order to make decisions. If it is not clear what you see, say that. It is better to be not specific than wrong."},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}",
-                        },
-                    },
-                ],
-            }
-        ],
-        model="llama-3.2-11b-vision-preview",
-    )
-    return chat_completion.choices[0].message.content
-
 # Function to get triage color
 def get_triage_color(triage_level):
     if triage_level == "1":
@@ -231,7 +101,7 @@ def login_page():
         st.session_state.login_ok = True
         st.session_state.username = "guest"
         st.session_state.is_guest = True
-        st.experimental_rerun()
+        st.rerun()
 
 # Authenticate user
 def authenticate():
@@ -244,7 +114,7 @@ def authenticate():
         controller.set(f'{cookie_name}_username', username, max_age=80*60*60)
         controller.set(f'{cookie_name}_password', password, max_age=80*60*60)
         st.session_state.login_ok = True
-        st.experimental_rerun()
+        st.rerun()
     else:
         st.error("Wrong username/password.")
 
@@ -260,39 +130,61 @@ def logout():
     st.session_state.username = None
     st.session_state.password = None
     st.session_state.is_guest = False
-    st.session_state.triage_requests = []
-    st.experimental_rerun()
-
-# Main App
-def main_app():
-    if "triage_requests" not in st.session_state:
-        st.session_state.triage_requests = []
- 
-    # Sidebar for previous triage requests
-    st.sidebar.title("📋 Previous Triage Requests")
-    if st.session_state.triage_requests:
-        # Sort triage requests by priority (1 at the top)
-        sorted_requests = sorted(st.session_state.triage_requests, key=lambda x: int(x["triage_level"]))
-        for i, request in enumerate(sorted_requests):
-            with st.sidebar.expander(f"Triage {i + 1}: Level {request['triage_level']}"):
+    st.session_state.pop("triage_result", None)
+    st.session_state.pop("surge_results", None)
+    st.rerun()
+
+# Sidebar queue. Open requests are shared by every workstation and the
+# database returns them most urgent first, one page at a time. As a fragment,
+# resolving or paging redraws only the queue; it also refreshes on its own so
+# requests added at other workstations show up.
+@st.fragment(run_every=QUEUE_REFRESH_SECONDS)
+def queue_sidebar():
+    queue = get_triage_queue()
+    if "queue_page" not in st.session_state:
+        st.session_state.queue_page = 0
+
+    st.title("📋 Previous Triage Requests")
+    open_count = queue.count_open()
+    page_count = max(1, -(-open_count // PAGE_SIZE))
+    st.session_state.queue_page = min(st.session_state.queue_page, page_count - 1)
+    page = st.session_state.queue_page
+    if open_count:
+        for i, request in enumerate(queue.open_requests(page), start=page * PAGE_SIZE):
+            with st.expander(f"Triage {i + 1}: Level {request['triage_level']}"):
                 st.write(f"**Description:** {request['description']}")
                 st.write(f"**Triage Level:** {request['triage_level']}")
                 st.write(f"**Reason:** {request['triage_description']}")
-                if st.button(f"Resolve Triage {i + 1}", key=f"resolve_{i}"):
-                     st.session_state.triage_requests.pop(i)
-                     st.experimental_rerun()
+                # The level the clinician settled on; it feeds incremental learning.
+                # Nothing is preselected, so resolving without a pick records no
+                # outcome instead of echoing the recommendation back as truth
+                confirmed_level = st.selectbox("Confirmed level", [1, 2, 3, 4, 5], index=None,
+                                               placeholder="Not confirmed", key=f"confirm_{request['id']}")
+                if st.button(f"Resolve Triage {i + 1}", key=f"resolve_{request['id']}"):
+                    if queue.resolve(request["id"], resolved_by=st.session_state.get("username"),
+                                     confirmed_level=confirmed_level):
+                        get_journal().append("resolve", request_id=request["id"],
+                                             triage_level=request["triage_level"], confirmed_level=confirmed_level,
+                                             resolved_by=st.session_state.get("username"))
+                    else:
+                        st.toast("That request was already resolved at another workstation.")
+                    st.rerun(scope="fragment")
+        if page_count > 1:
+            prev_col, page_col, next_col = st.columns([1, 2, 1])
+            if prev_col.button("◀", disabled=page == 0, key="queue_prev"):
+                st.session_state.queue_page -= 1
+                st.rerun(scope="fragment")
+            page_col.caption(f"Page {page + 1} of {page_count} ({open_count} open)")
+            if next_col.button("▶", disabled=page >= page_count - 1, key="queue_next"):
+                st.session_state.queue_page += 1
+                st.rerun(scope="fragment")
     else:
-        st.sidebar.write("No triage requests yet.")
- 
-     # Logout button
-    if st.sidebar.button("Logout"):
-        logout()
-
-    model_weight = 0
+        st.write("No triage requests yet.")
 
-    st.title("🏥 TriageAssist")
-    st.write("Enter patient details below to determine their triage status.")
 
+# Input form. Changing a field reruns only the form, not the queue or results
+@st.fragment
+def triage_form():
     # Input Fields
     age = st.number_input("Age", min_value=0, max_value=120, step=1, value=None)
 
@@ -346,166 +238,223 @@ def main_app():
         st.write("Upload a photo:")
         image_file = st.file_uploader("Upload an image", type=["jpg", "jpeg", "png"], label_visibility="collapsed")
         if image_file is not None:
-            image = Image.open(image_file)
-            model_weight = model_weight - .3
+            image = image_file.getvalue()  # Raw bytes; resized before upload in the pipeline
     else:
         st.write("Take a photo:")
         camera_image = st.camera_input("Take a photo", label_visibility="collapsed")
         if camera_image is not None:
-            image = Image.open(camera_image)
-            model_weight = model_weight - .3
+            image = camera_image.getvalue()
 
     if st.button("Submit", use_container_width=True):
         # Handle empty inputs
-        if age is None:
-            age = 0
-        else:
-            model_weight += 0.05
-
-        if pain_level is None:
-            pain_level = 0
-        else:
-            model_weight += 0.05
-
-        if bp_systolic is None:
-            bp_systolic = 0
-        else:
-            model_weight += 0.05
-
-        if bp_diastolic is None:
-            bp_diastolic = 0
-        else:
-            model_weight += 0.05
-
-        if heart_rate is None:
-            heart_rate = 0
-        else:
-            model_weight += 0.05
-
-        if oxygen_saturation is None:
-            oxygen_saturation = 0
-        else:
-            model_weight += 0.05
-
-        if respiratory_rate is None:
-            respiratory_rate = 0
-        else:
-            model_weight += 0.05
-
-        if body_temperature is None:
-            body_temperature = 0
-        else:
-            model_weight += 0.05
-
-        if sex is None:
-            sex = "No Selection"
-        else:
-            model_weight += 0.05
-
-        if consciousness is None:
-            consciousness = "Unknown"
-        else:
-            model_weight += 0.05
-
-        if transport is None:
-            transport = "No Selection"
-        else:
-            model_weight += 0.05
-
-        if description is None or description == "":
-            description = "No description"
-        else:
-            model_weight -= 0.1
+        patient, model_weight = apply_input_defaults({
+            "age": age,
+            "sex": sex,
+            "description": description,
+            "pain_level": pain_level,
+            "bp_systolic": bp_systolic,
+            "bp_diastolic": bp_diastolic,
+            "heart_rate": heart_rate,
+            "oxygen_saturation": oxygen_saturation,
+            "respiratory_rate": respiratory_rate,
+            "body_temperature": body_temperature,
+            "temp_unit": temp_unit,
+            "consciousness": consciousness,
+            "transport": transport,
+        }, has_image=image is not None)
+        description, body_temperature = patient["description"], patient["body_temperature"]
 
         # Convert body temperature to Celsius
-        body_temperature_celsius = convert_to_celsius(body_temperature, temp_unit)
-
-        image_description = "No image provided."
-        if image is not None:
-            image_description = analyze_image(image)
-
-        # Create input data for the model
-        input_data = pd.DataFrame({
-            'Sex': [map_sex(sex)],
-            'Age': [age],
-            'Arrival mode': [map_transport(transport)],
-            'Injury': [map_injury(description)],
-            'Mental': [map_consciousness(consciousness)],
-            'Pain': [map_pain(pain_level)],  # Updated pain mapping
-            'SBP': [bp_systolic],
-            'DBP': [bp_diastolic],
-            'HR': [heart_rate],
-            'RR': [respiratory_rate],
-            'BT': [body_temperature_celsius],  # Use converted temperature
-        })
-
-        # Ensure the input data has the same columns as the training data
-        input_data = input_data.reindex(columns=feature_names, fill_value=0)
-
-        # Make the prediction using the machine learning model
-        ml_triage_level = predict_with_ml_model(input_data)
-
-        # Groq Prediction
-        query = ("Give the triage level based on the following info. Description: " + str(description)
-                 + ", Description of the image of the patient: " + str(image_description)
-                 + ", Pain Level: " + str(pain_level)
-                 + ", BP: " + str(bp_systolic) + "/" + str(bp_diastolic)
-                 + ", Heart Rate: " + str(heart_rate)
-                 + ", Oxygen Saturation: " + str(oxygen_saturation)
-                 + ", Respiratory Rate: " + str(respiratory_rate)
-                 + ", Body Temperature: " + str(body_temperature_celsius) + "°C"  # Display in Celsius
-                 + ", Sex: " + str(sex)
-                 + ", Consciousness: " + str(consciousness)
-                 + ", Mode of Transport: " + str(transport)
-                 + ". Give a number from 1 through 5, where 1 is a life threatening injury that requires intervention, and 5 is not life-threatening in any way. Then, give a ONE sentence (LESS THAN 10 WORDS) description of why. Separate the number from the description with a semi colon (for example, \"1;Patient is entering cardiac arrest and needs AED.\" No extra punctuation or extra words. Only a number that is 1, 2, 3, 4, or 5 and a description that is ONE sentence and 10 words or less. DO NOT use a semi colon anywhere else in the response. Do not give explicit medical advice.")
-
-        client = get_groq_client()
-
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": query,
-                }
-            ],
-            model="llama-3.3-70b-versatile",
-        )
-
-        response = chat_completion.choices[0].message.content
-        groq_triage_level = response.split(";")[0]
-        groq_triage_description = response.split(";")[1]
-
-        # Calculate the recommended triage level
-        recommended_triage = calculate_recommended_triage(groq_triage_level, ml_triage_level, model_weight)
-
-        # Summary card at the top
-        st.subheader("Recommended Triage")
-        recommended_triage_color = get_triage_color(str(recommended_triage))
-        st.markdown(
-            f"""
-                            <div style="
-                                background-color: {recommended_triage_color};
-                                padding: 20px;
-                                border-radius: 10px;
-                                text-align: center;
-                                font-size: 24px;
-                                color: black;
-                                font-weight: bold;
-                                margin-bottom: 20px;
-                            ">
-                                Recommended Triage Level: {recommended_triage}
-                            </div>
-                            """,
-            unsafe_allow_html=True,
-        )
-
-        with st.expander("More Details", expanded=True):
-            # Create columns for the three main components
-            col1, col2, col3 = st.columns(3)
-
-            # Groq Recommendation
-            with col1:
-                st.subheader("LLM Prediction")
+        body_temperature_celsius = triage_engine.convert_to_celsius(body_temperature, temp_unit)
+
+        # Run the ML prediction alongside the vision -> LLM chain and show the
+        # ML level as soon as it is ready instead of after the remote calls
+        ml_preview = st.empty()
+        llm_preview = st.empty()
+        rationale_preview = st.empty()
+        streamed_levels = {}
+
+        def show_ml_preview(level):
+            streamed_levels["ml"] = level
+            ml_preview.info(f"ML Prediction: Level {level}. Waiting for the LLM analysis...")
+
+        # When the LLM answer is streamed, the recommended level is shown as
+        # soon as its first token arrives and the rationale fills in after it
+        def show_llm_level(level):
+            provisional_triage = calculate_recommended_triage(level, streamed_levels["ml"], model_weight)
+            ml_preview.empty()
+            llm_preview.markdown(
+                f"""
+                <div style="
+                    background-color: {get_triage_color(str(provisional_triage))};
+                    padding: 20px;
+                    border-radius: 10px;
+                    text-align: center;
+                    font-size: 24px;
+                    color: black;
+                    font-weight: bold;
+                ">
+                    Recommended Triage Level: {provisional_triage}
+                </div>
+                """,
+                unsafe_allow_html=True,
+            )
+
+        def show_llm_text(text):
+            rationale_preview.markdown(f"**Rationale:** {text}")
+
+        with st.spinner("Analyzing patient..."), metrics.span("submit"):
+            result = run_triage(get_groq_client(), patient, image, on_ml_level=show_ml_preview,
+                                on_llm_level=show_llm_level if STREAM_LLM else None,
+                                on_llm_text=show_llm_text if STREAM_LLM else None)
+        ml_preview.empty()
+
+        ml_triage_level = result["ml_triage_level"]
+        recommended_triage, model_weight, groq_triage_description = recommend(result, model_weight)
+
+        # Keep the result so later reruns redraw it instead of recomputing it
+        st.session_state.triage_result = {
+            "patient": patient,
+            "model_weight": model_weight,
+            "has_image": image is not None,
+            "body_temperature_celsius": body_temperature_celsius,
+            "result": result,
+            "recommended_triage": recommended_triage,
+        }
+        request_id = get_triage_queue().add(recommended_triage, description, groq_triage_description,
+                                            created_by=st.session_state.get("username"),
+                                            features=result["features"], model_version=result["model_version"],
+                                            ml_triage_level=ml_triage_level)
+        get_journal().append("triage", request_id=request_id, created_by=st.session_state.get("username"),
+                             patient=patient, has_image=image is not None, model_weight=model_weight,
+                             recommended_triage=recommended_triage, **result)
+        # Full rerun so the queue shows the new request
+        st.rerun()
+
+
+# Surge mode: many patients at once from a pasted, edited or uploaded table
+@st.fragment
+def surge_form():
+    import pandas as pd
+
+    st.write("Paste patients into the table, or upload a CSV with the same columns. "
+             "Photos are matched to patients by the file name in the `image` column.")
+    csv_file = st.file_uploader("Patient table (CSV)", type=["csv"])
+    if csv_file is not None:
+        table = pd.read_csv(csv_file)
+    else:
+        # Typed columns, so pasted vitals arrive as numbers
+        text_fields = {"sex", "description", "temp_unit", "consciousness", "transport", "image"}
+        table = pd.DataFrame({field: pd.Series(dtype=object if field in text_fields else float)
+                              for field in list(triage_engine.PATIENT_FIELDS) + ["image"]})
+    table = st.data_editor(table, num_rows="dynamic", use_container_width=True, key="surge_table")
+    image_files = st.file_uploader("Patient photos", type=["jpg", "jpeg", "png"], accept_multiple_files=True)
+
+    if st.button("Triage all", use_container_width=True):
+        patients, image_names = read_patient_table(table)
+        if not patients:
+            st.warning("Enter at least one patient.")
+            return
+        photos = {image_file.name: image_file.getvalue() for image_file in image_files or []}
+        images = {i: photos[name] for i, name in enumerate(image_names) if name in photos}
+
+        progress = st.progress(0.0, text=f"Triaging {len(patients)} patients...")
+        done = []
+
+        def add_to_queue(index, result):
+            done.append(index)
+            progress.progress(len(done) / len(patients), text=f"Triaged {len(done)} of {len(patients)} patients")
+            request_id = get_triage_queue().add(
+                result["recommended_triage"], result["patient"]["description"], result["rationale"],
+                created_by=st.session_state.get("username"), features=result["features"],
+                model_version=result["model_version"], ml_triage_level=result["ml_triage_level"])
+            get_journal().append("surge_triage", request_id=request_id, created_by=st.session_state.get("username"),
+                                 has_image=index in images, **result)
+
+        st.session_state.surge_results = run_surge(get_groq_client(), patients, images, on_result=add_to_queue)
+        # Full rerun so the queue shows the new requests
+        st.rerun()
+
+
+def surge_results_panel():
+    results = st.session_state.get("surge_results")
+    if not results:
+        return
+    st.subheader(f"Surge Triage ({len(results)} patients)")
+    ml_only = sum(result["ml_only"] and not result["llm_bypassed"] for result in results)
+    if ml_only:
+        st.warning(f"{ml_only} of {len(results)} patients were triaged by the ML model alone "
+                   "because the LLM gave no usable answer for them.")
+    bypassed = sum(result["llm_bypassed"] for result in results)
+    if bypassed:
+        st.caption(f"{bypassed} confident low-acuity patients skipped the LLM.")
+    order = sorted(range(len(results)), key=lambda i: results[i]["recommended_triage"])
+    st.dataframe([{
+        "Row": i + 1,
+        "Level": int(results[i]["recommended_triage"]),
+        "ML": int(results[i]["ml_triage_level"]),
+        "LLM": results[i]["groq_triage_level"] or "Unavailable",
+        "Description": results[i]["patient"]["description"],
+        "Rationale": results[i]["rationale"],
+    } for i in order], hide_index=True, use_container_width=True)
+    packs = {id(result["pack_usage"]): result["pack_usage"] for result in results if result["pack_usage"]}
+    tokens = sum(usage["prompt_tokens"] + usage["completion_tokens"] for usage in packs.values())
+    st.caption(f"{len(packs)} packed LLM calls, {tokens} tokens")
+
+
+# Results of the last submit, drawn from session state
+def results_panel():
+    saved = st.session_state.get("triage_result")
+    if saved is None:
+        return
+    patient, model_weight, result = saved["patient"], saved["model_weight"], saved["result"]
+    body_temperature_celsius = saved["body_temperature_celsius"]
+    recommended_triage = saved["recommended_triage"]
+    age, sex, description = patient["age"], patient["sex"], patient["description"]
+    pain_level, consciousness, transport = patient["pain_level"], patient["consciousness"], patient["transport"]
+    bp_systolic, bp_diastolic = patient["bp_systolic"], patient["bp_diastolic"]
+    heart_rate, respiratory_rate = patient["heart_rate"], patient["respiratory_rate"]
+    ml_triage_level = result["ml_triage_level"]
+    groq_triage_level = result["groq_triage_level"]
+    groq_triage_description = result["groq_triage_description"]
+
+    # Summary card at the top
+    st.subheader("Recommended Triage")
+    if result.get("llm_bypassed"):
+        st.info(f"ML-only triage: {result['llm_error']}, so the LLM was not asked.")
+    elif result["ml_only"]:
+        st.warning("ML-only triage: the LLM could not be reached or gave no usable answer, so this level "
+                   f"comes from the machine learning model alone. ({result['llm_error']})")
+    recommended_triage_color = get_triage_color(str(recommended_triage))
+    st.markdown(
+        f"""
+                        <div style="
+                            background-color: {recommended_triage_color};
+                            padding: 20px;
+                            border-radius: 10px;
+                            text-align: center;
+                            font-size: 24px;
+                            color: black;
+                            font-weight: bold;
+                            margin-bottom: 20px;
+                        ">
+                            Recommended Triage Level: {recommended_triage}
+                        </div>
+                        """,
+        unsafe_allow_html=True,
+    )
+
+    with st.expander("More Details", expanded=True):
+        # Create columns for the three main components
+        col1, col2, col3 = st.columns(3)
+
+        # Groq Recommendation
+        with col1:
+            st.subheader("LLM Prediction")
+            if result["ml_only"]:
+                st.markdown("**Skipped**" if result.get("llm_bypassed") else "**Unavailable**")
+                st.caption(result["llm_error"])
+            else:
                 groq_triage_color = get_triage_color(groq_triage_level)
                 st.markdown(
                     f"""
@@ -525,149 +474,190 @@ def main_app():
                     unsafe_allow_html=True,
                 )
                 st.markdown(f"**Rationale:** {groq_triage_description}")
+                if result["llm_cached"]:
+                    st.caption("Reused the LLM answer for identical inputs.")
+                llm_timings = result["llm_timings"]
+                if llm_timings is not None and llm_timings["level"] is not None:
+                    st.caption(f"LLM first token {llm_timings['first_token'] * 1000:,.0f} ms, "
+                               f"level {llm_timings['level'] * 1000:,.0f} ms, "
+                               f"complete {llm_timings['total'] * 1000:,.0f} ms")
+                llm_usage = result["llm_usage"]
+                if llm_usage is not None and llm_usage["triage"] is not None:
+                    st.caption(f"Tokens: {llm_usage['triage']['prompt_tokens']} prompt, "
+                               f"{llm_usage['triage']['completion_tokens']} completion")
                 st.markdown("**Inputs Considered:**")
                 st.markdown("- Patient description")
                 st.markdown("- Image analysis")
                 st.markdown("- All clinical vitals")
                 st.markdown("- Consciousness level")
                 st.markdown("- Transport method")
+                image_stats = result["image_stats"]
+                if image_stats is not None:
+                    st.caption(f"Image sent: {image_stats['bytes_before'] / 1024:,.0f} KB "
+                               f"→ {image_stats['bytes_after'] / 1024:,.0f} KB "
+                               f"({image_stats['size_after'][0]}x{image_stats['size_after'][1]})")
+                if result["vision_cached"]:
+                    st.caption("Reused the image description of the same photo.")
+
+        # Model Recommendation
+        with col2:
+            st.subheader("ML Prediction")
+            ml_triage_color = get_triage_color(str(ml_triage_level))
+            st.markdown(
+                f"""
+                <div style="
+                    background-color: {ml_triage_color};
+                    padding: 20px;
+                    border-radius: 10px;
+                    text-align: center;
+                    font-size: 24px;
+                    color: black;
+                    font-weight: bold;
+                    margin-bottom: 10px;
+                ">
+                    Level: {ml_triage_level}
+                </div>
+                """,
+                unsafe_allow_html=True,
+            )
+            st.markdown("**Algorithm:** Voting Classifier (RF + XP + KNN)")
+            st.caption(f"Model version: {result['model_version']}")
+            if result.get("ml_confidence") is not None:
+                st.caption(f"Confidence: {result['ml_confidence']:.0%}")
+            st.markdown("**Inputs Considered:**")
+            st.markdown("- Age: " + str(age))
+            st.markdown("- Sex: " + str(sex))
+            st.markdown("- Transport: " + str(transport))
+            st.markdown("- Consciousness: " + str(consciousness))
+            st.markdown("- BP: " + str(bp_systolic) + "/" + str(bp_diastolic))
+            st.markdown("- Heart rate: " + str(heart_rate))
+            st.markdown("- Resp. rate: " + str(respiratory_rate))
+            st.markdown("- Temp: " + f"{body_temperature_celsius:.1f}°C")
+
+        # Model Weight and Final Recommendation
+        with col3:
+            st.subheader("Final Prediction")
+            recommended_triage_color = get_triage_color(str(recommended_triage))
+            st.markdown(
+                f"""
+                <div style="
+                    background-color: {recommended_triage_color};
+                    padding: 20px;
+                    border-radius: 10px;
+                    text-align: center;
+                    font-size: 24px;
+                    color: black;
+                    font-weight: bold;
+                    margin-bottom: 10px;
+                ">
+                    Level: {recommended_triage}
+                </div>
+                """,
+                unsafe_allow_html=True,
+            )
+
+            # Display model weight information
+            st.markdown("**Model Weighting:**")
+            st.write(f"Machine learning model contribution: {model_weight * 100:.1f}%")
+            st.write(f"Llama LLM analysis contribution: {(1 - model_weight) * 100:.1f}%")
+
+            # Weight adjustment factors
+            st.markdown("**Weight Adjustment Factors:**")
+            if saved["has_image"]:
+                st.write("- Image analysis reduced model weight")
+            if description != "No description":
+                st.write("- Text description reduced model weight")
+            if age is not None:
+                st.write("- Age increased model weight")
+            if pain_level is not None:
+                st.write("- Pain level increased model weight")
+            # Add more factors as needed
+
+            st.progress(model_weight)
+            st.caption("Higher values mean more reliance on the ML model")
+
+
+    # st.subheader("Groq Prediction")
+    # groq_triage_color = get_triage_color(groq_triage_level)
+    # st.markdown(
+    #     f"""
+    #     <div style="
+    #         background-color: {groq_triage_color};
+    #         padding: 20px;
+    #         border-radius: 10px;
+    #         text-align: center;
+    #         font-size: 24px;
+    #         color: black;
+    #         font-weight: bold;
+    #     ">
+    #         Triage Level: {groq_triage_level}
+    #     </div>
+    #     """,
+    #     unsafe_allow_html=True,
+    # )
+    # st.markdown(
+    #     f"""
+    #     <div style="
+    #         text-align: center;
+    #         font-size: 16px;
+    #         color: #666666;
+    #         margin-top: 10px;
+    #     ">
+    #         {groq_triage_description}
+    #     </div>
+    #     """,
+    #     unsafe_allow_html=True,
+    # )
+    #
+    # st.subheader("Machine Learning Model Prediction")
+    # ml_triage_color = get_triage_color(str(ml_triage_level))
+    # st.markdown(
+    #     f"""
+    #     <div style="
+    #         background-color: {ml_triage_color};
+    #         padding: 20px;
+    #         border-radius: 10px;
+    #         text-align: center;
+    #         font-size: 24px;
+    #         color: black;
+    #         font-weight: bold;
+    #     ">
+    #         Triage Level: {ml_triage_level}
+    #     </div>
+    #     """,
+    #     unsafe_allow_html=True,
+    # )
 
-            # Model Recommendation
-            with col2:
-                st.subheader("ML Prediction")
-                ml_triage_color = get_triage_color(str(ml_triage_level))
-                st.markdown(
-                    f"""
-                    <div style="
-                        background-color: {ml_triage_color};
-                        padding: 20px;
-                        border-radius: 10px;
-                        text-align: center;
-                        font-size: 24px;
-                        color: black;
-                        font-weight: bold;
-                        margin-bottom: 10px;
-                    ">
-                        Level: {ml_triage_level}
-                    </div>
-                    """,
-                    unsafe_allow_html=True,
-                )
-                st.markdown("**Algorithm:** Voting Classifier (RF + XP + KNN)")
-                st.markdown("**Inputs Considered:**")
-                st.markdown("- Age: " + str(age))
-                st.markdown("- Sex: " + str(sex))
-                st.markdown("- Transport: " + str(transport))
-                st.markdown("- Consciousness: " + str(consciousness))
-                st.markdown("- BP: " + str(bp_systolic) + "/" + str(bp_diastolic))
-                st.markdown("- Heart rate: " + str(heart_rate))
-                st.markdown("- Resp. rate: " + str(respiratory_rate))
-                st.markdown("- Temp: " + f"{body_temperature_celsius:.1f}°C")
-
-            # Model Weight and Final Recommendation
-            with col3:
-                st.subheader("Final Prediction")
-                recommended_triage_color = get_triage_color(str(recommended_triage))
-                st.markdown(
-                    f"""
-                    <div style="
-                        background-color: {recommended_triage_color};
-                        padding: 20px;
-                        border-radius: 10px;
-                        text-align: center;
-                        font-size: 24px;
-                        color: black;
-                        font-weight: bold;
-                        margin-bottom: 10px;
-                    ">
-                        Level: {recommended_triage}
-                    </div>
-                    """,
-                    unsafe_allow_html=True,
-                )
 
-                # Display model weight information
-                st.markdown("**Model Weighting:**")
-                st.write(f"Machine learning model contribution: {model_weight * 100:.1f}%")
-                st.write(f"Llama LLM analysis contribution: {(1 - model_weight) * 100:.1f}%")
-
-                # Weight adjustment factors
-                st.markdown("**Weight Adjustment Factors:**")
-                if image is not None:
-                    st.write("- Image analysis reduced model weight")
-                if description != "No description":
-                    st.write("- Text description reduced model weight")
-                if age is not None:
-                    st.write("- Age increased model weight")
-                if pain_level is not None:
-                    st.write("- Pain level increased model weight")
-                # Add more factors as needed
-
-                st.progress(model_weight)
-                st.caption("Higher values mean more reliance on the ML model")
-
-
-        # st.subheader("Groq Prediction")
-        # groq_triage_color = get_triage_color(groq_triage_level)
-        # st.markdown(
-        #     f"""
-        #     <div style="
-        #         background-color: {groq_triage_color};
-        #         padding: 20px;
-        #         border-radius: 10px;
-        #         text-align: center;
-        #         font-size: 24px;
-        #         color: black;
-        #         font-weight: bold;
-        #     ">
-        #         Triage Level: {groq_triage_level}
-        #     </div>
-        #     """,
-        #     unsafe_allow_html=True,
-        # )
-        # st.markdown(
-        #     f"""
-        #     <div style="
-        #         text-align: center;
-        #         font-size: 16px;
-        #         color: #666666;
-        #         margin-top: 10px;
-        #     ">
-        #         {groq_triage_description}
-        #     </div>
-        #     """,
-        #     unsafe_allow_html=True,
-        # )
-        #
-        # st.subheader("Machine Learning Model Prediction")
-        # ml_triage_color = get_triage_color(str(ml_triage_level))
-        # st.markdown(
-        #     f"""
-        #     <div style="
-        #         background-color: {ml_triage_color};
-        #         padding: 20px;
-        #         border-radius: 10px;
-        #         text-align: center;
-        #         font-size: 24px;
-        #         color: black;
-        #         font-weight: bold;
-        #     ">
-        #         Triage Level: {ml_triage_level}
-        #     </div>
-        #     """,
-        #     unsafe_allow_html=True,
-        # )
-
-        st.session_state.triage_requests.append({
-            "triage_level": recommended_triage,
-            "description": description,
-            "triage_description": groq_triage_description,
-        })
+# Main App
+def main_app():
+    with st.sidebar:
+        queue_sidebar()
+        # Logout button
+        if st.button("Logout"):
+            logout()
+
+    st.title("🏥 TriageAssist")
+    mode = st.radio("Mode", ["Single patient", "Surge"], horizontal=True, label_visibility="collapsed")
+    if mode == "Surge":
+        st.write("Triage many incoming patients at once, most urgent first.")
+        surge_form()
+        surge_results_panel()
+        return
+
+    st.write("Enter patient details below to determine their triage status.")
+
+    triage_form()
+    if st.session_state.get("triage_result") is not None:
+        with metrics.span("render"):
+            results_panel()
 
 # App Entry Point
 def main():
-    time.sleep(1)
     if not st.session_state["login_ok"]:
+        # Give the cookie component a moment to report back before deciding
+        # the user is logged out; logged-in reruns skip the wait
+        time.sleep(1)
         cookie_username = controller.get(f'{cookie_name}_username')
         cookie_password = controller.get(f'{cookie_name}_password')
 